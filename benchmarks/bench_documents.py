@@ -0,0 +1,69 @@
+"""Measures the CPU time spent creating Elasticsearch documents.
+
+Builds documents from synthetic object metadata with DocumentBuilder, which
+MetadataSync uses for every object it indexes, and reports the time per
+document.
+
+Example:
+
+    python -m benchmarks.bench_documents --metadata-keys 50 --parse-json
+"""
+import argparse
+import email.utils
+import json
+import time
+
+from swift_metadata_sync.document_builder import DocumentBuilder
+from swift_metadata_sync.metadata_sync import MetadataSync
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the creation of Elasticsearch documents')
+    parser.add_argument('--documents', type=int, default=20000,
+                        help='number of documents to create')
+    parser.add_argument('--metadata-keys', type=int, default=20,
+                        help='number of user metadata keys per object')
+    parser.add_argument('--parse-json', action='store_true',
+                        help='store JSON metadata values and parse them')
+    parser.add_argument('--fast-json', action='store_true',
+                        help='parse the JSON values with ujson, if installed')
+    return parser.parse_args()
+
+
+def make_metadata(keys, as_json):
+    timestamp = 1500000000.12345
+    meta = {
+        'content-length': '1024',
+        'content-type': 'application/octet-stream',
+        'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+        'last-modified': email.utils.formatdate(timestamp, usegmt=True),
+        'x-timestamp': '%.5f' % timestamp,
+        'x-trans-id': 'tx0123456789abcdef01234-0059682f00',
+        'x-backend-timestamp': '%.5f' % timestamp,
+        'accept-ranges': 'bytes',
+    }
+    for i in xrange(keys):
+        value = 'value-%d' % i
+        if as_json:
+            value = json.dumps({'value': value, 'number': i})
+        meta['x-object-meta-key-%d' % i] = value
+    return meta
+
+
+def main():
+    args = parse_args()
+    builder = DocumentBuilder(MetadataSync.DOC_MAPPING.keys(),
+                              MetadataSync.USER_META_PREFIX,
+                              args.parse_json, args.fast_json)
+    meta = make_metadata(args.metadata_keys, args.parse_json)
+    start = time.clock()
+    for i in xrange(args.documents):
+        builder.build(meta, u'AUTH_bench', u'bench', u'object-%d' % i)
+    elapsed = time.clock() - start
+    print '%d documents with %d metadata keys: %.1f us per document' % (
+        args.documents, args.metadata_keys, elapsed / args.documents * 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""Measures the throughput of MetadataSync.handle().
+
+The benchmark syncs synthetic container rows into an in-process fake
+Elasticsearch server, using a fake Swift internal client with configurable
+latency, and reports the rows processed per second, the chunk latency
+percentiles, and the peak RSS of the process.
+
+Example:
+
+    python -m benchmarks.bench_handle --rows 20000 --head-latency 0.005 \
+        --metadata-keys 20 --parse-json
+"""
+import argparse
+import json
+import logging
+import random
+import resource
+import shutil
+import string
+import tempfile
+import time
+
+from swift.common.utils import Timestamp
+
+from swift_metadata_sync import checkpoint_store
+from swift_metadata_sync import green
+from swift_metadata_sync import registry
+from swift_metadata_sync.metadata_sync import MetadataSync
+from .fake_es import FakeElasticsearch
+from .fake_swift import FakeInternalClient
+
+
+ROW_TIMESTAMP = 1500000000.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the MetadataSync.handle() sync path')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of container rows to sync')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='rows passed to each handle() call')
+    parser.add_argument('--passes', type=int, default=1,
+                        help='number of times the rows are synced; passes '
+                             'after the first measure already indexed rows')
+    parser.add_argument('--name-length', type=int, default=32,
+                        help='length of the object names')
+    parser.add_argument('--delete-ratio', type=float, default=0.0,
+                        help='fraction of the rows that are deletions')
+    parser.add_argument('--metadata-keys', type=int, default=5,
+                        help='number of user metadata keys per object')
+    parser.add_argument('--metadata-size', type=int, default=32,
+                        help='size of each user metadata value')
+    parser.add_argument('--parse-json', action='store_true',
+                        help='store JSON metadata values and parse them')
+    parser.add_argument('--head-latency', type=float, default=0.0,
+                        help='latency of each Swift HEAD in seconds')
+    parser.add_argument('--es-latency', type=float, default=0.0,
+                        help='latency of each Elasticsearch request in '
+                             'seconds')
+    parser.add_argument('--setting', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='additional container mapping setting; the '
+                             'value is parsed as JSON if possible')
+    parser.add_argument('--green-io', action='store_true',
+                        help='patch the sockets with eventlet, as the '
+                             'green_io option does')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the synthetic rows')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    return parser.parse_args()
+
+
+def make_rows(count, name_length, delete_ratio, rand):
+    created_at = Timestamp(ROW_TIMESTAMP).internal
+    rows = []
+    for row_id in xrange(1, count + 1):
+        prefix = '%08d-' % row_id
+        name = prefix + ''.join(
+            rand.choice(string.ascii_letters)
+            for _ in xrange(max(0, name_length - len(prefix))))
+        rows.append({'ROWID': row_id,
+                     'name': name,
+                     'deleted': rand.random() < delete_ratio,
+                     'created_at': created_at,
+                     'size': 1024,
+                     'content_type': 'application/octet-stream',
+                     'etag': 'd41d8cd98f00b204e9800998ecf8427e'})
+    return rows
+
+
+def make_metadata(keys, size, as_json, rand):
+    metadata = {}
+    for i in xrange(keys):
+        value = ''.join(rand.choice(string.ascii_letters)
+                        for _ in xrange(size))
+        if as_json:
+            value = json.dumps({'value': value, 'number': i, 'flag': True})
+        metadata['x-object-meta-key-%d' % i] = value
+    return metadata
+
+
+def parse_settings(settings):
+    parsed = {}
+    for setting in settings:
+        key, value = setting.split('=', 1)
+        try:
+            parsed[key] = json.loads(value)
+        except ValueError:
+            parsed[key] = value
+    return parsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(args):
+    rand = random.Random(args.seed)
+    rows = make_rows(args.rows, args.name_length, args.delete_ratio, rand)
+    swift = FakeInternalClient(
+        latency=args.head_latency,
+        metadata=make_metadata(args.metadata_keys, args.metadata_size,
+                               args.parse_json, rand))
+    es = FakeElasticsearch(latency=args.es_latency).start()
+    status_dir = tempfile.mkdtemp()
+    sync = None
+    try:
+        settings = {'account': u'AUTH_bench',
+                    'container': u'bench',
+                    'index': 'bench',
+                    'es_hosts': es.url,
+                    'parse_json': args.parse_json}
+        settings.update(parse_settings(args.setting))
+        sync = MetadataSync(status_dir, settings)
+
+        results = []
+        for sync_pass in xrange(args.passes):
+            chunk_latencies = []
+            start = time.time()
+            # Like the crawler, each chunk starts from the saved row, as the
+            # handler may not handle all of the rows it is passed. Each pass
+            # uses its own database ID to start over.
+            db_id = 'bench-db-%d' % sync_pass
+            last_row = sync.get_last_row(db_id)
+            while last_row < len(rows):
+                chunk = rows[last_row:last_row + args.chunk_size]
+                chunk_start = time.time()
+                sync.handle(chunk, swift)
+                sync.save_last_row(chunk[-1]['ROWID'], db_id)
+                chunk_latencies.append(time.time() - chunk_start)
+                last_row = sync.get_last_row(db_id)
+            elapsed = time.time() - start
+            results.append({
+                'pass': sync_pass + 1,
+                'rows': len(rows),
+                'seconds': elapsed,
+                'rows_per_second': len(rows) / elapsed if elapsed else 0,
+                'chunk_p50_ms': percentile(chunk_latencies, 0.5) * 1000,
+                'chunk_p99_ms': percentile(chunk_latencies, 0.99) * 1000,
+            })
+        return {
+            'passes': results,
+            'swift_heads': swift.requests,
+            'es_requests': es.requests,
+            'es_bytes_received': es.bytes_received,
+            # ru_maxrss is reported in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+    finally:
+        if sync:
+            sync._es_conn.transport.close()
+        es.stop()
+        checkpoint_store.flush_stores()
+        registry.clear()
+        shutil.rmtree(status_dir)
+
+
+def print_results(results):
+    print '%-6s %10s %10s %12s %14s %14s' % (
+        'pass', 'rows', 'seconds', 'rows/sec', 'chunk p50 ms', 'chunk p99 ms')
+    for result in results['passes']:
+        print '%-6d %10d %10.2f %12.1f %14.1f %14.1f' % (
+            result['pass'], result['rows'], result['seconds'],
+            result['rows_per_second'], result['chunk_p50_ms'],
+            result['chunk_p99_ms'])
+    print
+    print 'Swift HEADs:           %d' % results['swift_heads']
+    print 'Elasticsearch requests: %d (%d bytes)' % (
+        results['es_requests'], results['es_bytes_received'])
+    print 'Peak RSS:              %.1f MB' % results['peak_rss_mb']
+
+
+def main():
+    args = parse_args()
+    if args.green_io:
+        green.patch()
+    logging.getLogger('swift-metadata-sync').addHandler(logging.NullHandler())
+    logging.getLogger('elasticsearch').setLevel(logging.ERROR)
+    results = run(args)
+    if args.json:
+        print json.dumps(results, indent=2)
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
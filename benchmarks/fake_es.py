@@ -0,0 +1,122 @@
+"""In-process stand-in for the Elasticsearch APIs used by MetadataSync.
+
+Only implements enough of the info, mapping, mget, and bulk APIs to exercise
+the sync path. Documents are kept in memory and only their x-timestamp field is
+retained.
+"""
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # The client keeps several persistent connections open at a time.
+    daemon_threads = True
+
+
+class FakeElasticsearch(object):
+    VERSION = '5.6.0'
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.docs = {}
+        self.requests = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._server = _Server(
+            ('127.0.0.1', 0), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def mget(self, body):
+        docs = []
+        for doc_id in body['ids']:
+            timestamp = self.docs.get(doc_id)
+            if timestamp is None:
+                docs.append({'_id': doc_id, 'found': False})
+            else:
+                docs.append({'_id': doc_id, 'found': True,
+                             '_source': {'x-timestamp': timestamp}})
+        return {'docs': docs}
+
+    def bulk(self, body):
+        items = []
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line:
+                continue
+            action = json.loads(line)
+            op_type, meta = action.items()[0]
+            doc_id = meta['_id']
+            if op_type == 'delete':
+                if self.docs.pop(doc_id, None) is None:
+                    items.append({op_type: {
+                        '_id': doc_id, 'status': 404, 'result': 'not_found'}})
+                else:
+                    items.append({op_type: {
+                        '_id': doc_id, 'status': 200, 'result': 'deleted'}})
+                continue
+            source = json.loads(next(lines))
+            self.docs[doc_id] = source.get('x-timestamp', 0)
+            items.append({op_type: {
+                '_id': doc_id, 'status': 201, 'result': 'created'}})
+        return {'took': 1, 'errors': False, 'items': items}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body):
+                payload = json.dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(payload)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else ''
+                path = urlparse.urlparse(self.path).path
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake._lock:
+                    fake.requests += 1
+                    fake.bytes_received += len(body)
+                    if path == '/':
+                        return self._respond(200, {
+                            'version': {'number': fake.VERSION}})
+                    if path.endswith('/_mget'):
+                        return self._respond(200, fake.mget(json.loads(body)))
+                    if path.endswith('/_bulk'):
+                        return self._respond(200, fake.bulk(body))
+                    if '/_mapping/' in path:
+                        if self.command == 'PUT':
+                            return self._respond(200, {'acknowledged': True})
+                        return self._respond(200, {})
+                return self._respond(404, {'error': 'unsupported request'})
+
+            do_GET = do_POST = do_PUT = do_HEAD = _handle
+
+        return Handler
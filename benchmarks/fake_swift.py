@@ -0,0 +1,31 @@
+"""Stand-in for the Swift InternalClient used by MetadataSync."""
+import email.utils
+import eventlet
+
+
+class FakeInternalClient(object):
+    """Returns synthetic object metadata after an injectable latency.
+
+    The latency is simulated with eventlet.sleep(), so that concurrent
+    requests issued from green threads overlap, as they would with Swift.
+    """
+    def __init__(self, latency=0, metadata=None):
+        self.latency = latency
+        self.metadata = metadata or {}
+        self.requests = 0
+
+    def get_object_metadata(self, account, container, obj, headers=None):
+        self.requests += 1
+        if self.latency:
+            eventlet.sleep(self.latency)
+        timestamp = 1500000000.0 + self.requests
+        meta = {
+            'content-length': '1024',
+            'content-type': 'application/octet-stream',
+            'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+            'last-modified': email.utils.formatdate(timestamp, usegmt=True),
+            'x-timestamp': '%.5f' % timestamp,
+            'x-trans-id': 'tx0123456789abcdef01234-0059682f00',
+        }
+        meta.update(self.metadata)
+        return meta
@@ -2,10 +2,19 @@ import argparse
 import json
 import logging
 import os
+import signal
+import sys
 import traceback
 
 from container_crawler import ContainerCrawler
+from . import green, rate_limits
+from .checkpoint_store import flush_stores
+from .freshness_cache import flush_caches
 from .metadata_sync import MetadataSync
+from .reconcile import reconcile
+from .shadow_index import check_aliases
+from .stats import flush_sinks
+from .workers import Supervisor
 
 
 def setup_logger(console=False, log_file=None, level='INFO'):
@@ -43,9 +52,28 @@ def parse_args():
                         help='logging level; defaults to info')
     parser.add_argument('--console', action='store_true',
                         help='log messages to console')
+    parser.add_argument('--processes', metavar='N', type=int, default=1,
+                        help='number of worker processes to shard the '
+                             'container mappings across; defaults to 1')
+    parser.add_argument('--reconcile', action='store_true',
+                        help='compare the local container databases against '
+                             'the indices, repair the differences, and exit')
     return parser.parse_args()
 
 
+def handle_sigterm(signum, frame):
+    # Exit through SystemExit, so that the pending checkpoints are flushed.
+    sys.exit(0)
+
+
+def run_crawler(conf, once, logger):
+    crawler = ContainerCrawler(conf, MetadataSync, logger)
+    if once:
+        crawler.run_once()
+    else:
+        crawler.run_always()
+
+
 def main():
     args = parse_args()
     if not os.path.exists(args.config):
@@ -53,22 +81,41 @@ def main():
         exit(0)
 
     conf = load_config(args.config)
+    if conf.get('green_io', False):
+        green.patch()
+    rate_limits.configure(conf)
     setup_logger(console=args.console, level=args.log_level.upper(),
                  log_file=conf.get('log_file'))
 
     logger = logging.getLogger('swift-metadata-sync')
     logger.info('Starting Swift Metadata Sync')
+    signal.signal(signal.SIGTERM, handle_sigterm)
     try:
         conf['bulk_process'] = True
-        crawler = ContainerCrawler(conf, MetadataSync, logger)
-        if args.once:
-            crawler.run_once()
-        else:
-            crawler.run_always()
+        check_aliases(conf['containers'])
+        for mapping in conf['containers']:
+            # The lag of the mappings is measured against the local databases.
+            mapping.setdefault('devices', conf['devices'])
+        if args.reconcile:
+            if reconcile(conf):
+                exit(1)
+            return
+        if args.processes > 1:
+            supervisor = Supervisor(
+                conf, args.processes,
+                lambda shard_conf: run_crawler(shard_conf, args.once, logger),
+                once=args.once)
+            signal.signal(signal.SIGTERM, supervisor.stop)
+            exit(supervisor.run())
+        run_crawler(conf, args.once, logger)
     except Exception as e:
         logger.error("Metadata Sync failed: %s" % repr(e))
         logger.error(traceback.format_exc(e))
         exit(1)
+    finally:
+        flush_stores()
+        flush_caches()
+        flush_sinks()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,227 @@
+import collections
+import eventlet
+import elasticsearch
+import json
+
+from . import green, registry
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _compact_dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+class BatchSize(object):
+    """Number of documents per request that a cluster currently accepts."""
+    def __init__(self, docs):
+        self.docs = docs
+
+
+class AdaptiveBulk(object):
+    """Submits bulk requests, adapting their size to the cluster's load.
+
+    Requests are limited to max_docs documents and max_bytes bytes. When
+    Elasticsearch rejects documents with a 429 status (e.g. a full write
+    thread pool queue), the number of documents per request is halved and the
+    rejected documents are retried with an exponential backoff. Each request
+    that is fully accepted doubles the number of documents again, up to
+    max_docs. The number of documents is kept in batch_size, which may be
+    shared by the AdaptiveBulk objects of the same cluster (see
+    get_batch_size()).
+
+    Each action is serialized once, when it is added to a request, into the
+    newline-delimited JSON lines of the _bulk API, and retries reuse the
+    serialized lines. The serialized output is ASCII, which means that its
+    length is the size of the request body. With fast_json, the actions are
+    serialized with ujson, if it is installed.
+
+    Up to concurrency requests are kept in flight, each in its own green
+    thread. The requests do not block the other green threads, such as the
+    metadata fetches (see swift_metadata_sync.green.call()). If set, the
+    docs_bucket and bytes_bucket limit the rate of the documents and bytes
+    sent, including the retries.
+    """
+    REJECTED_STATUS = 429
+    INITIAL_BACKOFF = 1
+    MAX_BACKOFF = 60
+    # The keys of an action that are passed in the action line, along with the
+    # operation type.
+    ACTION_KEYS = ('_index', '_type', '_id', '_routing', '_version',
+                   '_version_type', 'pipeline')
+
+    def __init__(self, max_docs, max_bytes, max_retries, fast_json=False,
+                 concurrency=1, docs_bucket=None, bytes_bucket=None,
+                 batch_size=None):
+        if max_docs < 1:
+            raise ValueError('bulk_max_docs must be positive')
+        if max_bytes < 1:
+            raise ValueError('bulk_max_bytes must be positive')
+        if concurrency < 1:
+            raise ValueError('bulk_concurrency must be positive')
+        self.concurrency = concurrency
+        self.docs_bucket = docs_bucket
+        self.bytes_bucket = bytes_bucket
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.batch_size = batch_size or BatchSize(max_docs)
+        if fast_json and ujson:
+            self._dumps = ujson.dumps
+        else:
+            self._dumps = _compact_dumps
+        # Total size of the request bodies, including the retries.
+        self.bytes_sent = 0
+        # Total time spent waiting for the rate limits.
+        self.throttled_seconds = 0
+
+    @property
+    def docs(self):
+        return max(1, min(self.max_docs, self.batch_size.docs))
+
+    @docs.setter
+    def docs(self, docs):
+        self.batch_size.docs = docs
+
+    def streaming_bulk(self, client, actions):
+        """Submits the actions and yields (action, ok, item) for each one.
+
+        The ok and item values follow the format of
+        elasticsearch.helpers.streaming_bulk(). Rejected actions that are
+        retried are yielded after the rest of their request. The results are
+        yielded in the order of the batches, even if the requests are
+        concurrent.
+        """
+        if self.concurrency == 1:
+            for batch in self._iter_batches(actions):
+                for result in self._submit(client, batch):
+                    yield result
+            return
+
+        pool = eventlet.GreenPool(self.concurrency)
+        pending = collections.deque()
+        for batch in self._iter_batches(actions):
+            if len(pending) >= self.concurrency:
+                for result in pending.popleft().wait():
+                    yield result
+            pending.append(pool.spawn(
+                lambda batch: list(self._submit(client, batch)), batch))
+        while pending:
+            for result in pending.popleft().wait():
+                yield result
+
+    def _iter_batches(self, actions):
+        batch = []
+        batch_bytes = 0
+        for action in actions:
+            lines = self.serialize(action)
+            if batch and batch_bytes + len(lines) > self.max_bytes:
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append((action, lines))
+            batch_bytes += len(lines)
+            if len(batch) >= self.docs:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def serialize(self, action):
+        """Returns the bulk body lines for the action."""
+        op_type = action.get('_op_type', 'index')
+        meta = dict((key, action[key]) for key in self.ACTION_KEYS
+                    if key in action)
+        lines = self._dumps({op_type: meta}) + '\n'
+        if op_type == 'delete':
+            return lines
+        return lines + self._dumps(action['_source']) + '\n'
+
+    def _submit(self, client, batch):
+        attempt = 0
+        while batch:
+            rejected = []
+            rejected_count = 0
+            for request in self._split(batch):
+                results = self._send(client, request)
+                for (action, lines), (ok, item) in zip(request, results):
+                    if not ok and self._is_rejected(item):
+                        rejected_count += 1
+                        if attempt < self.max_retries:
+                            rejected.append((action, lines))
+                            continue
+                    yield action, ok, item
+            if not rejected_count:
+                self.docs = min(self.max_docs, self.docs * 2)
+                return
+            self.docs = max(1, self.docs // 2)
+            if not rejected:
+                return
+            eventlet.sleep(min(self.MAX_BACKOFF,
+                               self.INITIAL_BACKOFF * 2 ** attempt))
+            attempt += 1
+            batch = rejected
+
+    def _split(self, batch):
+        """Splits the batch into requests within the current limits."""
+        request = []
+        request_bytes = 0
+        for action, lines in batch:
+            if request and (len(request) >= self.docs or
+                            request_bytes + len(lines) > self.max_bytes):
+                yield request
+                request = []
+                request_bytes = 0
+            request.append((action, lines))
+            request_bytes += len(lines)
+        if request:
+            yield request
+
+    def _send(self, client, request):
+        """Returns the list of (ok, item) results for the request."""
+        body = ''.join(lines for _, lines in request)
+        if self.docs_bucket is not None:
+            self.throttled_seconds += self.docs_bucket.take(len(request))
+        if self.bytes_bucket is not None:
+            self.throttled_seconds += self.bytes_bucket.take(len(body))
+        self.bytes_sent += len(body)
+        try:
+            response = green.call(client.bulk, body=body)
+        except elasticsearch.TransportError as e:
+            # Mark every action as failed, as streaming_bulk() does.
+            return [(False, self._exception_item(action, e))
+                    for action, _ in request]
+        results = []
+        for item in response['items']:
+            info = item.values()[0]
+            results.append((200 <= info.get('status', 500) < 300, item))
+        return results
+
+    @classmethod
+    def _exception_item(cls, action, error):
+        op_type = action.get('_op_type', 'index')
+        info = {'error': str(error),
+                'status': error.status_code,
+                'exception': error}
+        info.update((key, action[key]) for key in cls.ACTION_KEYS
+                    if key in action)
+        if op_type != 'delete':
+            info['data'] = action['_source']
+        return {op_type: info}
+
+    @classmethod
+    def _is_rejected(cls, item):
+        return any(info.get('status') == cls.REJECTED_STATUS
+                   for info in item.values())
+
+
+def get_batch_size(key, max_docs):
+    """Returns the process-wide batch size for the given key (e.g. cluster).
+
+    An overloaded cluster is not sent full-sized requests again on every pass.
+    """
+    return registry.get('batch_size', key, lambda: BatchSize(max_docs))
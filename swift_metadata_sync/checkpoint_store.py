@@ -0,0 +1,181 @@
+import atexit
+import json
+import os
+import os.path
+import time
+
+from . import registry
+
+
+class CheckpointStore(object):
+    """Append-only log of the last processed row of each container database.
+
+    Every update appends a single record to the log, which is periodically
+    compacted by atomically replacing the file with one record per database.
+    Records are stored one per line as JSON lists of the database ID, the last
+    row, and the index, optionally followed by the chunk size chosen for the
+    database, e.g.:
+
+        ["db-id", 42, "index"]
+        ["db-id", 42, "index", 2000]
+
+    A record that was only partially written (e.g. if the process crashes) is
+    ignored when the log is read back. Status files in the older format (a
+    single JSON object mapping database IDs to the last row and index) are
+    converted when they are first loaded.
+
+    The entries are kept in memory after the first load. Updates are written
+    out (and fsync'ed) once flush_interval seconds have passed since the last
+    flush or once the updated databases have advanced by flush_rows rows,
+    whichever comes first. The default of 0 for both writes every update.
+    Losing the updates that were not flushed only means that the rows will be
+    processed again.
+    """
+    COMPACTION_FACTOR = 4
+    MIN_COMPACTION_RECORDS = 128
+
+    def __init__(self, path, flush_interval=0, flush_rows=0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._entries = None
+        self._records = 0
+        self._dirty = set()
+        self._pending_rows = 0
+        self._last_flush = time.time()
+
+    def get(self, db_id):
+        """Returns a dict with the last row and index or None.
+
+        The dict also has the chunk size, if one was saved.
+        """
+        self._load()
+        return self._entries.get(db_id)
+
+    def put(self, db_id, last_row, index, chunk_size=None):
+        self._load()
+        entry = self._entries.get(db_id)
+        if entry and entry['index'] == index:
+            if entry['last_row'] == last_row and \
+                    entry.get('chunk_size') == chunk_size:
+                return
+            self._pending_rows += max(0, last_row - entry['last_row'])
+        else:
+            self._pending_rows += last_row
+        self._entries[db_id] = self._make_entry(last_row, index, chunk_size)
+        self._dirty.add(db_id)
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        """Flushes the pending updates if the interval or rows are exceeded."""
+        if not self._dirty:
+            return
+        if self._pending_rows >= self.flush_rows or \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        if self._records + len(self._dirty) > max(
+                self.MIN_COMPACTION_RECORDS,
+                self.COMPACTION_FACTOR * len(self._entries)):
+            self.compact()
+            return
+        with open(self.path, 'a') as f:
+            for db_id in self._dirty:
+                f.write(self._format_record(db_id, self._entries[db_id]))
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += len(self._dirty)
+        self._flushed()
+
+    def compact(self):
+        """Atomically replaces the log with the current entries."""
+        self._load()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for db_id, entry in self._entries.items():
+                f.write(self._format_record(db_id, entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self._records = len(self._entries)
+        self._flushed()
+
+    def _flushed(self):
+        self._dirty.clear()
+        self._pending_rows = 0
+        self._last_flush = time.time()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        self._records = 0
+        if not os.path.exists(self.path):
+            return
+        legacy = False
+        # A partially written record must be removed, as it would otherwise be
+        # merged with the next appended record.
+        torn = False
+        with open(self.path) as f:
+            for line in f:
+                torn = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict):
+                    legacy = True
+                    self._load_legacy(record)
+                    continue
+                try:
+                    db_id, last_row, index = record[:3]
+                except (TypeError, ValueError):
+                    continue
+                self._entries[db_id] = self._make_entry(
+                    last_row, index, *record[3:4])
+                self._records += 1
+        if legacy or torn:
+            self.compact()
+
+    def _load_legacy(self, status):
+        for db_id, entry in status.items():
+            try:
+                self._entries[db_id] = dict(last_row=entry['last_row'],
+                                            index=entry['index'])
+            except (KeyError, TypeError):
+                continue
+
+    @staticmethod
+    def _make_entry(last_row, index, chunk_size=None):
+        entry = dict(last_row=last_row, index=index)
+        if chunk_size is not None:
+            entry['chunk_size'] = chunk_size
+        return entry
+
+    @staticmethod
+    def _format_record(db_id, entry):
+        record = [db_id, entry['last_row'], entry['index']]
+        if 'chunk_size' in entry:
+            record.append(entry['chunk_size'])
+        return json.dumps(record) + '\n'
+
+
+def get_store(path, flush_interval=0, flush_rows=0):
+    """Returns the process-wide checkpoint store for the given status file.
+
+    The status file may be shared by the containers of an account, in which
+    case all of their handlers must go through the same store.
+    """
+    return registry.get(
+        'checkpoint_store', path,
+        lambda: CheckpointStore(path, flush_interval, flush_rows))
+
+
+@atexit.register
+def flush_stores():
+    """Writes out the pending updates of all checkpoint stores."""
+    for store in registry.values('checkpoint_store'):
+        store.flush()
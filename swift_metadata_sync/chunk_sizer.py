@@ -0,0 +1,41 @@
+from . import registry
+
+
+class ChunkSizer(object):
+    """Adjusts the number of rows of a container handled at a time.
+
+    After each chunk, the size moves toward the number of rows that would have
+    taken target_seconds to handle or produced target_bytes of bulk requests,
+    whichever is smaller, at the rates measured on that chunk. Only half of
+    the difference is applied at a time, so that a single unusual chunk does
+    not swing the size. The size stays within min_rows and max_rows and is
+    None until the first chunk is measured.
+    """
+    def __init__(self, min_rows, max_rows, target_seconds, target_bytes):
+        if min_rows < 1:
+            raise ValueError('chunk_min_rows must be positive')
+        if max_rows < min_rows:
+            raise ValueError('chunk_max_rows must be at least chunk_min_rows')
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.size = None
+
+    def update(self, rows, seconds, bytes_sent):
+        if rows <= 0:
+            return
+        target = float(self.max_rows)
+        if self.target_seconds > 0 and seconds > 0:
+            target = min(target, rows * self.target_seconds / seconds)
+        if self.target_bytes > 0 and bytes_sent > 0:
+            target = min(target, rows * float(self.target_bytes) / bytes_sent)
+        if self.size is not None:
+            target = (self.size + target) / 2
+        self.size = int(min(self.max_rows, max(self.min_rows, target)))
+
+
+def get_sizer(key, min_rows, max_rows, target_seconds, target_bytes):
+    """Returns the process-wide chunk sizer for the given key."""
+    return registry.get('chunk_sizer', key, lambda: ChunkSizer(
+        min_rows, max_rows, target_seconds, target_bytes))
@@ -0,0 +1,59 @@
+import logging
+
+
+class _Payload(object):
+    """Defers formatting the payload until the record is emitted."""
+    __slots__ = ('value', 'max_length')
+
+    def __init__(self, value, max_length):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        formatted = repr(self.value)
+        if self.max_length and len(formatted) > self.max_length:
+            return '%s... (%d more characters)' % (
+                formatted[:self.max_length],
+                len(formatted) - self.max_length)
+        return formatted
+
+
+class DebugTrace(object):
+    """Debug log of the individual rows going through the sync path.
+
+    Each event is logged with the document ID, so that the rows of an object
+    can be followed through all of the phases. Only the fraction of the
+    documents given by sample_rate is traced; the sampling is based on the
+    document ID, which means that an object is either traced in every phase
+    and chunk or not at all. The payloads are formatted only when the record
+    is emitted and are truncated to max_length characters.
+
+    Callers should check the enabled property once per chunk, which is the
+    only cost of the trace when debug logging is off.
+    """
+    def __init__(self, logger, sample_rate=1.0, max_length=1024):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('trace_sample_rate must be between 0 and 1')
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+        # Document IDs are hex digests, the prefix of which is compared to
+        # the threshold.
+        self._threshold = int(sample_rate * 0x100000000)
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 and \
+            self.logger.isEnabledFor(logging.DEBUG)
+
+    def sampled(self, doc_id):
+        if self.sample_rate >= 1:
+            return True
+        return int(doc_id[:8], 16) < self._threshold
+
+    def trace(self, event, doc_id, payload):
+        """Logs the event, if the document is sampled."""
+        if not self.sampled(doc_id):
+            return
+        self.logger.debug('%s %s: %s', event, doc_id,
+                          _Payload(payload, self.max_length))
@@ -0,0 +1,89 @@
+import json
+import math
+import os
+import os.path
+import time
+
+from . import registry
+
+
+class DeleteFilter(object):
+    """Bloom filter of the IDs of the documents that may have been indexed.
+
+    The filter is sized for capacity IDs at the given false positive rate.
+    IDs that are not in the filter are known not to be indexed, which means
+    that their deletion can be skipped, but only once the filter is complete:
+    it must have been seeded with all of the indexed documents and then
+    updated with every undeleted row from the rows recorded in rows (per
+    container database) onward. False positives only mean that a deletion is
+    sent to Elasticsearch.
+
+    The document IDs are hex SHA-256 digests, whose prefixes are used as the
+    two hashes from which the bit positions are derived.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            self.size / float(max(capacity, 1)) * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.complete = False
+        self.rows = {}
+        self.saved_at = 0
+
+    def __contains__(self, doc_id):
+        bits = self._bits
+        for position in self._positions(doc_id):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, doc_id):
+        bits = self._bits
+        for position in self._positions(doc_id):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def _positions(self, doc_id):
+        first = int(doc_id[:16], 16)
+        second = int(doc_id[16:32], 16) | 1
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.size
+
+    def load(self, path, index):
+        """Loads the filter persisted for the index at the given path.
+
+        Missing or malformed files, or files for a different index or size,
+        are ignored.
+        """
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                bits = f.read()
+        except (IOError, ValueError):
+            return
+        if not isinstance(header, dict) or header.get('index') != index or \
+                header.get('size') != self.size or \
+                header.get('hashes') != self.hashes or \
+                len(bits) != len(self._bits):
+            return
+        self._bits = bytearray(bits)
+        self.complete = header.get('complete', False)
+        self.rows = header.get('rows', {})
+
+    def save(self, path, index):
+        """Atomically persists the filter at the given path."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'index': index,
+                                'size': self.size,
+                                'hashes': self.hashes,
+                                'complete': self.complete,
+                                'rows': self.rows}) + '\n')
+            f.write(self._bits)
+        os.rename(tmp_path, path)
+        self.saved_at = time.time()
+
+
+def get_filter(key, capacity):
+    """Returns the process-wide filter for the given key."""
+    return registry.get('delete_filter', key, lambda: DeleteFilter(capacity))
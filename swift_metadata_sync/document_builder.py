@@ -0,0 +1,110 @@
+import calendar
+import email.utils
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class DocumentBuilder(object):
+    """Creates the Elasticsearch documents from the object metadata.
+
+    The field that each header maps to is resolved once and cached, as the
+    same headers appear on most objects. User metadata headers map to their
+    key, without the prefix, and take precedence over the other fields. The
+    mapped headers are copied as-is, unless the field is already set.
+    Headers that do not map to a field are ignored.
+
+    If parse_json is set, the user metadata values are parsed as JSON and are
+    indexed as strings if that fails. With fast_json, the values are parsed
+    with ujson, if it is installed.
+    """
+    MONTHS = dict((month, i + 1) for i, month in enumerate(
+        ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+         'Nov', 'Dec']))
+    MAX_CACHED_HEADERS = 10000
+
+    def __init__(self, mapped_fields, user_meta_prefix, parse_json=False,
+                 fast_json=False):
+        self.mapped_fields = frozenset(mapped_fields)
+        self.user_meta_prefix = user_meta_prefix
+        self.parse_json = parse_json
+        if fast_json and ujson:
+            self._json_loads = ujson.loads
+        else:
+            self._json_loads = json.loads
+        # Maps the header names to a tuple of whether the header is user
+        # metadata and the field name, or None if the header is ignored.
+        self._fields = {}
+
+    def build(self, meta, account, container, key):
+        es_doc = {
+            # ElasticSearch only supports millisecond resolution
+            'x-timestamp': int(float(meta['x-timestamp']) * 1000),
+            # Convert Last-Modified header into a millis since epoch date
+            'last-modified': self.parse_http_date(meta['last-modified']) *
+            1000,
+            'x-swift-object': key,
+            'x-swift-account': account,
+            'x-swift-container': container,
+        }
+        fields = self._fields
+        mapped = []
+        for header, value in meta.iteritems():
+            try:
+                field = fields[header]
+            except KeyError:
+                field = self._resolve(header)
+            if field is None:
+                continue
+            is_user_meta, name = field
+            if is_user_meta:
+                es_doc[name] = self._parse_value(value)
+            else:
+                mapped.append((name, value))
+        for name, value in mapped:
+            if name not in es_doc:
+                es_doc[name] = value
+        return es_doc
+
+    def _resolve(self, header):
+        if header.startswith(self.user_meta_prefix):
+            field = (True, header[len(self.user_meta_prefix):].decode('utf-8'))
+        elif header in self.mapped_fields:
+            field = (False, header)
+        else:
+            field = None
+        # Guard against unbounded growth if the headers are all different.
+        if len(self._fields) < self.MAX_CACHED_HEADERS:
+            self._fields[header] = field
+        return field
+
+    def _parse_value(self, value):
+        if self.parse_json:
+            try:
+                # Both decoders expect UTF-8 encoded strings.
+                return self._json_loads(value)
+            except ValueError:
+                pass
+        return value.decode('utf-8')
+
+    @classmethod
+    def parse_http_date(cls, value):
+        """Returns the seconds since the epoch for an HTTP date.
+
+        Swift always formats the dates as in "Wed, 06 Jun 2018 22:24:19 GMT",
+        which is converted directly. Other formats are handled by
+        email.utils.
+        """
+        parts = value.split()
+        if len(parts) == 6 and parts[5] == 'GMT':
+            try:
+                hours, minutes, seconds = parts[4].split(':')
+                return calendar.timegm((
+                    int(parts[3]), cls.MONTHS[parts[2]], int(parts[1]),
+                    int(hours), int(minutes), int(seconds)))
+            except (KeyError, ValueError):
+                pass
+        return email.utils.mktime_tz(email.utils.parsedate_tz(value))
@@ -0,0 +1,38 @@
+from distutils.version import StrictVersion
+import elasticsearch
+
+from . import registry
+
+
+class ClusterClient(object):
+    """Elasticsearch client shared by all of the mappings for a cluster.
+
+    Along with the connection pool, caches the server version and the indices
+    whose mappings have been verified, so that they are only queried once per
+    process.
+    """
+    def __init__(self, hosts, maxsize):
+        self.conn = elasticsearch.Elasticsearch(hosts, maxsize=maxsize)
+        self.verified_indices = set()
+        self._server_version = None
+
+    @property
+    def server_version(self):
+        if self._server_version is None:
+            self._server_version = StrictVersion(
+                self.conn.info()['version']['number'])
+        return self._server_version
+
+
+def hosts_key(hosts):
+    if isinstance(hosts, basestring):
+        return hosts
+    return tuple(sorted(
+        tuple(sorted(host.items())) if isinstance(host, dict) else host
+        for host in hosts))
+
+
+def get_client(hosts, maxsize):
+    """Returns the process-wide client for the hosts and pool size."""
+    return registry.get('es_client', (hosts_key(hosts), maxsize),
+                        lambda: ClusterClient(hosts, maxsize))
@@ -0,0 +1,119 @@
+import atexit
+import collections
+import json
+import os
+import os.path
+import time
+
+from . import registry
+
+
+class FreshnessCache(object):
+    """Bounded LRU map of document IDs to the last indexed x-timestamp.
+
+    The timestamps are in milliseconds, as stored in Elasticsearch. The cache
+    is only used to avoid querying Elasticsearch for rows that are known to
+    have been indexed already: a miss simply means that Elasticsearch has to
+    be consulted.
+
+    When persisted with maybe_save(), the entries are written out at most
+    once per interval and the remaining updates are written out at exit.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self.path = None
+        self.index = None
+        self.saved_at = 0
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._entries
+
+    def get(self, doc_id):
+        try:
+            timestamp = self._entries.pop(doc_id)
+        except KeyError:
+            return None
+        self._entries[doc_id] = timestamp
+        return timestamp
+
+    def is_fresh(self, doc_id, timestamp):
+        cached = self.get(doc_id)
+        return cached is not None and timestamp <= cached
+
+    def update(self, doc_id, timestamp):
+        if self.max_size <= 0:
+            return
+        cached = self._entries.pop(doc_id, None)
+        if cached is not None and cached > timestamp:
+            timestamp = cached
+        self._entries[doc_id] = timestamp
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def discard(self, doc_id):
+        if self._entries.pop(doc_id, None) is not None:
+            self._dirty = True
+
+    def clear(self):
+        self._entries.clear()
+        self._dirty = True
+
+    def load(self, path, index):
+        """Loads the entries persisted for the index at the given path.
+
+        Missing, malformed, or files for a different index are ignored.
+        """
+        try:
+            with open(path) as f:
+                status = json.load(f)
+        except (IOError, ValueError):
+            return
+        if not isinstance(status, dict) or status.get('index') != index:
+            return
+        # The entries are persisted from the least to the most recently used.
+        for doc_id, timestamp in status.get('entries', []):
+            self.update(doc_id, timestamp)
+        self._dirty = False
+
+    def save(self, path, index):
+        """Atomically persists the cache entries at the given path."""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'index': index, 'entries': self._entries.items()}, f)
+        os.rename(tmp_path, path)
+        self.saved_at = time.time()
+        self._dirty = False
+
+    def maybe_save(self, path, index, interval):
+        """Persists the entries if interval seconds passed since the last save.
+
+        The path and index are kept, so that flush_caches() can write out the
+        updates made since then.
+        """
+        self.path = path
+        self.index = index
+        if self._dirty and time.time() - self.saved_at >= interval:
+            self.save(path, index)
+
+
+def get_cache(key, max_size):
+    """Returns the process-wide cache for the given key.
+
+    MetadataSync objects for the same container and index share the cache.
+    """
+    return registry.get('freshness_cache', key,
+                        lambda: FreshnessCache(max_size))
+
+
+@atexit.register
+def flush_caches():
+    """Writes out the pending updates of the persisted caches."""
+    for cache in registry.values('freshness_cache'):
+        if cache.path is not None and cache._dirty:
+            cache.save(cache.path, cache.index)
@@ -0,0 +1,31 @@
+import eventlet
+from eventlet import tpool
+
+_patched = False
+
+
+def patch():
+    """Makes the blocking network calls and sleeps cooperative.
+
+    The Swift requests are already made with eventlet, but the Elasticsearch
+    client uses the standard library sockets, which block the whole process
+    while a request is outstanding. Once patched, the requests of all of the
+    green threads (e.g. the concurrent bulk requests and metadata fetches)
+    overlap. Must be called before any Elasticsearch client is created.
+    """
+    global _patched
+    eventlet.monkey_patch(socket=True, select=True, time=True)
+    _patched = True
+
+
+def call(func, *args, **kwargs):
+    """Calls the function without blocking the other green threads.
+
+    Once the sockets are patched, the function is called directly. Otherwise,
+    it is run in a native thread of the eventlet thread pool (whose size is
+    set by the EVENTLET_THREADPOOL_SIZE environment variable), so that a
+    blocking request does not hold up the rest of the process.
+    """
+    if _patched:
+        return func(*args, **kwargs)
+    return tpool.execute(func, *args, **kwargs)
@@ -1,15 +1,50 @@
+import collections
 from distutils.version import StrictVersion
 import elasticsearch
-import elasticsearch.helpers
-import email.utils
+import eventlet
+import eventlet.queue
 import hashlib
+import itertools
 import json
 import logging
+import math
 import os
 import os.path
+import time
 
-from swift.common.utils import decode_timestamps
+from swift.common.internal_client import UnexpectedResponse
+from swift.common.utils import decode_timestamps, extract_swift_bytes
 from container_crawler.base_sync import BaseSync
+from . import bulk
+from . import checkpoint_store
+from . import chunk_sizer
+from . import debug_trace
+from . import delete_filter
+from . import document_builder
+from . import es_clients
+from . import freshness_cache
+from . import rate_limits
+from . import replicas
+from . import scheduler
+from . import shadow_index
+from . import stats
+
+
+class MetadataFetchError(Exception):
+    """The metadata of an object could not be retrieved from Swift."""
+    def __init__(self, message, cause):
+        super(MetadataFetchError, self).__init__(message)
+        self.cause = cause
+
+
+class DocumentError(Exception):
+    """Elasticsearch failed to look up or write the document of a row.
+
+    The status is the HTTP status of the bulk item, if there is one.
+    """
+    def __init__(self, message, status=None):
+        super(DocumentError, self).__init__(message)
+        self.status = status
 
 
 class MetadataSync(BaseSync):
@@ -28,101 +63,617 @@ class MetadataSync(BaseSync):
         "x-trans-id": {"type": "string", "index": "not_analyzed"}
     }
     USER_META_PREFIX = 'x-object-meta-'
+    DEFAULT_FETCH_CONCURRENCY = 10
+    PENDING_OPS_FACTOR = 2
+    DEFAULT_FRESHNESS_CACHE_SIZE = 10000
+    DEFAULT_CHECKPOINT_INTERVAL = 5
+    DEFAULT_CHECKPOINT_ROWS = 10000
+    DEFAULT_ES_POOL_SIZE = 10
+    DEFAULT_BULK_MAX_DOCS = 500
+    DEFAULT_BULK_MAX_BYTES = 10 * 2**20
+    DEFAULT_BULK_MAX_RETRIES = 5
+    DEFAULT_BULK_CONCURRENCY = 1
+    DEFAULT_FAILURE_RETRIES = 2
+    DEFAULT_TRACE_SAMPLE_RATE = 1.0
+    DEFAULT_TRACE_MAX_LENGTH = 1024
+    DEFAULT_SWIFT_DIR = '/etc/swift'
+    DEFAULT_VERIFICATION_LAG = 300
+    DEFAULT_MAX_DEFERRED_ROWS = 100000
+    DEFAULT_VERIFY_BATCH_SIZE = 1000
+    # Searches cannot return more hits than index.max_result_window allows.
+    MAX_VERIFY_BATCH_SIZE = 10000
+    DEFAULT_SHADOW_ROWS_PER_SECOND = 1000
+    DEFAULT_DELETE_FILTER_CAPACITY = 1000000
+    DEFAULT_DELETE_FILTER_SAVE_INTERVAL = 60
+    VERSION_CONFLICT_STATUS = 409
+    DEFAULT_PRIORITY = 1
+    DEFAULT_MAX_ROWS_PER_CYCLE = 0
+    DEFAULT_CHUNK_MIN_ROWS = 100
+    DEFAULT_CHUNK_MAX_ROWS = 10000
+    DEFAULT_CHUNK_TARGET_SECONDS = 5
+    DEFAULT_CHUNK_TARGET_BYTES = 10 * 2**20
 
     def __init__(self, status_dir, settings, per_account=False):
         super(MetadataSync, self).__init__(status_dir, settings, per_account)
 
         self.logger = logging.getLogger('swift-metadata-sync')
-        es_hosts = settings['es_hosts']
-        self._es_conn = elasticsearch.Elasticsearch(es_hosts)
-        self._server_version = StrictVersion(
-            self._es_conn.info()['version']['number'])
+        self._trace = debug_trace.DebugTrace(
+            self.logger,
+            float(settings.get('trace_sample_rate',
+                               self.DEFAULT_TRACE_SAMPLE_RATE)),
+            int(settings.get('trace_max_length',
+                             self.DEFAULT_TRACE_MAX_LENGTH)))
+        self._es_client = es_clients.get_client(
+            settings['es_hosts'],
+            int(settings.get('es_pool_size', self.DEFAULT_ES_POOL_SIZE)))
+        self._es_conn = self._es_client.conn
+        self._server_version = self._es_client.server_version
         self._index = settings['index']
         self._parse_json = settings.get('parse_json', False)
+        fast_json = settings.get('fast_json', False)
+        self._doc_builder = document_builder.DocumentBuilder(
+            self.DOC_MAPPING.keys(), self.USER_META_PREFIX, self._parse_json,
+            fast_json)
         self._pipeline = settings.get('pipeline')
-        self._verify_mapping()
+        self._versioned_writes = settings.get('versioned_writes', False)
+        self._row_only = settings.get('row_only', False)
+        self._index_counts = collections.Counter()
+        self._stats = stats.Stats(
+            stats.get_sinks(settings, self._status_dir),
+            self._account, self._container, self._index)
+        self._failure_retries = int(settings.get(
+            'failure_retries', self.DEFAULT_FAILURE_RETRIES))
+        self._dead_letter = settings.get('dead_letter', False)
+        self._skip_missing_objects = settings.get(
+            'skip_missing_objects', False)
+        self._dead_letter_file = os.path.join(
+            self._status_account_dir,
+            u'%s.%s.failed' % (self._account, self._container))
+        self._fetch_concurrency = int(settings.get(
+            'metadata_fetch_concurrency', self.DEFAULT_FETCH_CONCURRENCY))
+        if self._fetch_concurrency < 1:
+            raise ValueError('metadata_fetch_concurrency must be positive')
+        hosts = es_clients.hosts_key(settings['es_hosts'])
+        self._rate_limits = [
+            (name, rate_limits.get_bucket(name, key, self._status_dir))
+            for name, key in [
+                ('swift_heads_per_second', None),
+                ('es_docs_per_second', hosts),
+                ('es_bytes_per_second', hosts)]]
+        self._head_bucket = self._rate_limits[0][1]
+        max_docs = int(settings.get('bulk_max_docs',
+                                    self.DEFAULT_BULK_MAX_DOCS))
+        self._bulk = bulk.AdaptiveBulk(
+            max_docs,
+            int(settings.get('bulk_max_bytes', self.DEFAULT_BULK_MAX_BYTES)),
+            int(settings.get('bulk_max_retries',
+                             self.DEFAULT_BULK_MAX_RETRIES)),
+            fast_json,
+            int(settings.get('bulk_concurrency',
+                             self.DEFAULT_BULK_CONCURRENCY)),
+            self._rate_limits[1][1], self._rate_limits[2][1],
+            # The size reduced by the rejections of an overloaded cluster
+            # carries over to the next passes and the other mappings.
+            bulk.get_batch_size(hosts, max_docs))
+        self._freshness_cache = freshness_cache.get_cache(
+            (self._account, self._container, self._index),
+            int(settings.get('freshness_cache_size',
+                             self.DEFAULT_FRESHNESS_CACHE_SIZE)))
+        self._persist_freshness_cache = settings.get(
+            'persist_freshness_cache', False)
+        self._freshness_cache_file = os.path.join(
+            self._status_account_dir,
+            u'%s.%s.freshness' % (self._account, self._container))
+        if settings.get('shadow_of'):
+            # The shadow index is synced alongside the live index of the
+            # container, which uses the file above.
+            self._freshness_cache_file = os.path.join(
+                self._status_account_dir, u'%s.%s.%s.freshness' % (
+                    self._account, self._container, self._index))
+        if self._persist_freshness_cache and not len(self._freshness_cache):
+            self._freshness_cache.load(self._freshness_cache_file,
+                                       self._index)
+        self._swift_dir = settings.get('swift_dir', self.DEFAULT_SWIFT_DIR)
+        self._replica_partition = None
+        if settings.get('replica_partitioning', False):
+            self._replica_partition = replicas.get_partition(
+                self._swift_dir,
+                self._account, self._container,
+                settings.get('container_port'))
+        self._verification_lag = float(settings.get(
+            'verification_lag', self.DEFAULT_VERIFICATION_LAG))
+        self._deferred_rows = replicas.get_deferred_rows(
+            (self._account, self._container, self._index))
+        self._max_deferred_rows = int(settings.get(
+            'max_deferred_rows', self.DEFAULT_MAX_DEFERRED_ROWS))
+        self._verify_batch_size = int(settings.get(
+            'verify_batch_size', self.DEFAULT_VERIFY_BATCH_SIZE))
+        if not 0 < self._verify_batch_size <= self.MAX_VERIFY_BATCH_SIZE:
+            raise ValueError('verify_batch_size must be between 1 and %d' %
+                             self.MAX_VERIFY_BATCH_SIZE)
+        self._shadow = None
+        if settings.get('alias') and per_account:
+            # The alias would be moved once any of the containers catches up.
+            raise ValueError('alias requires a mapping of a single container')
+        if settings.get('shadow_of'):
+            self._shadow = shadow_index.ShadowIndex(
+                self._es_conn, self._index, settings['shadow_of'],
+                settings.get('alias'),
+                os.path.join(self._status_account_dir, u'%s.%s.%s.shadow' % (
+                    self._account, self._container, self._index)),
+                float(settings.get('shadow_rows_per_second',
+                                   self.DEFAULT_SHADOW_ROWS_PER_SECOND)))
+        self._reindex = settings.get('reindex', False)
+        # Whether the reindexing task of the shadow index is still running.
+        self._seeding = False
+        self._delete_filter = None
+        if settings.get('delete_filter', False):
+            if self._server_version >= StrictVersion('5.0'):
+                self._delete_filter = delete_filter.get_filter(
+                    (self._account, self._container, self._index),
+                    int(settings.get('delete_filter_capacity',
+                                     self.DEFAULT_DELETE_FILTER_CAPACITY)))
+            else:
+                self.logger.warning(
+                    'The delete filter requires Elasticsearch 5.0 or later')
+        self._delete_filter_file = os.path.join(
+            self._status_account_dir, u'%s.%s.%s.deletes' % (
+                self._account, self._container, self._index))
+        self._delete_filter_save_interval = float(settings.get(
+            'delete_filter_save_interval',
+            self.DEFAULT_DELETE_FILTER_SAVE_INTERVAL))
+        self._devices = settings.get('devices')
+        self._broker = None
+        self._priority = float(settings.get('priority',
+                                            self.DEFAULT_PRIORITY))
+        if self._priority <= 0:
+            raise ValueError('priority must be positive')
+        self._max_rows_per_cycle = int(settings.get(
+            'max_rows_per_cycle', self.DEFAULT_MAX_ROWS_PER_CYCLE))
+        self._scheduler = scheduler.get_scheduler()
+        self._chunk_sizer = None
+        if settings.get('adaptive_chunks', False):
+            self._chunk_sizer = chunk_sizer.get_sizer(
+                (self._account, self._container, self._index),
+                int(settings.get('chunk_min_rows',
+                                 self.DEFAULT_CHUNK_MIN_ROWS)),
+                int(settings.get('chunk_max_rows',
+                                 self.DEFAULT_CHUNK_MAX_ROWS)),
+                float(settings.get('chunk_target_seconds',
+                                   self.DEFAULT_CHUNK_TARGET_SECONDS)),
+                int(settings.get('chunk_target_bytes',
+                                 self.DEFAULT_CHUNK_TARGET_BYTES)))
+        # The last row handled in this pass, if it is not the last of the rows
+        # passed in by the crawler.
+        self._handled_row = None
+        self._checkpoints = checkpoint_store.get_store(
+            self._status_file,
+            float(settings.get('checkpoint_interval',
+                               self.DEFAULT_CHECKPOINT_INTERVAL)),
+            int(settings.get('checkpoint_rows',
+                             self.DEFAULT_CHECKPOINT_ROWS)))
+        if self._index not in self._es_client.verified_indices:
+            self._verify_mapping()
+            self._es_client.verified_indices.add(self._index)
 
     def get_last_row(self, db_id):
-        if not os.path.exists(self._status_file):
+        # Write out any progress that has been pending for too long.
+        self._checkpoints.maybe_flush()
+        self._seeding = False
+        row_id = self._get_last_row(db_id)
+        if self._seeding:
+            # The delete filter is seeded once the index is complete.
+            return row_id
+        if self._chunk_sizer is not None and self._chunk_sizer.size is None:
+            # Start from the size that was chosen before the restart.
+            entry = self._checkpoints.get(self._checkpoint_key(db_id))
+            if entry and entry['index'] == self._index:
+                self._chunk_sizer.size = entry.get('chunk_size')
+        if self._delete_filter is None:
+            return row_id
+        if not self._delete_filter.complete:
+            self._delete_filter.load(self._delete_filter_file, self._index)
+        if not self._delete_filter.complete:
+            self._seed_delete_filter(db_id, row_id)
+        # The rows past the position of the filter would not be added to it.
+        return min(row_id, self._delete_filter.rows.get(db_id, 0))
+
+    def _get_last_row(self, db_id):
+        entry = self._checkpoints.get(self._checkpoint_key(db_id))
+        if self._shadow is None and (
+                not entry or entry['index'] != self._index):
+            # Continue from the shadow index's cursor once it has replaced
+            # the previous index of the mapping.
+            entry = self._checkpoints.get(self._shadow_key(db_id))
+        if not entry or entry['index'] != self._index:
+            if self._shadow is not None and self._reindex:
+                return self._seed_shadow(db_id)
             return 0
-        with open(self._status_file) as f:
-            try:
-                status = json.load(f)
-                entry = status.get(db_id, None)
-                if not entry:
-                    return 0
-                if entry['index'] == self._index:
-                    return entry['last_row']
-                else:
-                    return 0
-            except ValueError:
-                return 0
-        return 0
+        # The saved row may be held back by the rows waiting to be verified.
+        return max(entry['last_row'],
+                   self._deferred_rows.progress.get(db_id, 0))
 
     def save_last_row(self, row_id, db_id):
+        if self._seeding:
+            return
         if not os.path.exists(self._status_account_dir):
             os.mkdir(self._status_account_dir)
-        if not os.path.exists(self._status_file):
-            with open(self._status_file, 'w') as f:
-                json.dump({db_id: dict(last_row=row_id,
-                                       index=self._index)}, f)
-                return
+        if self._persist_freshness_cache:
+            # The cache is written out with the checkpoints rather than
+            # after every chunk.
+            self._freshness_cache.maybe_save(
+                self._freshness_cache_file, self._index,
+                self._checkpoints.flush_interval)
+        if self._handled_row is not None:
+            row_id = self._handled_row
+        self._deferred_rows.progress[db_id] = row_id
+        if self._delete_filter is not None and self._delete_filter.complete:
+            self._delete_filter.rows[db_id] = row_id
+            if time.time() - self._delete_filter.saved_at >= \
+                    self._delete_filter_save_interval:
+                self._save_delete_filter()
+        # Restart from the oldest row that has not been verified, as the rows
+        # waiting for verification are not persisted.
+        oldest_row_id = self._deferred_rows.oldest_row_id()
+        if oldest_row_id is not None:
+            row_id = min(row_id, oldest_row_id - 1)
+        self._checkpoints.put(
+            self._checkpoint_key(db_id), row_id, self._index,
+            self._chunk_sizer.size if self._chunk_sizer is not None else None)
+        if self._shadow is not None and not self._shadow.promoted:
+            live_entry = self._checkpoints.get(db_id)
+            if live_entry and live_entry['index'] == self._shadow.live_index \
+                    and row_id >= live_entry['last_row']:
+                self._shadow.promote()
 
-        with open(self._status_file, 'r+') as f:
-            try:
-                status = json.load(f)
-            except ValueError:
-                status = {}
-            status[db_id] = dict(last_row=row_id, index=self._index)
-            f.seek(0)
-            json.dump(status, f)
-            f.truncate()
-            return
+    def _seed_delete_filter(self, db_id, row_id):
+        """Adds all of the container's indexed documents to the filter.
+
+        The documents of the rows up to row_id are either indexed or deleted
+        by now, which means that the filter is complete from that row onward.
+        """
+        self.logger.info('Seeding the delete filter of %s/%s' % (
+            self._account, self._container))
+        for name, _ in self.iter_indexed_objects(self._verify_batch_size):
+            self._delete_filter.add(self._get_document_id({'name': name}))
+        self._delete_filter.complete = True
+        self._delete_filter.rows = {db_id: row_id}
+        self._save_delete_filter()
+
+    def _save_delete_filter(self):
+        if not os.path.exists(self._status_account_dir):
+            os.mkdir(self._status_account_dir)
+        self._delete_filter.save(self._delete_filter_file, self._index)
+
+    def _checkpoint_key(self, db_id):
+        if self._shadow is None:
+            return db_id
+        return self._shadow_key(db_id)
+
+    def _shadow_key(self, db_id):
+        # The shadow index has its own cursor in the same status file.
+        return u'%s/%s' % (db_id, self._index)
+
+    def _seed_shadow(self, db_id):
+        """Seeds the shadow index from the live index.
+
+        Returns the row that the live index had reached when the documents
+        were copied, from which the shadow index is then synced. While the
+        documents are being copied, the rows are neither handled nor saved
+        until the next pass.
+        """
+        live_entry = self._checkpoints.get(db_id)
+        live_row = 0
+        if live_entry and live_entry['index'] == self._shadow.live_index:
+            live_row = live_entry['last_row']
+        row_id = self._shadow.reindex(self._container_query(), live_row)
+        if row_id is None:
+            self._seeding = True
+            return live_row
+        self._checkpoints.put(self._shadow_key(db_id), row_id, self._index)
+        return row_id
 
     def handle(self, rows, internal_client):
-        self.logger.debug("Handling rows: %s" % repr(rows))
+        self.logger.debug("Handling %d rows", len(rows))
         if not rows:
             return []
+        if self._seeding:
+            self.logger.debug("Waiting for %s to be reindexed", self._index)
+            return []
+        start = time.time()
+        self._handled_row = None
+        rows = self._schedule(self._resize_chunk(rows))
+        row_count = len(rows)
+        bytes_sent = self._bulk.bytes_sent
+        if self._replica_partition is None:
+            self._handle(rows, internal_client)
+        else:
+            due_rows, rows, verify_ids = self._partition_rows(rows)
+            self._handle(due_rows + rows, internal_client, verify_ids)
+            # The rows that were verified are only removed once they have
+            # been processed, so that they are retried otherwise.
+            self._deferred_rows.remove(len(due_rows))
+        elapsed = time.time() - start
+        if self._chunk_sizer is not None:
+            self._chunk_sizer.update(row_count, elapsed,
+                                     self._bulk.bytes_sent - bytes_sent)
+        if self._shadow is not None:
+            self._shadow.throttle(row_count, elapsed)
+
+    def _resize_chunk(self, rows):
+        """Returns the rows of a chunk of the size chosen for the container.
+
+        The rows are either truncated or extended with the next rows of the
+        container database, if it is on this node. save_last_row() then saves
+        the last handled row rather than the crawler's.
+        """
+        if self._chunk_sizer is None or self._chunk_sizer.size is None or \
+                rows[-1].get('ROWID') is None:
+            return rows
+        size = self._chunk_sizer.size
+        if size < len(rows):
+            self._handled_row = rows[size - 1]['ROWID']
+            return rows[:size]
+        broker = self._get_broker()
+        if size > len(rows) and broker is not None:
+            rows = rows + broker.get_items_since(rows[-1]['ROWID'],
+                                                 size - len(rows))
+            self._handled_row = rows[-1]['ROWID']
+        return rows
+
+    def _schedule(self, rows):
+        """Returns the rows to handle in this pass of the crawler.
+
+        The rows past the limit set by the scheduler are handled in the next
+        pass, as save_last_row() does not go past the last handled row.
+        """
+        if rows[-1].get('ROWID') is None or (
+                self._max_rows_per_cycle <= 0 and not self._stats.enabled):
+            return rows
+        lag_rows, lag_seconds = self._get_lag(rows)
+        self._stats.gauge('lag_rows', lag_rows)
+        self._stats.gauge('lag_seconds', lag_seconds)
+        limit = self._scheduler.limit(
+            (self._account, self._container, self._index), lag_rows,
+            self._priority, self._max_rows_per_cycle)
+        if limit is None or limit >= len(rows):
+            return rows
+        self._stats.incr('postponed_rows', len(rows) - limit)
+        self._handled_row = rows[limit - 1]['ROWID']
+        return rows[:limit]
+
+    def _get_lag(self, rows):
+        """Returns how far behind the container database the mapping is.
+
+        The lag is the number of rows from the first of the rows to the end of
+        the database, and the age of the first row in seconds. Without the
+        database (e.g. if devices is not set), the rows are assumed to be the
+        last rows of the database.
+        """
+        max_row = rows[-1]['ROWID']
+        broker = self._get_broker()
+        if broker is not None:
+            max_row = max(max_row, broker.get_max_row())
+        age = time.time() - self._get_row_timestamp(rows[0]) / 1000.0
+        return max_row - rows[0]['ROWID'] + 1, max(0, age)
+
+    def _get_broker(self):
+        """Returns the broker of the container database or None.
+
+        The database is only available if devices is set and it is on this
+        node.
+        """
+        if self._broker is None and self._devices:
+            self._broker = replicas.find_broker(
+                self._devices, self._swift_dir, self._account,
+                self._container)
+        return self._broker
+
+    def _partition_rows(self, rows):
+        """Splits the rows between this replica and the other replicas.
+
+        Returns the deferred rows of the other replicas that are due to be
+        verified, the rows to process now, and the set of document IDs that
+        are only verified. The rows of this replica are processed right away.
+        The rows of the other replicas are only verified once the
+        verification lag has passed since they were first seen (or since
+        their timestamp, if it is in the future), by which time their replica
+        should have indexed them, and are deferred until then. Old rows are
+        deferred as well, as the other replicas may be just as far behind
+        (e.g. during a backfill). Once max_deferred_rows are deferred, the
+        rest of the chunk is left for a later pass.
+        """
+        now = time.time()
+        due_rows = self._deferred_rows.due(now)
+        verify_ids = set(self._get_document_id(row) for row in due_rows)
+        current_rows = []
+        deferred = 0
+        # The due rows are removed once they have been processed.
+        max_deferred = self._max_deferred_rows + len(due_rows)
+        for i, row in enumerate(rows):
+            doc_id = self._get_document_id(row)
+            if self._replica_partition.is_primary(doc_id):
+                current_rows.append(row)
+                continue
+            due = max(self._get_row_timestamp(row) / 1000.0, now) + \
+                self._verification_lag
+            if due > now and row.get('ROWID') is not None and \
+                    len(self._deferred_rows) >= max_deferred:
+                self._stats.incr('postponed_rows', len(rows) - i)
+                self._handled_row = row['ROWID'] - 1
+                break
+            if due <= now:
+                current_rows.append(row)
+                verify_ids.add(doc_id)
+                continue
+            self._deferred_rows.add(doc_id, row, due)
+            deferred += 1
+        self._stats.incr('deferred_rows', deferred)
+        return due_rows, current_rows, verify_ids
+
+    def _handle(self, rows, internal_client, verify_ids=frozenset()):
+        self._index_counts.clear()
+        self._stats.incr('rows', len(rows))
+        for name, bucket in self._rate_limits:
+            self._stats.gauge(name, bucket.rate)
+        with self._stats.timer('handle'):
+            failures, errors = self._handle_rows(
+                rows, internal_client, verify_ids)
+            for _ in range(self._failure_retries):
+                if not failures:
+                    break
+                self.logger.debug("Retrying %d failed rows", len(failures))
+                self._stats.incr('retried_rows', len(failures))
+                failures, retry_errors = self._handle_rows(
+                    [row for row, _ in failures.values()], internal_client)
+                errors += retry_errors
+        self._stats.incr('failures', len(failures) + len(errors))
+        self._stats.flush()
+        self.logger.debug(
+            "Created %d documents from container rows and %d documents from "
+            "object metadata", self._index_counts['row'],
+            self._index_counts['head'])
+
+        if self._dead_letter and failures and \
+                self._can_park(rows, failures, errors):
+            self._park_rows(failures)
+            self._stats.incr('parked_rows', len(failures))
+            return
+        self._check_errors(
+            errors + [error for _, error in failures.values()])
+
+    def _can_park(self, rows, failures, errors):
+        """Returns whether the failed rows may be skipped.
+
+        Only the rows that failed on their own are parked: objects that are
+        gone from Swift and documents that Elasticsearch rejected with a
+        client error (e.g. a mapping error). If every row of the chunk failed,
+        or if any of the errors is not specific to its row (e.g. Elasticsearch
+        or Swift could not be contacted, or a shard is unavailable), the chunk
+        has to be processed again, as skipping it would advance past rows that
+        were never indexed.
+        """
+        if errors:
+            return False
+        if len(failures) >= len(set(
+                self._get_document_id(row) for row in rows)):
+            return False
+        return all(self._is_row_error(error)
+                   for _, error in failures.values())
+
+    def _is_row_error(self, error):
+        if isinstance(error, MetadataFetchError):
+            return self._is_missing_object(error.cause)
+        # Rejections (429) are caused by the load of the cluster.
+        return isinstance(error, DocumentError) and \
+            error.status is not None and 400 <= error.status < 500 and \
+            error.status != bulk.AdaptiveBulk.REJECTED_STATUS
+
+    @staticmethod
+    def _is_missing_object(error):
+        return isinstance(error, UnexpectedResponse) and \
+            error.resp.status_int == 404
+
+    def _handle_rows(self, rows, internal_client, verify_ids=frozenset()):
+        """Deletes or indexes the documents for the rows.
+
+        The documents in verify_ids are expected to have been indexed already
+        and are looked up with a cheaper search (see _get_indexed_timestamps).
+        Returns an ordered dictionary of the rows that failed, mapping the
+        document ID to the row and the error, and a list of errors that could
+        not be attributed to a row.
+        """
+        failures = collections.OrderedDict()
         errors = []
 
-        bulk_delete_ops = []
+        delete_map = collections.OrderedDict()
         mget_map = {}
+        skipped_deletes = 0
+        members = self._delete_filter
+        filtering = members is not None and members.complete
+        tracing = self._trace.enabled
         for row in rows:
+            doc_id = self._get_document_id(row)
+            if tracing:
+                self._trace.trace('Row', doc_id, row)
+            # A later row for the same object (e.g. after a deferred row of
+            # another replica) supersedes the earlier ones.
+            delete_map.pop(doc_id, None)
+            mget_map.pop(doc_id, None)
             if row['deleted']:
-                bulk_delete_ops.append({'_op_type': 'delete',
-                                        '_id': self._get_document_id(row),
-                                        '_index': self._index,
-                                        '_type': self.DOC_TYPE})
+                self._freshness_cache.discard(doc_id)
+                # Documents that were never indexed do not need to be deleted.
+                if filtering and doc_id not in members:
+                    skipped_deletes += 1
+                    continue
+                delete_map[doc_id] = row
                 continue
-            mget_map[self._get_document_id(row)] = row
-
-        if bulk_delete_ops:
-            errors = self._bulk_delete(bulk_delete_ops)
-        if not mget_map:
-            self._check_errors(errors)
-            return
+            if members is not None:
+                members.add(doc_id)
+            mget_map[doc_id] = row
 
-        self.logger.debug("multiple get map: %s" % repr(mget_map))
-        stale_rows, mget_errors = self._get_stale_rows(mget_map)
-        errors += mget_errors
-        update_ops = [self._create_index_op(doc_id, row, internal_client)
-                      for doc_id, row in stale_rows]
-        _, update_failures = elasticsearch.helpers.bulk(
-            self._es_conn,
-            update_ops,
-            raise_on_error=False,
-            raise_on_exception=False
-        )
-        self.logger.debug("Index operations: %s" % repr(update_ops))
-
-        for op in update_failures:
-            op_info = op['index']
-            if 'exception' in op_info:
-                errors.append(op_info['exception'])
-            else:
-                errors.append("%s: %s" % (
-                    op_info['_id'], self._extract_error(op_info)))
-        self._check_errors(errors)
+        bulk_delete_ops = [self._make_delete_op(delete_id, row)
+                           for delete_id, row in delete_map.items()]
+        self._stats.incr('deletes', len(bulk_delete_ops))
+        self._stats.incr('skipped_deletes', skipped_deletes)
+        stale_rows = []
+        if mget_map:
+            self.logger.debug("Looking up %d documents", len(mget_map))
+            with self._stats.timer('mget'):
+                stale_rows, mget_failures = self._get_stale_rows(
+                    mget_map, verify_ids)
+            self._stats.incr('stale_rows', len(stale_rows))
+            for doc_id, error in mget_failures:
+                if doc_id in mget_map:
+                    failures[doc_id] = (mget_map[doc_id], error)
+                else:
+                    errors.append(error)
+        if not bulk_delete_ops and not stale_rows:
+            return failures, errors
+        stale_map = dict(stale_rows)
+        fetch_failures = []
+        index_ops = self._iter_index_ops(
+            stale_rows, internal_client, fetch_failures)
+        # The deletions are submitted along with the index operations, which
+        # are submitted as soon as the object metadata is retrieved. This
+        # allows us to overlap the Swift requests with indexing in
+        # Elasticsearch. The index timer therefore includes the deletions and
+        # the time spent waiting for the object metadata.
+        bytes_sent = self._bulk.bytes_sent
+        throttled_seconds = self._bulk.throttled_seconds
+        with self._stats.timer('index'):
+            for action, ok, item in self._bulk.streaming_bulk(
+                    self._es_conn,
+                    itertools.chain(bulk_delete_ops, index_ops)):
+                doc_id = action['_id']
+                if action['_op_type'] == 'delete':
+                    error = self._get_delete_error(action, ok, item)
+                    if error is not None:
+                        failures[doc_id] = (delete_map[doc_id], error)
+                    continue
+                op_info = item['index']
+                if ok or self._is_version_conflict(op_info):
+                    # A version conflict means that the document is already
+                    # at least as recent as the row.
+                    self._freshness_cache.update(
+                        doc_id, self._get_row_timestamp(stale_map[doc_id]))
+                    self._stats.incr('indexed' if ok else 'version_conflicts')
+                    continue
+                if 'exception' in op_info:
+                    failures[doc_id] = (stale_map[doc_id],
+                                        op_info['exception'])
+                else:
+                    failures[doc_id] = (stale_map[doc_id], DocumentError(
+                        "%s: %s" % (op_info['_id'],
+                                    self._extract_error(op_info)),
+                        op_info.get('status')))
+        self._stats.incr('index_bytes', self._bulk.bytes_sent - bytes_sent)
+        if self._bulk.throttled_seconds > throttled_seconds:
+            self._stats.timing(
+                'bulk_wait', self._bulk.throttled_seconds - throttled_seconds)
+        for doc_id, error in fetch_failures:
+            failures[doc_id] = (stale_map[doc_id], error)
+        return failures, errors
 
     def _check_errors(self, errors):
         if not errors:
@@ -132,72 +683,316 @@ class MetadataSync(BaseSync):
             self.logger.error(str(error))
         raise RuntimeError('Failed to process some entries')
 
-    def _bulk_delete(self, ops):
-        errors = []
-        success_count, delete_failures = elasticsearch.helpers.bulk(
-            self._es_conn, ops,
-            raise_on_error=False,
-            raise_on_exception=False
-        )
-
-        for op in delete_failures:
-            op_info = op['delete']
-            if op_info['status'] == 404:
-                if op_info.get('result') == 'not_found':
-                    continue
-                # < 5.x Elasticsearch versions do not return "result"
-                if op_info.get('found') is False:
-                    continue
-            if 'exception' in op_info:
-                errors.append(op_info['exception'])
-            else:
-                errors.append("%s: %s" % (op_info['_id'],
-                                          self._extract_error(op_info)))
-        return errors
+    def _park_rows(self, failures):
+        """Records the rows that could not be processed in the status directory.
 
-    def _get_stale_rows(self, mget_map):
-        errors = []
+        The rows are appended to the dead letter file as JSON records, so that
+        they can be inspected and replayed, and the failures are logged.
+        """
+        if not os.path.exists(self._status_account_dir):
+            os.mkdir(self._status_account_dir)
+        now = time.time()
+        with open(self._dead_letter_file, 'a') as f:
+            for doc_id, (row, error) in failures.items():
+                self.logger.error(str(error))
+                f.write(json.dumps({
+                    'timestamp': now,
+                    'index': self._index,
+                    'doc_id': doc_id,
+                    'row': dict(row, name=row['name'].decode('utf-8')),
+                    'error': str(error)}) + '\n')
+        self.logger.error(
+            "Recorded %d failed rows in %s" % (
+                len(failures), self._dead_letter_file))
+
+    def _get_delete_error(self, action, ok, item):
+        """Returns the error of a delete operation or None if it succeeded.
+
+        Documents that are already gone count as deleted.
+        """
+        if ok:
+            return None
+        op_info = item['delete']
+        if self._is_version_conflict(op_info):
+            # The document was re-created after the deletion.
+            self._stats.incr('version_conflicts')
+            return None
+        if op_info['status'] == 404:
+            if op_info.get('result') == 'not_found':
+                return None
+            # < 5.x Elasticsearch versions do not return "result"
+            if op_info.get('found') is False:
+                return None
+        if 'exception' in op_info:
+            return op_info['exception']
+        return DocumentError("%s: %s" % (
+            op_info['_id'], self._extract_error(op_info)), op_info['status'])
+
+    def _is_version_conflict(self, op_info):
+        return self._versioned_writes and \
+            op_info.get('status') == self.VERSION_CONFLICT_STATUS
+
+    def _get_stale_rows(self, mget_map, verify_ids=frozenset()):
+        failures = []
         stale_rows = []
-        results = self._es_conn.mget(body={'ids': mget_map.keys()},
+        # Rows that we know to have been indexed do not need to be looked up.
+        query_map = dict(
+            [(doc_id, row) for doc_id, row in mget_map.items()
+             if not self._freshness_cache.is_fresh(
+                 doc_id, self._get_row_timestamp(row))])
+        self._stats.incr('cache_hits', len(mget_map) - len(query_map))
+        if verify_ids:
+            verify_map = dict((doc_id, query_map.pop(doc_id))
+                              for doc_id in verify_ids
+                              if doc_id in query_map)
+            if verify_map:
+                with self._stats.timer('verify'):
+                    stale_rows.extend(self._verify_rows(verify_map))
+        if not query_map:
+            return stale_rows, failures
+        if self._versioned_writes:
+            # Elasticsearch rejects the writes of older rows, which means
+            # that the documents do not have to be looked up.
+            stale_rows.extend(query_map.items())
+            return stale_rows, failures
+        # GET requests are real-time in Elasticsearch, which means that the
+        # index does not have to be refreshed.
+        results = self._es_conn.mget(body={'ids': query_map.keys()},
                                      index=self._index,
-                                     refresh=True,
                                      _source=['x-timestamp'])
         docs = results['docs']
+        tracing = self._trace.enabled
         for doc in docs:
-            row = mget_map.get(doc['_id'])
+            row = query_map.get(doc['_id'])
             if not row:
-                errors.append("Unknown row for ID %s" % doc['_id'])
+                failures.append((doc['_id'], DocumentError(
+                    "Unknown row for ID %s" % doc['_id'])))
                 continue
             if 'error' in doc:
-                errors.append("Failed to query %s: %s" % (
-                              doc['_id'], str(doc['error'])))
+                failures.append((doc['_id'], DocumentError(
+                    "Failed to query %s: %s" % (
+                        doc['_id'], str(doc['error'])))))
+                continue
+            if tracing:
+                self._trace.trace('Indexed document', doc['_id'], doc)
+            if not doc['found']:
+                self._stats.incr('mget_misses')
+                stale_rows.append((doc['_id'], row))
                 continue
-            object_date = self._get_last_modified_date(row)
-            # ElasticSearch only supports milliseconds
-            object_ts = int(float(object_date) * 1000)
-            if not doc['found'] or object_ts > doc['_source'].get(
-                    'x-timestamp', 0):
+            self._stats.incr('mget_hits')
+            object_ts = self._get_row_timestamp(row)
+            if object_ts > doc['_source'].get('x-timestamp', 0):
                 stale_rows.append((doc['_id'], row))
                 continue
-        self.logger.debug("Stale rows: %s" % repr(stale_rows))
-        return stale_rows, errors
+            self._freshness_cache.update(doc['_id'],
+                                         doc['_source']['x-timestamp'])
+        self.logger.debug("Found %d stale rows", len(stale_rows))
+        return stale_rows, failures
+
+    def _verify_rows(self, verify_map):
+        """Returns the (doc_id, row) tuples of the rows that are not indexed.
+
+        Only the rows whose documents are missing or older than the row are
+        returned, so that they can be indexed.
+        """
+        stale_rows = []
+        doc_ids = verify_map.keys()
+        for i in range(0, len(doc_ids), self._verify_batch_size):
+            batch = doc_ids[i:i + self._verify_batch_size]
+            timestamps = self._get_indexed_timestamps(batch)
+            for doc_id in batch:
+                row = verify_map[doc_id]
+                indexed_ts = timestamps.get(doc_id)
+                if indexed_ts is None or \
+                        self._get_row_timestamp(row) > indexed_ts:
+                    self._stats.incr('verify_misses')
+                    stale_rows.append((doc_id, row))
+                    continue
+                self._stats.incr('verify_hits')
+                self._freshness_cache.update(doc_id, indexed_ts)
+        return stale_rows
+
+    def _get_indexed_timestamps(self, doc_ids):
+        """Returns a dictionary of the indexed documents' timestamps.
+
+        Rather than fetching the documents, the timestamps are read from the
+        doc values of a search on the document IDs, which avoids loading and
+        parsing the stored source. Unlike GET requests, searches are not
+        real-time, which means that documents indexed since the last refresh
+        are reported as missing (and are indexed again) rather than forcing
+        a refresh.
+        """
+        if self._server_version >= StrictVersion('5.0'):
+            fields_key = 'docvalue_fields'
+        else:
+            fields_key = 'fielddata_fields'
+        results = self._es_conn.search(
+            index=self._index,
+            doc_type=self.DOC_TYPE,
+            body={'query': {'terms': {'_id': doc_ids}},
+                  '_source': False,
+                  fields_key: ['x-timestamp'],
+                  'size': len(doc_ids)})
+        timestamps = {}
+        for hit in results['hits']['hits']:
+            values = hit.get('fields', {}).get('x-timestamp')
+            if values:
+                timestamps[hit['_id']] = int(values[0])
+        return timestamps
+
+    def iter_indexed_objects(self, batch_size):
+        """Yields the (name, timestamp) of the container's indexed objects.
+
+        The objects are sorted by name, which is UTF-8 encoded, in the same
+        order as the container database listing. The index is paged through
+        with search_after on the keyword sub-field of the object name, which
+        only exists in the mappings created for Elasticsearch 5.x or later.
+        """
+        if self._server_version < StrictVersion('5.0'):
+            raise RuntimeError(
+                'Listing the indexed objects requires Elasticsearch 5.0 or '
+                'later')
+        body = {'query': self._container_query(),
+                'sort': [{'x-swift-object.keyword': 'asc'}],
+                '_source': False,
+                'docvalue_fields': ['x-timestamp'],
+                'size': batch_size}
+        while True:
+            hits = self._es_conn.search(
+                index=self._index, doc_type=self.DOC_TYPE,
+                body=body)['hits']['hits']
+            for hit in hits:
+                name = hit['sort'][0]
+                timestamp = hit.get('fields', {}).get('x-timestamp', [0])[0]
+                yield name.encode('utf-8'), int(timestamp)
+            if len(hits) < batch_size:
+                return
+            body['search_after'] = hits[-1]['sort']
+
+    def _container_query(self):
+        """Returns the query for the documents of the container."""
+        return {'bool': {'filter': [
+            {'term': {'x-swift-account.keyword': self._account}},
+            {'term': {'x-swift-container.keyword': self._container}}]}}
+
+    def _iter_index_ops(self, stale_rows, internal_client, failures):
+        """Generates the index operations for the stale rows.
+
+        The object metadata is retrieved concurrently by a separate green
+        thread, which keeps fetching while the bulk requests are outstanding.
+        At most PENDING_OPS_FACTOR * metadata_fetch_concurrency operations,
+        or as many as the bulk requests in flight may hold, are queued at any
+        given time. The operations are generated in the same order as the
+        rows. Rows whose metadata could not be retrieved are
+        skipped and the document ID and error are appended to the failures
+        list, unless the object no longer exists and skip_missing_objects is
+        set.
+
+        In the row-only mode, the documents are created from the container
+        rows and no requests are made to Swift.
+        """
+        tracing = self._trace.enabled
+        if self._row_only:
+            for doc_id, row in stale_rows:
+                self._index_counts['row'] += 1
+                op = self._create_row_index_op(doc_id, row)
+                if tracing:
+                    self._trace.trace('Index operation', doc_id, op)
+                yield op
+            return
+
+        def _fetch(doc_id, row):
+            try:
+                return self._create_index_op(doc_id, row, internal_client)
+            except Exception as e:
+                return e
+
+        pool = eventlet.GreenPool(self._fetch_concurrency)
+        pending = eventlet.queue.Queue(max(
+            self._fetch_concurrency * self.PENDING_OPS_FACTOR,
+            self._bulk.max_docs * self._bulk.concurrency))
+
+        def _spawn_fetches():
+            for doc_id, row in stale_rows:
+                pending.put((doc_id, row, pool.spawn(_fetch, doc_id, row)))
+            pending.put(None)
+
+        producer = eventlet.spawn(_spawn_fetches)
+        try:
+            while True:
+                fetch = pending.get()
+                if fetch is None:
+                    return
+                doc_id, row, fetch_thread = fetch
+                result = fetch_thread.wait()
+                if self._skip_missing_objects and \
+                        self._is_missing_object(result):
+                    # The row of the deletion removes the document.
+                    self.logger.debug('Skipping deleted object %s (%s)' % (
+                        row['name'], doc_id))
+                    continue
+                if isinstance(result, Exception):
+                    self._stats.incr('head_failures')
+                    failures.append((doc_id, MetadataFetchError(
+                        "Failed to retrieve metadata for %s (%s): %s" % (
+                            row['name'], doc_id, repr(result)), result)))
+                    continue
+                if tracing:
+                    self._trace.trace('Index operation', doc_id, result)
+                self._index_counts['head'] += 1
+                yield result
+        finally:
+            # The bulk requests may stop early (e.g. on an error).
+            producer.kill()
 
     def _create_index_op(self, doc_id, row, internal_client):
         swift_hdrs = {'X-Newest': True}
-        meta = internal_client.get_object_metadata(
-            self._account, self._container, row['name'], headers=swift_hdrs)
+        waited = self._head_bucket.take(1)
+        if waited:
+            self._stats.timing('head_wait', waited)
+        self._stats.incr('heads')
+        with self._stats.timer('head'):
+            meta = internal_client.get_object_metadata(
+                self._account, self._container, row['name'],
+                headers=swift_hdrs)
+        return self._make_index_op(
+            doc_id, row, self._doc_builder.build(meta, self._account,
+                                                 self._container,
+                                                 row['name'].decode('utf-8')))
+
+    def _create_row_index_op(self, doc_id, row):
+        return self._make_index_op(
+            doc_id, row, self._create_row_es_doc(
+                row, self._account, self._container,
+                row['name'].decode('utf-8')))
+
+    def _make_index_op(self, doc_id, row, es_doc):
         op = {'_op_type': 'index',
               '_index': self._index,
               '_type': self.DOC_TYPE,
-              '_source': self._create_es_doc(meta, self._account,
-                                             self._container,
-                                             row['name'].decode('utf-8'),
-                                             self._parse_json),
+              '_source': es_doc,
               '_id': doc_id}
         if self._pipeline:
             op['pipeline'] = self._pipeline
+        if self._versioned_writes:
+            self._set_version(op, row)
         return op
 
+    def _make_delete_op(self, doc_id, row):
+        op = {'_op_type': 'delete',
+              '_id': doc_id,
+              '_index': self._index,
+              '_type': self.DOC_TYPE}
+        if self._versioned_writes:
+            self._set_version(op, row)
+        return op
+
+    def _set_version(self, op, row):
+        # The row timestamp (in milliseconds) is the external version of the
+        # document, so that Elasticsearch rejects the writes of older rows.
+        op['_version'] = self._get_row_timestamp(row)
+        op['_version_type'] = 'external'
+
     """
         Verify document mapping for the elastic search index. Does not include
         any user-defined fields.
@@ -237,36 +1032,28 @@ class MetadataSync(BaseSync):
                                      body={'properties': new_mapping})
 
     @staticmethod
-    def _create_es_doc(meta, account, container, key, parse_json=False):
-        def _parse_document(value):
-            try:
-                return json.loads(value.decode('utf-8'))
-            except ValueError:
-                return value.decode('utf-8')
-
-        es_doc = {}
-        # ElasticSearch only supports millisecond resolution
-        es_doc['x-timestamp'] = int(float(meta['x-timestamp']) * 1000)
-        # Convert Last-Modified header into a millis since epoch date
-        ts = email.utils.mktime_tz(
-            email.utils.parsedate_tz(meta['last-modified'])) * 1000
-        es_doc['last-modified'] = ts
-        es_doc['x-swift-object'] = key
-        es_doc['x-swift-account'] = account
-        es_doc['x-swift-container'] = container
-
-        user_meta_keys = dict(
-            [(k.split(MetadataSync.USER_META_PREFIX, 1)[1].decode('utf-8'),
-              _parse_document(v) if parse_json else v.decode('utf-8'))
-             for k, v in meta.items()
-             if k.startswith(MetadataSync.USER_META_PREFIX)])
-        es_doc.update(user_meta_keys)
-        for field in MetadataSync.DOC_MAPPING.keys():
-            if field in es_doc:
-                continue
-            if field not in meta:
-                continue
-            es_doc[field] = meta[field]
+    def _create_row_es_doc(row, account, container, key):
+        """Creates the document from the container database row alone.
+
+        User metadata, as well as the large object and transaction ID headers,
+        is not available in the row and is not included in the document.
+        """
+        object_date = float(MetadataSync._get_last_modified_date(row))
+        content_type, _ = extract_swift_bytes(row['content_type'])
+        es_doc = {
+            # ElasticSearch only supports millisecond resolution
+            'x-timestamp': int(object_date * 1000),
+            # Swift rounds the Last-Modified header up to the next second
+            'last-modified': int(math.ceil(object_date)) * 1000,
+            'x-swift-object': key,
+            'x-swift-account': account,
+            'x-swift-container': container,
+            'content-length': row['size'],
+            'content-type': content_type.decode('utf-8'),
+            # The container database may include additional parameters with
+            # the ETag (e.g. for SLOs).
+            'etag': row['etag'].split(';', 1)[0].strip(),
+        }
         return es_doc
 
     @staticmethod
@@ -276,6 +1063,11 @@ class MetadataSync(BaseSync):
         # when content type is updated
         return meta
 
+    @staticmethod
+    def _get_row_timestamp(row):
+        # ElasticSearch only supports milliseconds
+        return int(float(MetadataSync._get_last_modified_date(row)) * 1000)
+
     @staticmethod
     def _extract_error(err_info):
         if 'error' not in err_info or 'root_cause' not in err_info['error']:
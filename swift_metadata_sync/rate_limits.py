@@ -0,0 +1,101 @@
+import eventlet
+import json
+import os.path
+import time
+
+from . import registry
+
+
+class TokenBucket(object):
+    """Limits the rate at which tokens (e.g. requests or bytes) are taken.
+
+    Up to a second's worth of tokens accumulates while the bucket is idle.
+    Taking more tokens than are available puts the bucket in debt and the
+    caller sleeps until the debt would be paid off, which means that the
+    callers in other green threads wait for their turn as well. The rate may
+    be changed at any time. A rate of 0 disables the limit.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.time()
+
+    def take(self, tokens):
+        """Takes the tokens and returns the number of seconds slept."""
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        self._tokens = min(
+            self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= tokens
+        if self._tokens >= 0:
+            return 0
+        delay = -self._tokens / float(self.rate)
+        eventlet.sleep(delay)
+        return delay
+
+
+RATE_LIMITS_FILE = 'rate_limits.json'
+LIMITS = ('swift_heads_per_second', 'es_docs_per_second',
+          'es_bytes_per_second')
+
+
+def configure(conf):
+    """Sets the limits of the process from the top-level configuration."""
+    limits = registry.get('rate_limits', None, dict)
+    for name in LIMITS:
+        limits[name] = float(conf.get(name) or 0)
+
+
+def get_limits(status_dir):
+    """Returns the limits of the process.
+
+    The configured limits are overridden by the ones in the rate limits file
+    of the status directory.
+    """
+    configured = registry.get('rate_limits', None, dict)
+    limits = dict((name, configured.get(name, 0)) for name in LIMITS)
+    overrides = get_overrides(os.path.join(status_dir, RATE_LIMITS_FILE))
+    for name in LIMITS:
+        if name in overrides:
+            limits[name] = float(overrides[name] or 0)
+    return limits
+
+
+def get_bucket(name, key, status_dir):
+    """Returns the process-wide bucket of the limit for the key (e.g. cluster).
+
+    The rate is the limit of the process (see get_limits()) rather than a
+    setting of the mapping, and follows the changes to the rate limits file.
+    """
+    rate = get_limits(status_dir)[name]
+    bucket = registry.get('rate_limit', (name, key), lambda: TokenBucket(rate))
+    bucket.rate = rate
+    return bucket
+
+
+def get_overrides(path):
+    """Returns the limits set in the file at the given path.
+
+    The file is a JSON object of the limits that override the configured
+    ones. It is only read again once it is modified, which allows the
+    limits to be changed without restarting. A missing or malformed file does
+    not override any limits.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    cached = registry.get('rate_limit_overrides', path, dict)
+    if cached.get('mtime') == mtime:
+        return cached['limits']
+    try:
+        with open(path) as f:
+            limits = json.load(f)
+    except (IOError, ValueError):
+        limits = {}
+    if not isinstance(limits, dict):
+        limits = {}
+    cached.update(mtime=mtime, limits=limits)
+    return limits
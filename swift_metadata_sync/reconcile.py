@@ -0,0 +1,135 @@
+import collections
+import logging
+import time
+
+from swift.common.internal_client import InternalClient
+
+from . import replicas
+from .metadata_sync import MetadataSync
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_INTERNAL_CLIENT_PATH = '/etc/swift/internal-client.conf'
+
+
+def iter_container_rows(broker, batch_size):
+    """Yields the rows of the objects in the container, sorted by name."""
+    marker = ''
+    while True:
+        rows = broker.get_objects(limit=batch_size, marker=marker,
+                                  include_deleted=False)
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        marker = rows[-1]['name']
+
+
+def diff(rows, indexed_objects, start_time):
+    """Yields the (reason, row) of the rows that need to be handled.
+
+    Both the rows and the (name, timestamp) of the indexed objects must be
+    sorted by name. They are merged to find the rows that are missing from
+    the index or are newer than their documents, and the documents without a
+    row, which are yielded as deleted rows. Documents whose timestamps are
+    after start_time (in milliseconds) are not orphaned, as their rows may
+    have been added after the listing went past them.
+    """
+    indexed_objects = iter(indexed_objects)
+    indexed = next(indexed_objects, None)
+    for row in rows:
+        while indexed is not None and indexed[0] < row['name']:
+            if indexed[1] < start_time:
+                yield 'orphaned', _deleted_row(*indexed)
+            indexed = next(indexed_objects, None)
+        if indexed is None or indexed[0] != row['name']:
+            yield 'missing', row
+            continue
+        if MetadataSync._get_row_timestamp(row) > indexed[1]:
+            yield 'stale', row
+        indexed = next(indexed_objects, None)
+    while indexed is not None:
+        if indexed[1] < start_time:
+            yield 'orphaned', _deleted_row(*indexed)
+        indexed = next(indexed_objects, None)
+
+
+def _deleted_row(name, timestamp):
+    # The deletion is 1ms newer than the document, as versioned_writes uses
+    # the row timestamp as the external version, which has to be greater
+    # than the version of the document for Elasticsearch to delete it.
+    return {'name': name,
+            'deleted': 1,
+            'created_at': '%.5f' % ((timestamp + 1) / 1000.0)}
+
+
+def reconcile_mapping(sync, broker, internal_client, batch_size):
+    """Repairs the index of a container mapping from the container database.
+
+    Only the rows found by diff() are handled, in chunks of batch_size rows,
+    which means that the objects that are indexed correctly do not require
+    any Swift requests. Returns a Counter of the rows handled by reason.
+    """
+    start_time = int(time.time() * 1000)
+    counts = collections.Counter()
+    chunk = []
+    for reason, row in diff(iter_container_rows(broker, batch_size),
+                            sync.iter_indexed_objects(batch_size),
+                            start_time):
+        counts[reason] += 1
+        chunk.append(row)
+        if len(chunk) >= batch_size:
+            sync.handle(chunk, internal_client)
+            chunk = []
+    if chunk:
+        sync.handle(chunk, internal_client)
+    return counts
+
+
+def reconcile(conf):
+    """Reconciles all of the container mappings whose databases are local.
+
+    A mapping that fails to be reconciled does not stop the others. Returns
+    the number of mappings that failed.
+    """
+    logger = logging.getLogger('swift-metadata-sync')
+    internal_client = InternalClient(
+        conf.get('internal_client_path', DEFAULT_INTERNAL_CLIENT_PATH),
+        'Swift Metadata Sync', 3)
+    batch_size = int(conf.get('items_chunk', DEFAULT_BATCH_SIZE))
+    failed = 0
+    for mapping in conf['containers']:
+        broker = replicas.find_broker(
+            conf['devices'],
+            mapping.get('swift_dir', MetadataSync.DEFAULT_SWIFT_DIR),
+            mapping['account'], mapping['container'])
+        if broker is None:
+            logger.info('No database for %s/%s on this node' % (
+                mapping['account'], mapping['container']))
+            continue
+        # Every row is compared against the index, regardless of the replica
+        # that indexes it, and without being limited by the scheduler. The
+        # freshness cache is not used either, as the rows that diff() reports
+        # are the ones whose documents the cache may wrongly consider fresh.
+        # The documents of objects deleted since the listing are removed
+        # when the rows of the deletions are handled.
+        try:
+            sync = MetadataSync(conf['status_dir'],
+                                dict(mapping, replica_partitioning=False,
+                                     max_rows_per_cycle=0,
+                                     freshness_cache_size=0,
+                                     persist_freshness_cache=False,
+                                     skip_missing_objects=True))
+            counts = reconcile_mapping(sync, broker, internal_client,
+                                       batch_size)
+        except Exception:
+            logger.exception('Failed to reconcile %s/%s' % (
+                mapping['account'], mapping['container']))
+            failed += 1
+            continue
+        logger.info(
+            'Reconciled %s/%s: %d missing, %d stale, and %d orphaned '
+            'documents' % (mapping['account'], mapping['container'],
+                           counts['missing'], counts['stale'],
+                           counts['orphaned']))
+    return failed
@@ -0,0 +1,39 @@
+"""Process-wide objects shared by the handlers of the mappings.
+
+The crawler re-creates the MetadataSync objects on every pass, so the state
+that has to carry over between passes (e.g. clients, caches, batch sizes and
+checkpoints) is kept here instead, keyed by its kind and by what it is shared
+by (e.g. the container or the cluster). An object is created by the first
+handler that asks for it: the settings of the handlers that ask for it later
+do not change it.
+"""
+
+_objects = {}
+
+
+def get(kind, key, factory):
+    """Returns the object of the given kind for the key.
+
+    The object is created by calling factory() if there is none yet.
+    """
+    obj = _objects.get((kind, key))
+    if obj is None:
+        obj = factory()
+        _objects[(kind, key)] = obj
+    return obj
+
+
+def values(kind):
+    """Returns the objects of the given kind."""
+    return [obj for (obj_kind, _), obj in _objects.items()
+            if obj_kind == kind]
+
+
+def clear(kind=None):
+    """Forgets the objects of the given kind, or all of them."""
+    if kind is None:
+        _objects.clear()
+        return
+    for obj_kind, key in _objects.keys():
+        if obj_kind == kind:
+            del _objects[(obj_kind, key)]
@@ -0,0 +1,123 @@
+import collections
+import os
+import os.path
+
+from swift.common.ring import Ring
+from swift.common.ring.utils import is_local_device
+from swift.common.utils import hash_path, storage_directory, whataremyips
+from swift.container.backend import ContainerBroker, DATADIR
+
+from . import registry
+
+
+class ReplicaPartition(object):
+    """Assigns the documents of a container to its replicas.
+
+    Each replica is the primary indexer for the documents whose ID hashes to
+    its index. The document IDs are hex digests, the prefix of which is used
+    as the hash.
+    """
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def is_primary(self, doc_id):
+        return int(doc_id[:8], 16) % self.count == self.index
+
+
+class DeferredRows(object):
+    """Rows of the other replicas that are waiting to be verified.
+
+    The rows are kept in the order they were added, which is the order of the
+    container database, along with the time at which they are due to be
+    verified. The progress through the database is tracked in memory, so that
+    the persisted checkpoint can be held back to the oldest row that has not
+    been verified yet.
+    """
+    def __init__(self):
+        self._rows = collections.deque()
+        self._row_ids = {}
+        self.progress = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, doc_id, row, due):
+        row_id = row.get('ROWID')
+        # The same rows are seen again if their chunk is processed again.
+        if doc_id in self._row_ids and self._row_ids[doc_id] == row_id:
+            return
+        self._row_ids[doc_id] = row_id
+        self._rows.append((due, doc_id, row))
+
+    def due(self, now):
+        """Returns the rows that are due to be verified.
+
+        The rows are not removed until remove() is called, so that they are
+        returned again if they could not be processed.
+        """
+        rows = []
+        for due, _, row in self._rows:
+            if due > now:
+                break
+            rows.append(row)
+        return rows
+
+    def remove(self, count):
+        """Removes the given number of the oldest rows."""
+        for _ in range(count):
+            _, doc_id, row = self._rows.popleft()
+            if self._row_ids.get(doc_id) == row.get('ROWID'):
+                del self._row_ids[doc_id]
+
+    def oldest_row_id(self):
+        """Returns the ROWID of the oldest row or None if there are none."""
+        for _, _, row in self._rows:
+            if row.get('ROWID') is not None:
+                return row['ROWID']
+        return None
+
+
+def get_ring(swift_dir):
+    """Returns the process-wide container ring, which reloads itself."""
+    return registry.get('ring', swift_dir,
+                        lambda: Ring(swift_dir, ring_name='container'))
+
+
+def get_partition(swift_dir, account, container, port=None):
+    """Returns the ReplicaPartition of this node for the container.
+
+    Returns None if this node is not one of the primary nodes of the
+    container (e.g. it holds a handoff copy), in which case it should process
+    all of the rows. If port is None, the nodes are matched by IP alone.
+    """
+    _, nodes = get_ring(swift_dir).get_nodes(
+        account.encode('utf-8'), container.encode('utf-8'))
+    my_ips = whataremyips()
+    for index, node in enumerate(nodes):
+        if is_local_device(my_ips, port, node['ip'], node['port']):
+            return ReplicaPartition(index, len(nodes))
+    return None
+
+
+def find_broker(devices, swift_dir, account, container):
+    """Returns the broker of the container database on this node.
+
+    Returns None if none of the devices hold the database.
+    """
+    account = account.encode('utf-8')
+    container = container.encode('utf-8')
+    part = get_ring(swift_dir).get_part(account, container)
+    name_hash = hash_path(account, container)
+    db_dir = storage_directory(DATADIR, part, name_hash)
+    for device in sorted(os.listdir(devices)):
+        db_path = os.path.join(devices, device, db_dir, name_hash + '.db')
+        if os.path.exists(db_path):
+            return ContainerBroker(db_path, account=account,
+                                   container=container)
+    return None
+
+
+def get_deferred_rows(key):
+    """Returns the process-wide deferred rows for the given key."""
+    return registry.get('deferred_rows', key, DeferredRows)
@@ -0,0 +1,34 @@
+from . import registry
+
+
+class FairScheduler(object):
+    """Shares the crawler's passes between the container mappings by lag.
+
+    A mapping is backfilling when it is further behind than it may catch up
+    on in a single pass (max_rows rows) and is in the steady state otherwise.
+    The mappings in the steady state handle all of their rows, while the
+    backfilling mappings are limited to a share of max_rows weighted by their
+    priority: the backfilling mappings with the highest priority handle up to
+    max_rows rows per pass, and the others proportionally fewer. This keeps
+    the passes short, so that the steady-state mappings are visited again
+    within seconds even while large containers are being backfilled.
+    """
+    def __init__(self):
+        self._backfills = {}
+
+    def limit(self, key, lag_rows, priority, max_rows):
+        """Returns the number of rows the mapping may handle in this pass.
+
+        Returns None if the mapping is not limited.
+        """
+        if max_rows <= 0 or lag_rows <= max_rows:
+            self._backfills.pop(key, None)
+            return None
+        self._backfills[key] = priority
+        top_priority = max(self._backfills.values())
+        return max(1, int(max_rows * priority / top_priority))
+
+
+def get_scheduler():
+    """Returns the scheduler shared by all of the mappings of the process."""
+    return registry.get('scheduler', None, FairScheduler)
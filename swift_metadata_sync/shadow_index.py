@@ -0,0 +1,146 @@
+import elasticsearch
+import eventlet
+import json
+import logging
+import os
+import os.path
+
+
+def check_aliases(mappings):
+    """Checks that the aliases of the mappings are moved safely.
+
+    The alias of a shadow index is moved as soon as the container of its
+    mapping catches up, so neither the shadow index nor the live index may
+    hold the documents of any other container. Raises ValueError otherwise.
+    """
+    for mapping in mappings:
+        if not mapping.get('shadow_of') or not mapping.get('alias'):
+            continue
+        container = (mapping['account'], mapping['container'])
+        for other in mappings:
+            if other['index'] not in (mapping['index'], mapping['shadow_of']):
+                continue
+            if (other['account'], other['container']) != container:
+                raise ValueError(
+                    'alias %s requires %s and %s to only hold the documents '
+                    'of %s/%s, but %s/%s is also indexed in %s' % (
+                        mapping['alias'], mapping['shadow_of'],
+                        mapping['index'], container[0], container[1],
+                        other['account'], other['container'],
+                        other['index']))
+
+
+class ShadowIndex(object):
+    """Rebuilds the index of a container mapping alongside the live index.
+
+    The shadow index is either seeded from the live index with the
+    Elasticsearch _reindex API, when only the index mapping changed, or rebuilt
+    from the container rows. The reindexing task runs in the background and is
+    checked on every pass of the crawler, rather than waited for. Once the
+    shadow index has caught up with the live index, the alias is atomically
+    moved over to it. Until then, the rebuild is limited to rows_per_second,
+    so that it does not starve the live updates.
+
+    The reindexing task and whether the alias has been moved are recorded in
+    the state file, so that they survive restarts. The alias may only be set
+    for indices that hold a single container (see check_aliases()).
+    """
+    def __init__(self, es_conn, index, live_index, alias, state_file,
+                 rows_per_second=0):
+        self.es_conn = es_conn
+        self.index = index
+        self.live_index = live_index
+        self.alias = alias
+        self.state_file = state_file
+        self.rows_per_second = rows_per_second
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._state = None
+
+    @property
+    def promoted(self):
+        return self._load_state().get('promoted', False)
+
+    def reindex(self, query, live_row):
+        """Copies the live documents matching the query into the index.
+
+        Starts the reindexing task on the first call and checks it on the
+        next ones. Returns None while the task is running and, once it has
+        completed, the row from which the shadow index has to be synced, which
+        is the row the live index was at when the task started.
+        """
+        state = self._load_state()
+        if not state.get('task'):
+            response = self.es_conn.reindex(
+                body={'source': {'index': self.live_index, 'query': query},
+                      'dest': {'index': self.index}},
+                wait_for_completion=False,
+                requests_per_second=self.rows_per_second or -1)
+            state = {'task': response['task'], 'row': live_row}
+            self._save_state(state)
+            self.logger.info('Reindexing %s into %s (task %s)' % (
+                self.live_index, self.index, state['task']))
+        try:
+            task = self.es_conn.tasks.get(task_id=state['task'])
+        except elasticsearch.NotFoundError:
+            # The task was lost (e.g. the node restarted) and is started again
+            # on the next pass.
+            self._save_state({})
+            raise RuntimeError('Reindexing task %s of %s was lost' % (
+                state['task'], self.index))
+        if not task.get('completed'):
+            return None
+        failures = task.get('response', {}).get('failures')
+        if failures or 'error' in task:
+            self._save_state({})
+            raise RuntimeError('Failed to reindex %s into %s: %s' % (
+                self.live_index, self.index,
+                failures or task['error']))
+        return state['row']
+
+    def promote(self):
+        """Atomically moves the alias from its current indices to the index.
+        """
+        if self.alias:
+            current = self.es_conn.indices.get_alias(name=self.alias,
+                                                     ignore=404)
+            # A missing alias is reported as an error status in the response.
+            actions = [{'remove': {'index': index, 'alias': self.alias}}
+                       for index, info in sorted(current.items())
+                       if isinstance(info, dict) and 'aliases' in info and
+                       index != self.index]
+            actions.append({'add': {'index': self.index, 'alias': self.alias}})
+            self.es_conn.indices.update_aliases(body={'actions': actions})
+            self.logger.info('Moved alias %s to %s' % (self.alias, self.index))
+        else:
+            self.logger.info('%s caught up with %s' % (
+                self.index, self.live_index))
+        self._save_state(dict(self._load_state(), promoted=True))
+
+    def throttle(self, rows, elapsed):
+        """Sleeps for as long as needed to process the rows at the limit.
+
+        Promoted indices are no longer rebuilding and are not throttled.
+        """
+        if self.rows_per_second <= 0 or self.promoted:
+            return
+        delay = float(rows) / self.rows_per_second - elapsed
+        if delay > 0:
+            eventlet.sleep(delay)
+
+    def _load_state(self):
+        if self._state is None:
+            try:
+                with open(self.state_file) as f:
+                    self._state = json.load(f)
+            except (IOError, ValueError):
+                self._state = {}
+        return self._state
+
+    def _save_state(self, state):
+        dir_path = os.path.dirname(self.state_file)
+        if not os.path.exists(dir_path):
+            os.mkdir(dir_path)
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(self.state_file + '.tmp', self.state_file)
+        self._state = state
@@ -0,0 +1,299 @@
+import atexit
+import contextlib
+import os
+import os.path
+import re
+import socket
+import time
+
+from . import registry
+
+
+class Stats(object):
+    """Counters and phase timings of a container mapping.
+
+    The values are reported to the configured sinks, labeled with the account,
+    container, and index of the mapping. Without any sinks, recording the
+    values is a no-op.
+    """
+    def __init__(self, sinks, account, container, index):
+        self.sinks = sinks
+        self.labels = (('account', account),
+                       ('container', container),
+                       ('index', index))
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def incr(self, name, value=1):
+        if not value:
+            return
+        for sink in self.sinks:
+            sink.incr(name, value, self.labels)
+
+    def timing(self, name, seconds):
+        for sink in self.sinks:
+            sink.timing(name, seconds, self.labels)
+
+    def gauge(self, name, value):
+        for sink in self.sinks:
+            sink.gauge(name, value, self.labels)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.maybe_flush()
+
+
+class StatsdSink(object):
+    """Emits the values as StatsD counters and timers over UDP.
+
+    The metric names are composed of the prefix, the label values, and the
+    name of the value, e.g. swift_metadata_sync.AUTH_test.container.index.rows.
+    Gauges are sent as StatsD gauges. Errors in sending the values are
+    ignored.
+    """
+    RESERVED_CHARS = re.compile(r'[.:|@\s]')
+
+    def __init__(self, host, port, prefix):
+        self.prefix = prefix
+        self._address = (socket.gethostbyname(host), port)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._names = {}
+
+    def incr(self, name, value, labels):
+        self._send('%s:%d|c' % (self._metric(name, labels), value))
+
+    def timing(self, name, seconds, labels):
+        self._send('%s:%.3f|ms' % (self._metric(name, labels), seconds * 1000))
+
+    def gauge(self, name, value, labels):
+        self._send('%s:%f|g' % (self._metric(name, labels), value))
+
+    def maybe_flush(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def _metric(self, name, labels):
+        key = (name, labels)
+        metric = self._names.get(key)
+        if metric is None:
+            parts = [self.prefix] + [
+                self.RESERVED_CHARS.sub('_', self._encode(value))
+                for _, value in labels] + [name]
+            metric = '.'.join(parts)
+            self._names[key] = metric
+        return metric
+
+    def _send(self, data):
+        try:
+            self._sock.sendto(data, self._address)
+        except socket.error:
+            pass
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+
+class PrometheusFileSink(object):
+    """Aggregates the values into a file in the Prometheus text format.
+
+    The file is meant to be collected by the node exporter's textfile
+    collector. Counters are exported as <prefix>_<name>_total, gauges as
+    <prefix>_<name>, and timers as the <prefix>_<name>_seconds summary. The
+    file is atomically replaced at
+    most once every flush_interval seconds.
+    """
+    def __init__(self, path, prefix, flush_interval=0):
+        self.path = path
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._dirty = False
+        self._last_flush = time.time()
+
+    def incr(self, name, value, labels):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+        self._dirty = True
+
+    def gauge(self, name, value, labels):
+        self._gauges[(name, labels)] = value
+        self._dirty = True
+
+    def timing(self, name, seconds, labels):
+        key = (name, labels)
+        timer = self._timers.get(key)
+        if timer is None:
+            self._timers[key] = [seconds, 1]
+        else:
+            timer[0] += seconds
+            timer[1] += 1
+        self._dirty = True
+
+    def maybe_flush(self):
+        if self._dirty and \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        lines = []
+        for name, samples in self._group(self._counters):
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            for labels, value in samples:
+                lines.append('%s%s %d' % (
+                    metric, self._format_labels(labels), value))
+        for name, samples in self._group(self._gauges):
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % metric)
+            for labels, value in samples:
+                lines.append('%s%s %f' % (
+                    metric, self._format_labels(labels), value))
+        for name, samples in self._group(self._timers):
+            metric = '%s_%s_seconds' % (self.prefix, name)
+            lines.append('# TYPE %s summary' % metric)
+            for labels, (total, count) in samples:
+                formatted = self._format_labels(labels)
+                lines.append('%s_sum%s %f' % (metric, formatted, total))
+                lines.append('%s_count%s %d' % (metric, formatted, count))
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.path)
+        self._dirty = False
+        self._last_flush = time.time()
+
+    @staticmethod
+    def _group(values):
+        groups = {}
+        for (name, labels), value in values.items():
+            groups.setdefault(name, []).append((labels, value))
+        return sorted((name, sorted(samples))
+                      for name, samples in groups.items())
+
+    @staticmethod
+    def _format_labels(labels):
+        formatted = []
+        for key, value in labels:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            value = value.replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n')
+            formatted.append('%s="%s"' % (key, value))
+        return '{%s}' % ','.join(formatted)
+
+
+DEFAULT_PREFIX = 'swift_metadata_sync'
+DEFAULT_STATSD_PORT = 8125
+DEFAULT_FLUSH_INTERVAL = 10
+PROMETHEUS_FILE = 'swift_metadata_sync.prom'
+WORKER_PROMETHEUS_FILE = re.compile(r'^swift_metadata_sync\.(\d+)\.prom$')
+
+_worker = None
+
+
+def set_worker(worker):
+    """Makes the sinks created in a worker process write separate files."""
+    global _worker
+    _worker = worker
+    registry.clear('stats_sink')
+
+
+def _prometheus_file():
+    if _worker is None:
+        return PROMETHEUS_FILE
+    return 'swift_metadata_sync.%d.prom' % _worker
+
+
+def get_sinks(settings, status_dir):
+    """Returns the process-wide sinks configured in the mapping settings.
+
+    Mappings with the same settings share the sinks, so that the values of all
+    of the containers are aggregated into the same file.
+    """
+    sinks = []
+    if settings.get('statsd_host'):
+        key = ('statsd',
+               settings['statsd_host'],
+               int(settings.get('statsd_port', DEFAULT_STATSD_PORT)),
+               settings.get('statsd_prefix', DEFAULT_PREFIX))
+        sinks.append(registry.get(
+            'stats_sink', key, lambda: StatsdSink(*key[1:])))
+    if settings.get('prometheus_stats', False):
+        key = ('prometheus', os.path.join(status_dir, _prometheus_file()))
+        flush_interval = float(settings.get(
+            'stats_flush_interval', DEFAULT_FLUSH_INTERVAL))
+        sinks.append(registry.get(
+            'stats_sink', key, lambda: PrometheusFileSink(
+                key[1], DEFAULT_PREFIX, flush_interval)))
+    return sinks
+
+
+@atexit.register
+def flush_sinks():
+    """Writes out the values aggregated by all sinks."""
+    for sink in registry.values('stats_sink'):
+        sink.flush()
+
+
+def merge_worker_files(status_dir):
+    """Merges the Prometheus files of the workers into a single file.
+
+    The values of the same metric and labels are added up.
+    """
+    try:
+        names = sorted(name for name in os.listdir(status_dir)
+                       if WORKER_PROMETHEUS_FILE.match(name))
+    except OSError:
+        return
+    families = {}
+    for name in names:
+        try:
+            with open(os.path.join(status_dir, name)) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            continue
+        family = None
+        for line in lines:
+            if line.startswith('# TYPE '):
+                _, _, metric, kind = line.split(' ', 3)
+                family = families.setdefault(metric, (kind, {}))
+                continue
+            if not line or line.startswith('#') or family is None:
+                continue
+            sample, value = line.rsplit(' ', 1)
+            samples = family[1]
+            samples[sample] = samples.get(sample, 0) + (
+                float(value) if '.' in value else int(value))
+    if not families:
+        return
+    lines = []
+    for metric, (kind, samples) in sorted(families.items()):
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for sample, value in sorted(samples.items()):
+            if isinstance(value, float):
+                lines.append('%s %f' % (sample, value))
+            else:
+                lines.append('%s %d' % (sample, value))
+    path = os.path.join(status_dir, PROMETHEUS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,161 @@
+import errno
+import logging
+import os
+import signal
+import time
+import zlib
+
+from . import checkpoint_store
+from . import freshness_cache
+from . import stats
+
+
+def shard_index(mapping, shards):
+    """Returns the shard of the container mapping.
+
+    The shard is a stable hash of the account and container, which means that
+    a mapping is always handled by the same worker (and its status files are
+    only written by one process).
+    """
+    key = u'/'.join([mapping['account'], mapping['container']])
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shards
+
+
+def shard_conf(conf, shard, shards):
+    """Returns the configuration with only the mappings of the shard."""
+    return dict(conf, containers=[
+        mapping for mapping in conf['containers']
+        if shard_index(mapping, shards) == shard])
+
+
+class Supervisor(object):
+    """Runs the container mappings sharded across worker processes.
+
+    Each worker is forked with the configuration of its shard and calls
+    run_worker with it. Workers that exit are restarted, with an exponential
+    backoff if they keep failing, unless running once. The Prometheus stats
+    files of the workers are periodically merged into the status directory's
+    stats file.
+    """
+    RESTART_DELAY = 1
+    MAX_RESTART_DELAY = 60
+    POLL_INTERVAL = 1
+    STATS_INTERVAL = 10
+
+    def __init__(self, conf, processes, run_worker, once=False):
+        self.conf = conf
+        self.run_worker = run_worker
+        self.once = once
+        self.logger = logging.getLogger('swift-metadata-sync')
+        # Shards without any mappings do not need a worker.
+        self.shard_confs = {}
+        for shard in range(processes):
+            sharded = shard_conf(conf, shard, processes)
+            if sharded['containers']:
+                self.shard_confs[shard] = sharded
+        self._workers = {}
+        self._started = {}
+        self._failures = dict((shard, 0) for shard in self.shard_confs)
+        self._restarts = {}
+        self._stopping = False
+        self._failed = False
+        self._last_stats = 0
+
+    def run(self):
+        """Runs the workers until they exit and returns the exit status."""
+        for shard in self.shard_confs:
+            self._spawn(shard)
+        while self._workers or self._restarts:
+            self._reap()
+            self._restart()
+            self._merge_stats()
+            if self._workers or self._restarts:
+                time.sleep(self.POLL_INTERVAL)
+        self._merge_stats(force=True)
+        return 1 if self._failed else 0
+
+    def stop(self, *args):
+        """Stops the workers and exits once they have stopped."""
+        self._stopping = True
+        self._restarts.clear()
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self, shard):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = shard
+            self._started[shard] = time.time()
+            return
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, _exit_worker)
+            stats.set_worker(shard)
+            self.run_worker(self.shard_confs[shard])
+            status = 0
+        except SystemExit as e:
+            status = e.code or 0
+        except Exception:
+            self.logger.exception('Worker %d failed' % shard)
+        finally:
+            try:
+                checkpoint_store.flush_stores()
+                freshness_cache.flush_caches()
+                stats.flush_sinks()
+            finally:
+                os._exit(status)
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not pid:
+                return
+            shard = self._workers.pop(pid, None)
+            if shard is None:
+                continue
+            self._exited(shard, status)
+
+    def _exited(self, shard, status):
+        if status:
+            self._failed = True
+            self.logger.error('Worker %d exited with status %d' % (
+                shard, os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                else status))
+        if self.once or self._stopping:
+            return
+        if time.time() - self._started[shard] >= self.MAX_RESTART_DELAY:
+            self._failures[shard] = 0
+        delay = min(self.MAX_RESTART_DELAY,
+                    self.RESTART_DELAY * 2 ** self._failures[shard])
+        self._failures[shard] += 1
+        self.logger.info('Restarting worker %d in %d seconds' % (
+            shard, delay))
+        self._restarts[shard] = time.time() + delay
+
+    def _restart(self):
+        now = time.time()
+        for shard, restart_time in self._restarts.items():
+            if restart_time <= now:
+                del self._restarts[shard]
+                self._spawn(shard)
+
+    def _merge_stats(self, force=False):
+        now = time.time()
+        if not force and now - self._last_stats < self.STATS_INTERVAL:
+            return
+        self._last_stats = now
+        stats.merge_worker_files(self.conf['status_dir'])
+
+
+def _exit_worker(signum, frame):
+    # Exit through SystemExit, so that the pending checkpoints are flushed.
+    raise SystemExit(0)
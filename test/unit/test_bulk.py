@@ -0,0 +1,230 @@
+import elasticsearch
+import eventlet
+import json
+import mock
+import unittest
+
+from eventlet import tpool
+from swift_metadata_sync import bulk, registry
+
+
+class TestAdaptiveBulk(unittest.TestCase):
+    def setUp(self):
+        self.es_conn = mock.Mock()
+        self.requests = []
+        # Maps the document ID to the number of times it should be rejected
+        self.rejections = {}
+
+        def _bulk(body):
+            ids = [json.loads(line)['index']['_id']
+                   for line in body.splitlines()[::2]]
+            self.requests.append((ids, len(body)))
+            items = []
+            for doc_id in ids:
+                if self.rejections.get(doc_id):
+                    self.rejections[doc_id] -= 1
+                    items.append({'index': {'_id': doc_id, 'status': 429}})
+                else:
+                    items.append({'index': {'_id': doc_id, 'status': 201}})
+            return {'errors': False, 'items': items}
+
+        self.es_conn.bulk.side_effect = _bulk
+        # The requests are sent through the thread pool, whose setup sleeps.
+        tpool.setup()
+        patcher = mock.patch('swift_metadata_sync.bulk.eventlet.sleep')
+        self.addCleanup(patcher.stop)
+        self.sleep_mock = patcher.start()
+
+    @staticmethod
+    def make_actions(count):
+        return [{'_op_type': 'index', '_id': 'doc-%d' % i, '_source': {}}
+                for i in range(count)]
+
+    def test_invalid_limits(self):
+        with self.assertRaises(ValueError):
+            bulk.AdaptiveBulk(0, 100, 1)
+        with self.assertRaises(ValueError):
+            bulk.AdaptiveBulk(10, 0, 1)
+        with self.assertRaises(ValueError):
+            bulk.AdaptiveBulk(10, 100, 1, concurrency=0)
+
+    def test_batches(self):
+        adaptive_bulk = bulk.AdaptiveBulk(4, 1024, 3)
+        results = list(adaptive_bulk.streaming_bulk(
+            self.es_conn, iter(self.make_actions(10))))
+
+        self.assertEqual(['doc-%d' % i for i in range(10)],
+                         [item['index']['_id'] for _, _, item in results])
+        self.assertTrue(all(ok for _, ok, _ in results))
+        self.assertEqual([4, 4, 2], [len(ids) for ids, _ in self.requests])
+        self.assertEqual(sum(size for _, size in self.requests),
+                         adaptive_bulk.bytes_sent)
+        self.sleep_mock.assert_not_called()
+
+    def test_max_bytes(self):
+        actions = self.make_actions(5)
+        action_size = len(bulk.AdaptiveBulk(1, 1, 1).serialize(actions[0]))
+        adaptive_bulk = bulk.AdaptiveBulk(10, action_size * 2, 3)
+        results = list(adaptive_bulk.streaming_bulk(self.es_conn, actions))
+
+        self.assertTrue(all(ok for _, ok, _ in results))
+        self.assertEqual([['doc-0', 'doc-1'], ['doc-2', 'doc-3'], ['doc-4']],
+                         [ids for ids, _ in self.requests])
+
+    def test_serialize(self):
+        adaptive_bulk = bulk.AdaptiveBulk(1, 1, 1)
+        lines = adaptive_bulk.serialize({'_op_type': 'index',
+                                         '_index': 'i',
+                                         '_type': 'object',
+                                         '_id': 'id',
+                                         'pipeline': 'p',
+                                         '_source': {'key': u'\u2603'}})
+        self.assertIsInstance(lines, str)
+        self.assertTrue(lines.endswith('\n'))
+        action, source = lines.splitlines()
+        self.assertEqual({'index': {'_index': 'i', '_type': 'object',
+                                    '_id': 'id', 'pipeline': 'p'}},
+                         json.loads(action))
+        self.assertEqual('{"key":"\\u2603"}', source)
+        self.assertEqual(
+            '{"delete":{"_id":"id"}}\n',
+            adaptive_bulk.serialize({'_op_type': 'delete', '_id': 'id'}))
+
+    def test_fast_json(self):
+        ujson_mock = mock.Mock()
+        with mock.patch('swift_metadata_sync.bulk.ujson', ujson_mock):
+            adaptive_bulk = bulk.AdaptiveBulk(1, 1, 1, fast_json=True)
+        self.assertIs(ujson_mock.dumps, adaptive_bulk._dumps)
+
+        with mock.patch('swift_metadata_sync.bulk.ujson', None):
+            adaptive_bulk = bulk.AdaptiveBulk(1, 1, 1, fast_json=True)
+        self.assertIs(bulk._compact_dumps, adaptive_bulk._dumps)
+
+    def test_transport_error(self):
+        error = elasticsearch.ConnectionError('N/A', 'connection refused',
+                                              None)
+        self.es_conn.bulk.side_effect = error
+        adaptive_bulk = bulk.AdaptiveBulk(10, 1024, 3)
+        actions = self.make_actions(2) + [
+            {'_op_type': 'delete', '_id': 'doc-2'}]
+        results = list(adaptive_bulk.streaming_bulk(self.es_conn, actions))
+
+        self.assertEqual([
+            (actions[0], False, {'index': {
+                'error': str(error), 'status': 'N/A', 'exception': error,
+                '_id': 'doc-0', 'data': {}}}),
+            (actions[1], False, {'index': {
+                'error': str(error), 'status': 'N/A', 'exception': error,
+                '_id': 'doc-1', 'data': {}}}),
+            (actions[2], False, {'delete': {
+                'error': str(error), 'status': 'N/A', 'exception': error,
+                '_id': 'doc-2'}})], results)
+        self.sleep_mock.assert_not_called()
+
+    def test_rejections_shrink_and_retry(self):
+        adaptive_bulk = bulk.AdaptiveBulk(8, 1024, 3)
+        self.rejections = {'doc-1': 2, 'doc-5': 1}
+        results = list(adaptive_bulk.streaming_bulk(
+            self.es_conn, self.make_actions(12)))
+
+        self.assertTrue(all(ok for _, ok, _ in results))
+        self.assertEqual(
+            sorted(['doc-%d' % i for i in range(12)]),
+            sorted([item['index']['_id'] for _, _, item in results]))
+        self.assertEqual([
+            ['doc-%d' % i for i in range(8)],
+            ['doc-1', 'doc-5'],
+            ['doc-1'],
+            # Successful requests grow the size again
+            ['doc-%d' % i for i in range(8, 12)],
+        ], [ids for ids, _ in self.requests])
+        self.assertEqual([mock.call(1), mock.call(2)],
+                         self.sleep_mock.mock_calls)
+        self.assertEqual(8, adaptive_bulk.docs)
+
+    def test_rejections_exhaust_retries(self):
+        adaptive_bulk = bulk.AdaptiveBulk(2, 1024, 2)
+        self.rejections = {'doc-0': 5}
+        results = list(adaptive_bulk.streaming_bulk(
+            self.es_conn, self.make_actions(2)))
+
+        actions = self.make_actions(2)
+        self.assertEqual(
+            [(actions[1], True, {'index': {'_id': 'doc-1', 'status': 201}}),
+             (actions[0], False, {'index': {'_id': 'doc-0', 'status': 429}})],
+            results)
+        self.assertEqual(3, len(self.requests))
+        self.assertEqual(1, adaptive_bulk.docs)
+
+    def test_max_backoff(self):
+        adaptive_bulk = bulk.AdaptiveBulk(1, 1024, 10)
+        self.rejections = {'doc-0': 10}
+        list(adaptive_bulk.streaming_bulk(self.es_conn, self.make_actions(1)))
+        self.assertEqual(
+            [1, 2, 4, 8, 16, 32, 60, 60, 60, 60],
+            [args[0] for _, args, _ in self.sleep_mock.mock_calls])
+
+    def test_concurrent_requests(self):
+        adaptive_bulk = bulk.AdaptiveBulk(2, 1024, 3, concurrency=3)
+        _bulk = self.es_conn.bulk.side_effect
+        started = [0]
+        in_flight = [0]
+        max_in_flight = [0]
+
+        def _slow_bulk(body):
+            started[0] += 1
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            # The later requests complete first.
+            eventlet.greenthread.sleep(0.01 / started[0])
+            in_flight[0] -= 1
+            return _bulk(body)
+
+        self.es_conn.bulk.side_effect = _slow_bulk
+        results = list(adaptive_bulk.streaming_bulk(
+            self.es_conn, iter(self.make_actions(10))))
+
+        self.assertEqual(['doc-%d' % i for i in range(10)],
+                         [item['index']['_id'] for _, _, item in results])
+        self.assertEqual(5, len(self.requests))
+        self.assertEqual(3, max_in_flight[0])
+
+    def test_rate_limits(self):
+        docs_bucket = mock.Mock()
+        docs_bucket.take.return_value = 0.5
+        bytes_bucket = mock.Mock()
+        bytes_bucket.take.return_value = 0
+        adaptive_bulk = bulk.AdaptiveBulk(
+            2, 1024, 3, docs_bucket=docs_bucket, bytes_bucket=bytes_bucket)
+        list(adaptive_bulk.streaming_bulk(
+            self.es_conn, iter(self.make_actions(3))))
+
+        self.assertEqual([mock.call(2), mock.call(1)],
+                         docs_bucket.take.mock_calls)
+        self.assertEqual([mock.call(size) for _, size in self.requests],
+                         bytes_bucket.take.mock_calls)
+        self.assertEqual(1, adaptive_bulk.throttled_seconds)
+
+    def test_shared_batch_size(self):
+        self.addCleanup(registry.clear)
+        batch_size = bulk.get_batch_size('cluster', 4)
+        self.assertIs(batch_size, bulk.get_batch_size('cluster', 8))
+        self.assertIsNot(batch_size, bulk.get_batch_size('other', 4))
+
+        self.rejections = {'doc-0': 1}
+        adaptive_bulk = bulk.AdaptiveBulk(4, 1024, 0, batch_size=batch_size)
+        list(adaptive_bulk.streaming_bulk(
+            self.es_conn, iter(self.make_actions(4))))
+        self.assertEqual(2, batch_size.docs)
+
+        # A new object for the same cluster starts from the reduced size
+        del self.requests[:]
+        adaptive_bulk = bulk.AdaptiveBulk(4, 1024, 3, batch_size=batch_size)
+        list(adaptive_bulk.streaming_bulk(
+            self.es_conn, iter(self.make_actions(2))))
+        self.assertEqual([2], [len(ids) for ids, _ in self.requests])
+        self.assertEqual(4, batch_size.docs)
+
+        # The size is still limited by each object's max_docs
+        adaptive_bulk = bulk.AdaptiveBulk(1, 1024, 3, batch_size=batch_size)
+        self.assertEqual(1, adaptive_bulk.docs)
@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import checkpoint_store, registry
+
+
+class TestCheckpointStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'status')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        registry.clear()
+
+    def read_records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_missing_file(self):
+        store = checkpoint_store.CheckpointStore(self.path)
+        self.assertIsNone(store.get('db-id'))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_put_and_get(self):
+        store = checkpoint_store.CheckpointStore(self.path)
+        store.put('db-id', 42, 'index')
+        self.assertEqual({'last_row': 42, 'index': 'index'},
+                         store.get('db-id'))
+        self.assertEqual([['db-id', 42, 'index']], self.read_records())
+
+        reloaded = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual({'last_row': 42, 'index': 'index'},
+                         reloaded.get('db-id'))
+
+    def test_chunk_size(self):
+        store = checkpoint_store.CheckpointStore(self.path)
+        store.put('db-id', 42, 'index', 2000)
+        self.assertEqual({'last_row': 42, 'index': 'index',
+                          'chunk_size': 2000}, store.get('db-id'))
+        # A change to the chunk size alone is also recorded
+        store.put('db-id', 42, 'index', 3000)
+        store.compact()
+        self.assertEqual([['db-id', 42, 'index', 3000]], self.read_records())
+
+        reloaded = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(3000, reloaded.get('db-id')['chunk_size'])
+
+    def test_compaction(self):
+        store = checkpoint_store.CheckpointStore(self.path)
+        store.MIN_COMPACTION_RECORDS = 4
+        for i in range(4):
+            store.put('db-id', i, 'index')
+        self.assertEqual(4, len(self.read_records()))
+        store.put('db-id', 4, 'index')
+        self.assertEqual([['db-id', 4, 'index']], self.read_records())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        store.put('other-id', 1, 'index')
+        reloaded = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(4, reloaded.get('db-id')['last_row'])
+        self.assertEqual(1, reloaded.get('other-id')['last_row'])
+
+    def test_torn_record(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(['db-id', 42, 'index']) + '\n')
+            f.write('["db-id", 4')
+        store = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(42, store.get('db-id')['last_row'])
+        # The partial record is dropped before anything is appended
+        self.assertEqual([['db-id', 42, 'index']], self.read_records())
+        store.put('db-id', 43, 'index')
+        reloaded = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(43, reloaded.get('db-id')['last_row'])
+
+    def test_invalid_records(self):
+        with open(self.path, 'w') as f:
+            f.write('["db-id"]\n42\n["db-id", 42, "index"]\n')
+        store = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(42, store.get('db-id')['last_row'])
+
+    def test_legacy_migration(self):
+        with open(self.path, 'w') as f:
+            json.dump({'db-id': {'last_row': 42, 'index': 'index'},
+                       'bad-id': {'row': 1}}, f)
+        store = checkpoint_store.CheckpointStore(self.path)
+        self.assertEqual(42, store.get('db-id')['last_row'])
+        self.assertIsNone(store.get('bad-id'))
+        self.assertEqual([['db-id', 42, 'index']], self.read_records())
+
+    def test_get_store(self):
+        store = checkpoint_store.get_store(self.path, 10, 100)
+        self.assertIs(store, checkpoint_store.get_store(self.path, 1, 1))
+        self.assertEqual((10, 100), (store.flush_interval, store.flush_rows))
+        self.assertIsNot(store, checkpoint_store.get_store(self.path + '2'))
@@ -0,0 +1,46 @@
+import unittest
+
+from swift_metadata_sync import chunk_sizer, registry
+
+
+class TestChunkSizer(unittest.TestCase):
+    def test_invalid_bounds(self):
+        with self.assertRaises(ValueError):
+            chunk_sizer.ChunkSizer(0, 100, 5, 0)
+        with self.assertRaises(ValueError):
+            chunk_sizer.ChunkSizer(100, 99, 5, 0)
+
+    def test_update(self):
+        sizer = chunk_sizer.ChunkSizer(10, 10000, 5, 1000)
+        self.assertIsNone(sizer.size)
+        # 1000 rows in 10 seconds are twice as slow as the target
+        sizer.update(1000, 10, 0)
+        self.assertEqual(500, sizer.size)
+        # The size moves halfway toward the target
+        sizer.update(500, 1, 0)
+        self.assertEqual(1500, sizer.size)
+        # The size of the requests limits the rows as well
+        sizer.update(1500, 1, 3000)
+        self.assertEqual(1000, sizer.size)
+        # Chunks without any rows are ignored
+        sizer.update(0, 1, 0)
+        self.assertEqual(1000, sizer.size)
+
+    def test_bounds(self):
+        sizer = chunk_sizer.ChunkSizer(10, 100, 5, 0)
+        sizer.update(10, 0, 0)
+        self.assertEqual(100, sizer.size)
+        sizer.update(100, 1000, 0)
+        self.assertEqual(50, sizer.size)
+        sizer.size = None
+        sizer.update(100, 1000, 0)
+        self.assertEqual(10, sizer.size)
+
+    def test_get_sizer(self):
+        self.addCleanup(registry.clear)
+        sizer = chunk_sizer.get_sizer('key', 10, 100, 5, 0)
+        self.assertIs(sizer, chunk_sizer.get_sizer('key', 20, 200, 1, 0))
+        # The bounds are not changed by the handlers created later
+        self.assertEqual((10, 100, 5), (
+            sizer.min_rows, sizer.max_rows, sizer.target_seconds))
+        self.assertIsNot(sizer, chunk_sizer.get_sizer('other', 10, 100, 5, 0))
@@ -0,0 +1,73 @@
+import logging
+import mock
+import unittest
+
+from swift_metadata_sync import debug_trace
+
+
+class TestDebugTrace(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test-debug-trace')
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = mock.Mock(level=logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def _messages(self):
+        return [call[1][0].getMessage()
+                for call in self.handler.handle.mock_calls]
+
+    def test_enabled(self):
+        trace = debug_trace.DebugTrace(self.logger)
+        self.assertTrue(trace.enabled)
+        self.logger.setLevel(logging.INFO)
+        self.assertFalse(trace.enabled)
+        self.logger.setLevel(logging.DEBUG)
+        trace = debug_trace.DebugTrace(self.logger, sample_rate=0)
+        self.assertFalse(trace.enabled)
+
+    def test_invalid_sample_rate(self):
+        for rate in [-0.1, 1.1]:
+            with self.assertRaises(ValueError):
+                debug_trace.DebugTrace(self.logger, sample_rate=rate)
+
+    def test_sampling(self):
+        trace = debug_trace.DebugTrace(self.logger, sample_rate=0.5)
+        self.assertTrue(trace.sampled('00000000' + 'f' * 56))
+        self.assertTrue(trace.sampled('7fffffff' + 'f' * 56))
+        self.assertFalse(trace.sampled('80000000' + '0' * 56))
+        self.assertFalse(trace.sampled('ffffffff' + '0' * 56))
+
+        trace.trace('Row', '10000000', {'name': 'sampled'})
+        trace.trace('Row', 'f0000000', {'name': 'skipped'})
+        self.assertEqual(["Row 10000000: {'name': 'sampled'}"],
+                         self._messages())
+
+        trace = debug_trace.DebugTrace(self.logger, sample_rate=1)
+        self.assertTrue(trace.sampled('ffffffff'))
+
+    def test_truncates_payload(self):
+        trace = debug_trace.DebugTrace(self.logger, max_length=10)
+        trace.trace('Row', 'abcd', 'x' * 20)
+        trace.trace('Row', 'abcd', 'short')
+        self.assertEqual(["Row abcd: 'xxxxxxxxx... (12 more characters)",
+                          "Row abcd: 'short'"],
+                         self._messages())
+
+    def test_deferred_formatting(self):
+        class Payload(object):
+            formatted = 0
+
+            def __repr__(self):
+                Payload.formatted += 1
+                return 'payload'
+
+        trace = debug_trace.DebugTrace(self.logger)
+        self.logger.setLevel(logging.INFO)
+        trace.trace('Row', 'abcd', Payload())
+        self.assertEqual(0, Payload.formatted)
+        self.assertEqual([], self._messages())
+
+        self.logger.setLevel(logging.DEBUG)
+        trace.trace('Row', 'abcd', Payload())
+        self.assertEqual(['Row abcd: payload'], self._messages())
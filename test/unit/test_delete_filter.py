@@ -0,0 +1,69 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import delete_filter, registry
+
+
+def _doc_id(i):
+    return hashlib.sha256(str(i)).hexdigest()
+
+
+class TestDeleteFilter(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.path = os.path.join(self.status_dir, 'filter')
+
+    def test_membership(self):
+        members = delete_filter.DeleteFilter(1000)
+        for i in range(1000):
+            members.add(_doc_id(i))
+        self.assertTrue(all(_doc_id(i) in members for i in range(1000)))
+        false_positives = sum(_doc_id(i) in members
+                              for i in range(1000, 11000))
+        # The filter is sized for a 1% false positive rate
+        self.assertLess(false_positives, 200)
+
+    def test_save_and_load(self):
+        members = delete_filter.DeleteFilter(100)
+        members.add(_doc_id(1))
+        members.complete = True
+        members.rows = {'db-id': 42}
+        members.save(self.path, 'index')
+        self.assertNotEqual(0, members.saved_at)
+
+        loaded = delete_filter.DeleteFilter(100)
+        loaded.load(self.path, 'index')
+        self.assertTrue(loaded.complete)
+        self.assertEqual({'db-id': 42}, loaded.rows)
+        self.assertIn(_doc_id(1), loaded)
+        self.assertNotIn(_doc_id(2), loaded)
+
+    def test_load_ignored(self):
+        members = delete_filter.DeleteFilter(100)
+        members.complete = True
+        members.save(self.path, 'index')
+
+        for capacity, index in [(100, 'other-index'), (1000, 'index')]:
+            loaded = delete_filter.DeleteFilter(capacity)
+            loaded.load(self.path, index)
+            self.assertFalse(loaded.complete)
+
+        with open(self.path, 'w') as f:
+            f.write('garbage')
+        loaded = delete_filter.DeleteFilter(100)
+        loaded.load(self.path, 'index')
+        self.assertFalse(loaded.complete)
+        loaded.load(os.path.join(self.status_dir, 'missing'), 'index')
+        self.assertFalse(loaded.complete)
+
+    def test_get_filter(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+        members = delete_filter.get_filter(('a', 'c', 'i'), 10)
+        self.assertIs(members, delete_filter.get_filter(('a', 'c', 'i'), 10))
+        self.assertIsNot(members,
+                         delete_filter.get_filter(('a', 'c', 'j'), 10))
@@ -0,0 +1,94 @@
+import email.utils
+import mock
+import unittest
+
+from swift_metadata_sync import document_builder
+from swift_metadata_sync.metadata_sync import MetadataSync
+
+
+class TestDocumentBuilder(unittest.TestCase):
+    def setUp(self):
+        self.builder = document_builder.DocumentBuilder(
+            MetadataSync.DOC_MAPPING.keys(), MetadataSync.USER_META_PREFIX)
+
+    def test_build(self):
+        meta = {'x-timestamp': '1500000000.12345',
+                'last-modified': 'Fri, 14 Jul 2017 02:40:01 GMT',
+                'content-length': '42',
+                'content-type': 'text/plain',
+                'etag': 'etag',
+                'x-static-large-object': 'True',
+                'x-backend-timestamp': '1500000000.12345',
+                'x-object-meta-color': 'blue',
+                'x-object-meta-\xe2\x98\x83': '\xe2\x98\x83'}
+        self.assertEqual({
+            'x-timestamp': 1500000000123,
+            'last-modified': 1500000001000,
+            'x-swift-account': u'AUTH_test',
+            'x-swift-container': u'container',
+            'x-swift-object': u'object',
+            'content-length': '42',
+            'content-type': 'text/plain',
+            'etag': 'etag',
+            'x-static-large-object': 'True',
+            u'color': u'blue',
+            u'\u2603': u'\u2603'},
+            self.builder.build(meta, u'AUTH_test', u'container', u'object'))
+        # The fields are resolved once per header
+        self.assertEqual((True, u'color'),
+                         self.builder._fields['x-object-meta-color'])
+        self.assertEqual((False, 'etag'), self.builder._fields['etag'])
+        self.assertIsNone(self.builder._fields['x-backend-timestamp'])
+
+    def test_user_meta_precedence(self):
+        meta = {'x-timestamp': '0',
+                'last-modified': email.utils.formatdate(0, usegmt=True),
+                'etag': 'etag',
+                'x-object-meta-etag': 'user etag',
+                'x-object-meta-x-swift-object': 'user object'}
+        es_doc = self.builder.build(meta, u'a', u'c', u'o')
+        self.assertEqual(u'user etag', es_doc['etag'])
+        self.assertEqual(u'user object', es_doc['x-swift-object'])
+
+    def test_parse_json(self):
+        builder = document_builder.DocumentBuilder(
+            MetadataSync.DOC_MAPPING.keys(), MetadataSync.USER_META_PREFIX,
+            parse_json=True)
+        meta = {'x-timestamp': '0',
+                'last-modified': email.utils.formatdate(0, usegmt=True),
+                'x-object-meta-json': '{"a": ["\xe2\x98\x83", 1]}',
+                'x-object-meta-text': '{not json \xe2\x98\x83'}
+        es_doc = builder.build(meta, u'a', u'c', u'o')
+        self.assertEqual({u'a': [u'\u2603', 1]}, es_doc['json'])
+        self.assertEqual(u'{not json \u2603', es_doc['text'])
+
+    def test_fast_json(self):
+        ujson_mock = mock.Mock()
+        with mock.patch(
+                'swift_metadata_sync.document_builder.ujson', ujson_mock):
+            builder = document_builder.DocumentBuilder(
+                [], MetadataSync.USER_META_PREFIX, parse_json=True,
+                fast_json=True)
+        self.assertIs(ujson_mock.loads, builder._json_loads)
+
+        with mock.patch('swift_metadata_sync.document_builder.ujson', None):
+            builder = document_builder.DocumentBuilder(
+                [], MetadataSync.USER_META_PREFIX, parse_json=True,
+                fast_json=True)
+        self.assertIs(document_builder.json.loads, builder._json_loads)
+
+    def test_parse_http_date(self):
+        for timestamp in [0, 951782400, 1500000000, 1528323859, 4102444800]:
+            value = email.utils.formatdate(timestamp, usegmt=True)
+            self.assertEqual(
+                timestamp,
+                document_builder.DocumentBuilder.parse_http_date(value))
+        # Other formats are parsed by email.utils
+        self.assertEqual(
+            1528323859,
+            document_builder.DocumentBuilder.parse_http_date(
+                'Wed, 06 Jun 2018 15:24:19 -0700'))
+        self.assertEqual(
+            1528323859,
+            document_builder.DocumentBuilder.parse_http_date(
+                'Wednesday, 06-Jun-18 22:24:19 GMT'))
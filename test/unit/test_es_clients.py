@@ -0,0 +1,37 @@
+from distutils.version import StrictVersion
+import mock
+import unittest
+
+from swift_metadata_sync import es_clients, registry
+
+
+class TestESClients(unittest.TestCase):
+    def tearDown(self):
+        registry.clear()
+
+    @mock.patch('swift_metadata_sync.es_clients.elasticsearch.Elasticsearch')
+    def test_get_client(self, es_mock):
+        es_mock.side_effect = lambda *args, **kwargs: mock.Mock()
+        client = es_clients.get_client('es.example.com', 10)
+        self.assertIs(client, es_clients.get_client('es.example.com', 10))
+        self.assertIsNot(client, es_clients.get_client('es.example.com', 20))
+        self.assertIsNot(client, es_clients.get_client('other.example.com',
+                                                       10))
+
+        hosts = [{'host': 'es1', 'port': 9200}, 'es2']
+        client = es_clients.get_client(hosts, 10)
+        self.assertIs(client, es_clients.get_client(
+            ['es2', {'port': 9200, 'host': 'es1'}], 10))
+        es_mock.assert_called_with(hosts, maxsize=10)
+
+    @mock.patch('swift_metadata_sync.es_clients.elasticsearch.Elasticsearch')
+    def test_server_version(self, es_mock):
+        es_mock.return_value.info.side_effect = [
+            Exception('connection failed'),
+            {'version': {'number': '5.4.0'}}]
+        client = es_clients.get_client('es.example.com', 10)
+        with self.assertRaises(Exception):
+            client.server_version
+        self.assertEqual(StrictVersion('5.4.0'), client.server_version)
+        self.assertEqual(StrictVersion('5.4.0'), client.server_version)
+        self.assertEqual(2, es_mock.return_value.info.call_count)
@@ -0,0 +1,131 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import freshness_cache, registry
+
+
+class TestFreshnessCache(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        registry.clear()
+
+    def test_is_fresh(self):
+        cache = freshness_cache.FreshnessCache(10)
+        self.assertFalse(cache.is_fresh('doc', 1000))
+        cache.update('doc', 1000)
+        self.assertTrue(cache.is_fresh('doc', 999))
+        self.assertTrue(cache.is_fresh('doc', 1000))
+        self.assertFalse(cache.is_fresh('doc', 1001))
+
+    def test_update_keeps_newest(self):
+        cache = freshness_cache.FreshnessCache(10)
+        cache.update('doc', 1000)
+        cache.update('doc', 500)
+        self.assertEqual(1000, cache.get('doc'))
+        cache.update('doc', 2000)
+        self.assertEqual(2000, cache.get('doc'))
+
+    def test_lru_eviction(self):
+        cache = freshness_cache.FreshnessCache(2)
+        cache.update('a', 1)
+        cache.update('b', 2)
+        # Accessing "a" makes "b" the least recently used entry
+        self.assertEqual(1, cache.get('a'))
+        cache.update('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_disabled(self):
+        cache = freshness_cache.FreshnessCache(0)
+        cache.update('a', 1)
+        self.assertEqual(0, len(cache))
+        self.assertFalse(cache.is_fresh('a', 1))
+
+    def test_discard(self):
+        cache = freshness_cache.FreshnessCache(2)
+        cache.update('a', 1)
+        cache.discard('a')
+        cache.discard('missing')
+        self.assertNotIn('a', cache)
+
+    def test_save_and_load(self):
+        path = os.path.join(self.tempdir, 'cache')
+        cache = freshness_cache.FreshnessCache(3)
+        for i in range(3):
+            cache.update('doc-%d' % i, i)
+        cache.get('doc-0')
+        cache.save(path, 'index')
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        loaded = freshness_cache.FreshnessCache(3)
+        loaded.load(path, 'index')
+        self.assertEqual(3, len(loaded))
+        # The recency order is preserved
+        loaded.update('doc-3', 3)
+        self.assertNotIn('doc-1', loaded)
+        self.assertIn('doc-0', loaded)
+
+        other_index = freshness_cache.FreshnessCache(3)
+        other_index.load(path, 'other-index')
+        self.assertEqual(0, len(other_index))
+
+    @mock.patch('swift_metadata_sync.freshness_cache.time.time')
+    def test_maybe_save(self, time_mock):
+        time_mock.return_value = 1000
+        path = os.path.join(self.tempdir, 'cache')
+        cache = freshness_cache.get_cache('key', 10)
+        cache.update('doc-0', 0)
+        cache.maybe_save(path, 'index', 10)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(1000, cache.saved_at)
+
+        # Updates are only written out once the interval passes
+        cache.update('doc-1', 1)
+        time_mock.return_value = 1005
+        cache.maybe_save(path, 'index', 10)
+        loaded = freshness_cache.FreshnessCache(10)
+        loaded.load(path, 'index')
+        self.assertEqual(1, len(loaded))
+
+        # or at exit
+        freshness_cache.flush_caches()
+        loaded.load(path, 'index')
+        self.assertEqual(2, len(loaded))
+        self.assertEqual(1005, cache.saved_at)
+
+        # Unchanged caches are not written out again
+        time_mock.return_value = 2000
+        cache.maybe_save(path, 'index', 10)
+        freshness_cache.flush_caches()
+        self.assertEqual(1005, cache.saved_at)
+
+    def test_load_invalid(self):
+        cache = freshness_cache.FreshnessCache(3)
+        cache.load(os.path.join(self.tempdir, 'missing'), 'index')
+        self.assertEqual(0, len(cache))
+
+        path = os.path.join(self.tempdir, 'malformed')
+        with open(path, 'w') as f:
+            f.write('{malformed')
+        cache.load(path, 'index')
+        self.assertEqual(0, len(cache))
+
+        with open(path, 'w') as f:
+            json.dump(['index'], f)
+        cache.load(path, 'index')
+        self.assertEqual(0, len(cache))
+
+    def test_get_cache(self):
+        cache = freshness_cache.get_cache(('a', 'c', 'i'), 10)
+        self.assertIs(cache, freshness_cache.get_cache(('a', 'c', 'i'), 20))
+        self.assertEqual(10, cache.max_size)
+        self.assertIsNot(cache, freshness_cache.get_cache(('a', 'c', 'j'), 10))
@@ -1,48 +1,33 @@
+import collections
 import email
+import eventlet
 import hashlib
+import itertools
 import json
 import mock
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
-from swift_metadata_sync import metadata_sync
+from swift.common.internal_client import UnexpectedResponse
+from swift.common.utils import encode_timestamps, Timestamp
+from swift_metadata_sync import checkpoint_store, chunk_sizer, \
+    metadata_sync, rate_limits, reconcile, registry, replicas, stats
 
 
 class TestMetadataSync(unittest.TestCase):
 
-    class FakeFile(object):
-        def __init__(self, content):
-            self.closed = None
-            self.data = content
-
-        def read(self, size=-1):
-            return self.data
-
-        def write(self, data):
-            self.data += data
-
-        def seek(self, pos, flags=None):
-            if pos != 0:
-                raise RuntimeError
-            self.data = ''
-
-        def truncate(self):
-            return
-
-        def __enter__(self):
-            if self.closed:
-                raise RuntimeError
-            self.closed = False
-            return self
-
-        def __exit__(self, *args):
-            self.closed = True
-
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
     @mock.patch(
         'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
     def setUp(self, mock_verify_mapping, mock_es):
-        self.status_dir = '/status/dir'
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
         self.es_hosts = 'es.example.com'
         self.test_index = 'test_index'
         self.test_account = u'test_account'
@@ -58,6 +43,9 @@ class TestMetadataSync(unittest.TestCase):
 
         self.sync = metadata_sync.MetadataSync(self.status_dir,
                                                self.sync_conf)
+        # Tests that create their own MetadataSync objects should not reuse
+        # the client created above.
+        registry.clear('es_client')
 
     @staticmethod
     def compute_id(account, container, obj):
@@ -65,109 +53,194 @@ class TestMetadataSync(unittest.TestCase):
         args = [x.encode('utf-8') if type(x) == unicode else x for x in args]
         return hashlib.sha256('/'.join(args)).hexdigest()
 
+    @staticmethod
+    def fake_bulk(es_conn, failures=()):
+        """Parses the bulk requests sent to the Elasticsearch connection.
+
+        The given failures are returned for the first actions and the rest
+        succeed. The failures may also be a dictionary of document IDs to the
+        list of failures to return for the successive actions for that ID.
+        Failures that are exceptions are raised for the entire request.
+        Returns the list that the submitted actions are recorded into.
+        """
+        submitted_ops = []
+        if not isinstance(failures, dict):
+            failures = list(failures)
+
+        def _bulk(body, **kwargs):
+            items = []
+            error = None
+            lines = iter(body.splitlines())
+            for line in lines:
+                [(op_type, meta)] = json.loads(line).items()
+                op = dict(meta, _op_type=op_type)
+                if op_type != 'delete':
+                    op['_source'] = json.loads(next(lines))
+                submitted_ops.append(op)
+                if isinstance(failures, dict):
+                    op_failures = failures.get(op['_id'])
+                else:
+                    op_failures = failures
+                if op_failures:
+                    failure = op_failures.pop(0)
+                    if isinstance(failure, Exception):
+                        error = failure
+                    items.append(failure)
+                    continue
+                items.append({op_type: {'_id': op['_id'], 'status': 200}})
+            if error:
+                raise error
+            return {'errors': False, 'items': items}
+
+        es_conn.bulk.side_effect = _bulk
+        return submitted_ops
+
+    def assert_bulk_request(self, es_conn):
+        es_conn.bulk.assert_called_once_with(body=mock.ANY)
+        body = es_conn.bulk.call_args[1]['body']
+        # The body is serialized to ASCII, so that it can be sent as is
+        self.assertIsInstance(body, str)
+        self.assertTrue(body.endswith('\n'))
+
     def test_default_parameters(self):
         self.assertFalse(self.sync._parse_json)
         self.assertEqual(None, self.sync._pipeline)
+        self.assertFalse(self.sync._row_only)
+        self.assertEqual(
+            metadata_sync.MetadataSync.DEFAULT_FETCH_CONCURRENCY,
+            self.sync._fetch_concurrency)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_invalid_fetch_concurrency(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        sync_conf = dict(self.sync_conf)
+        sync_conf['metadata_fetch_concurrency'] = 0
+        with self.assertRaises(ValueError):
+            metadata_sync.MetadataSync(self.status_dir, sync_conf)
+
+    def write_status(self, content):
+        os.mkdir(self.sync._status_account_dir)
+        with open(self.sync._status_file, 'w') as f:
+            f.write(content)
 
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_get_last_row_nonexistent(self, exists_mock):
-        exists_mock.return_value = False
+    def read_status(self):
+        with open(self.sync._status_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_get_last_row_nonexistent(self):
         self.assertEqual(0, self.sync.get_last_row('bogus-id'))
 
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_get_last_row_new_dbid(self, exists_mock, open_mock):
-        exists_mock.return_value = True
-        status = {'db_id': {'last_row': 42, 'index': self.test_index}}
-        open_mock.return_value = self.FakeFile(json.dumps(status))
+    def test_get_last_row_new_dbid(self):
+        self.write_status(json.dumps(['db_id', 42, self.test_index]) + '\n')
         self.assertEqual(0, self.sync.get_last_row('bogus-id'))
 
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_get_last_row_correct_dbid(self, exists_mock, open_mock):
-        exists_mock.return_value = True
-        status = {'db_id': {'last_row': 42, 'index': self.test_index}}
-        open_mock.return_value = self.FakeFile(json.dumps(status))
+    def test_get_last_row_correct_dbid(self):
+        self.write_status(json.dumps(['db_id', 42, self.test_index]) + '\n')
         self.assertEqual(42, self.sync.get_last_row('db_id'))
 
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_get_last_row_new_index(self, exists_mock, open_mock):
-        exists_mock.return_value = True
-        status = {'db_id': {'last_row': 42, 'index': 'old-index'}}
-        fake_file = self.FakeFile(json.dumps(status))
-        open_mock.return_value = fake_file
+    def test_get_last_row_new_index(self):
+        self.write_status(json.dumps(['db_id', 42, 'old-index']) + '\n')
         self.assertEqual(0, self.sync.get_last_row('db_id'))
-        self.assertTrue(fake_file.closed)
 
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_get_last_row_malformed_status(self, exists_mock, open_mock):
-        exists_mock.return_value = True
-        open_mock.return_value = self.FakeFile('')
+    def test_get_last_row_malformed_status(self):
+        self.write_status('')
         self.assertEqual(0, self.sync.get_last_row('db_id'))
 
-    @mock.patch('swift_metadata_sync.metadata_sync.os.mkdir')
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_dir_does_not_exist(self, exists_mock, open_mock,
-                                              mkdir_mock):
-        exists_mock.return_value = False
-        fake_file = self.FakeFile('')
-        open_mock.return_value = fake_file
+    def test_get_last_row_legacy_status(self):
+        self.write_status(json.dumps({
+            'db_id': {'last_row': 42, 'index': self.test_index},
+            'old_id': {'last_row': 1, 'index': 'old-index'}}))
+        self.assertEqual(42, self.sync.get_last_row('db_id'))
+        self.assertEqual(0, self.sync.get_last_row('old_id'))
+        # The legacy status file is converted in place
+        self.assertEqual(
+            sorted([['db_id', 42, self.test_index],
+                    ['old_id', 1, 'old-index']]),
+            sorted(self.read_status()))
+
+    def test_save_last_row_dir_does_not_exist(self):
         self.sync.save_last_row(42, 'db-id')
+        self.assertTrue(os.path.isdir(self.sync._status_account_dir))
+        self.assertEqual(42, self.sync.get_last_row('db-id'))
+
+        checkpoint_store.flush_stores()
+        self.assertEqual([['db-id', 42, self.test_index]], self.read_status())
 
-        mkdir_mock.assert_called_once_with(self.sync._status_account_dir)
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
-        self.assertIn('db-id', status)
-        self.assertEqual(42, status['db-id']['last_row'])
-        self.assertEqual(self.test_index, status['db-id']['index'])
-
-    @mock.patch('swift_metadata_sync.metadata_sync.os.mkdir')
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_does_not_exist(self, exists_mock, open_mock,
-                                          mkdir_mock):
-        def fake_exists(path):
-            if path.endswith(self.sync._account):
-                return True
-            return False
-
-        fake_file = self.FakeFile('')
-        exists_mock.side_effect = fake_exists
-        open_mock.return_value = fake_file
+    def test_save_last_row_appends(self):
+        self.sync._checkpoints.flush_rows = 0
         self.sync.save_last_row(42, 'db-id')
+        self.sync.save_last_row(84, 'db-id')
+        self.sync.save_last_row(1, 'other-id')
+
+        self.assertEqual([['db-id', 42, self.test_index],
+                          ['db-id', 84, self.test_index],
+                          ['other-id', 1, self.test_index]],
+                         self.read_status())
+        store = checkpoint_store.CheckpointStore(self.sync._status_file)
+        self.assertEqual(84, store.get('db-id')['last_row'])
+        self.assertEqual(1, store.get('other-id')['last_row'])
+
+    @mock.patch('swift_metadata_sync.checkpoint_store.time.time')
+    def test_save_last_row_batched(self, time_mock):
+        time_mock.return_value = 1000
+        registry.clear('checkpoint_store')
+        sync_conf = dict(self.sync_conf)
+        sync_conf['checkpoint_interval'] = 10
+        sync_conf['checkpoint_rows'] = 100
+        with mock.patch('swift_metadata_sync.metadata_sync.elasticsearch'
+                        '.Elasticsearch') as es_mock, \
+                mock.patch('swift_metadata_sync.metadata_sync.MetadataSync'
+                           '._verify_mapping'):
+            es_mock.return_value.info.return_value = {
+                'version': {'number': '5.4.0'}}
+            self.sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
 
-        mkdir_mock.assert_not_called()
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
-        self.assertIn('db-id', status)
-        self.assertEqual(42, status['db-id']['last_row'])
-        self.assertEqual(self.test_index, status['db-id']['index'])
-
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_new_db_id(self, exists_mock, open_mock):
-        old_status = {'old_id': {'last_row': 1, 'index': self.test_index}}
-        fake_file = self.FakeFile(json.dumps(old_status))
-        exists_mock.return_value = True
-        open_mock.return_value = fake_file
+        self.sync.save_last_row(42, 'db-id')
+        self.assertFalse(os.path.exists(self.sync._status_file))
+        self.assertEqual(42, self.sync.get_last_row('db-id'))
+
+        # The rows threshold triggers a flush
+        self.sync.save_last_row(142, 'db-id')
+        self.assertEqual([['db-id', 142, self.test_index]], self.read_status())
+
+        # Saving the same row is a no-op
+        time_mock.return_value = 1020
+        self.sync.save_last_row(142, 'db-id')
+        self.assertEqual([['db-id', 142, self.test_index]], self.read_status())
+
+        self.sync.save_last_row(143, 'db-id')
+        self.assertEqual([['db-id', 142, self.test_index],
+                          ['db-id', 143, self.test_index]],
+                         self.read_status())
+
+        # Pending updates are flushed once the interval passes
+        self.sync.save_last_row(144, 'db-id')
+        self.assertEqual(2, len(self.read_status()))
+        time_mock.return_value = 1031
+        self.assertEqual(144, self.sync.get_last_row('db-id'))
+        self.assertEqual(['db-id', 144, self.test_index],
+                         self.read_status()[-1])
+
+    def test_save_last_row_new_db_id(self):
+        self.write_status(json.dumps(
+            {'old_id': {'last_row': 1, 'index': self.test_index}}))
 
         self.sync.save_last_row(42, 'new-id')
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
-        self.assertIn('new-id', status)
-        self.assertIn('old_id', status)
-        self.assertEqual(42, status['new-id']['last_row'])
-        self.assertEqual(self.test_index, status['new-id']['index'])
-        self.assertEqual(1, status['old_id']['last_row'])
-        self.assertEqual(self.test_index, status['old_id']['index'])
-
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_delete(self, helpers_mock):
+        checkpoint_store.flush_stores()
+        self.assertEqual(
+            sorted([['old_id', 1, self.test_index],
+                    ['new-id', 42, self.test_index]]),
+            sorted(self.read_status()))
+        self.assertEqual(42, self.sync.get_last_row('new-id'))
+        self.assertEqual(1, self.sync.get_last_row('old_id'))
+
+    def test_handle_delete(self):
         rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
-        helpers_mock.bulk.return_value = (None, [])
+        delete_ops = self.fake_bulk(self.sync._es_conn)
 
         self.sync.handle(rows, mock.Mock())
         expected_delete_ops = [{
@@ -177,20 +250,18 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_delete_ops, delete_ops)
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_delete_errors(self, helpers_mock):
+    def test_handle_delete_errors(self):
         rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
-        helpers_mock.bulk.return_value = (0,
-                                          [{'delete': {'exception': 'blow up!',
-                                                       'status': 500}},
-                                           {'delete': {'_id': 'fake doc id',
-                                                       'status': 500}}])
+        delete_ops = self.fake_bulk(
+            self.sync._es_conn, [{'delete': {'exception': 'blow up!',
+                                             'status': 500}},
+                                 {'delete': {'_id': 'fake doc id',
+                                             'status': 500}}])
 
+        self.sync._failure_retries = 0
         with self.assertRaises(RuntimeError):
             self.sync.handle(rows, mock.Mock())
         expected_delete_ops = [{
@@ -200,15 +271,12 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_delete_ops, delete_ops)
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_delete_skip_404(self, helpers_mock):
+    def test_handle_delete_skip_404(self):
         rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
-        helpers_mock.bulk.return_value = (0, [{
+        delete_ops = self.fake_bulk(self.sync._es_conn, [{
             'delete': {'exception': 'not found',
                        'status': 404,
                        'result': 'not_found'}}])
@@ -221,13 +289,10 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_delete_ops, delete_ops)
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_update_and_new_docs(self, helpers_mock):
+    def test_handle_update_and_new_docs(self):
         def fake_object_meta(account, container, key, headers={}):
             object_id = int(key.split('_')[1])
             x_timestamp = 1000000 - object_id % 2
@@ -250,7 +315,7 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        index_ops = self.fake_bulk(self.sync._es_conn)
 
         self.sync.handle(rows, swift_mock)
 
@@ -271,13 +336,12 @@ class TestMetadataSync(unittest.TestCase):
                 'foo': 'bar'
             }
         } for i in range(1, 10, 2)]
-        helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_ops, index_ops)
+        self.assertEqual({'head': 5}, self.sync._index_counts)
         self.sync._es_conn.mget.assert_called_once_with(
             body=mock.ANY,
             index=self.test_index,
-            refresh=True,
             _source=['x-timestamp'])
         call = self.sync._es_conn.mget.mock_calls[0]
         self.assertIn('body', call[2])
@@ -288,8 +352,7 @@ class TestMetadataSync(unittest.TestCase):
              for i in xrange(10)])
         self.assertEqual(id_set, set(call[2]['body']['ids']))
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_unicode_meta(self, helpers_mock):
+    def test_handle_unicode_meta(self):
         def fake_object_meta(account, container, key, headers={}):
             return {'content-length': 42,
                     'content-type': 'application/x-fake',
@@ -309,7 +372,7 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        index_ops = self.fake_bulk(self.sync._es_conn)
 
         self.sync.handle(rows, swift_mock)
 
@@ -330,19 +393,16 @@ class TestMetadataSync(unittest.TestCase):
                 u'\U0001f435': u'\U0001f44d'
             }
         }]
-        helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_ops, index_ops)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
                     self.test_account, self.test_container, 'object')]},
             index=self.test_index,
-            refresh=True,
             _source=['x-timestamp'])
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_handle_unicode_object_name(self, helpers_mock):
+    def test_handle_unicode_object_name(self):
         def fake_object_meta(account, container, key, headers={}):
             return {'content-length': 42,
                     'content-type': 'application/x-fake',
@@ -361,7 +421,7 @@ class TestMetadataSync(unittest.TestCase):
         self.sync._es_conn.mget.return_value = es_docs
         swift_mock = mock.Mock()
         swift_mock.get_object_metadata.side_effect = fake_object_meta
-        helpers_mock.bulk.return_value = (None, [])
+        index_ops = self.fake_bulk(self.sync._es_conn)
 
         self.sync.handle(rows, swift_mock)
 
@@ -381,15 +441,13 @@ class TestMetadataSync(unittest.TestCase):
                 'x-timestamp': 0,
             }
         }]
-        helpers_mock.bulk.assert_called_once_with(
-            self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(expected_ops, index_ops)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
                     self.test_account, self.test_container, rows[0]['name'])]},
             index=self.test_index,
-            refresh=True,
             _source=['x-timestamp'])
 
     @mock.patch(
@@ -428,6 +486,7 @@ class TestMetadataSync(unittest.TestCase):
         ]
 
         for return_mapping, expected_put_mapping in test_mappings:
+            registry.clear('es_client')
             es_conn = mock.Mock()
             es_conn.info.return_value = {'version': {'number': '2.2.0'}}
             index_conn = mock.Mock()
@@ -498,8 +557,7 @@ class TestMetadataSync(unittest.TestCase):
 
     # For delete and index failures, we should extract the reason if
     # possible or return the status if not possible.
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_delete_errors(self, helpers_mock):
+    def test_delete_errors(self):
         rows = [{'name': 'object_%d' % i,
                  'deleted': True,
                  'created_at': 1000000} for i in range(0, 10)]
@@ -510,7 +568,7 @@ class TestMetadataSync(unittest.TestCase):
             'found': True} for i in range(0, 10)]}
         self.sync._es_conn = mock.Mock()
         self.sync._es_conn.mget.return_value = es_docs
-        helpers_mock.bulk.return_value = (None, [
+        self.fake_bulk(self.sync._es_conn, [
             {'delete': {'status': 400, '_id': 'object_0'}},
             {'delete': {'status': 400, '_id': 'object_1',
              'error': {'root_cause': 'delete failure reason'}}},
@@ -521,6 +579,7 @@ class TestMetadataSync(unittest.TestCase):
                         }}
         ])
 
+        self.sync._failure_retries = 0
         self.sync.logger = mock.Mock()
         with self.assertRaises(RuntimeError):
             self.sync.handle(rows, mock.Mock())
@@ -532,18 +591,17 @@ class TestMetadataSync(unittest.TestCase):
         ]
         self.sync.logger.error.assert_has_calls(expected_error_calls)
 
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
-    def test_index_errors(self, helpers_mock):
+    def test_index_errors(self):
         rows = [{'name': 'object_%d' % i,
                  'deleted': False,
                  'created_at': 1000000} for i in range(0, 10)]
         es_docs = {'docs': [{
-            '_id': '%s/%s/object_%d' % (
-                self.test_account, self.test_container, i),
+            '_id': self.compute_id(
+                self.test_account, self.test_container, 'object_%d' % i),
             'found': False} for i in range(0, 10)]}
         self.sync._es_conn = mock.Mock()
         self.sync._es_conn.mget.return_value = es_docs
-        helpers_mock.bulk.return_value = (None, [
+        self.fake_bulk(self.sync._es_conn, [
             {'index': {'status': 400, '_id': 'object_0'}},
             {'index': {'status': 400, '_id': 'object_1',
              'error': {'root_cause': 'index failure reason'}}},
@@ -559,6 +617,7 @@ class TestMetadataSync(unittest.TestCase):
             'last-modified': email.utils.formatdate(1000000)
         }
 
+        self.sync._failure_retries = 0
         self.sync.logger = mock.Mock()
         with self.assertRaises(RuntimeError):
             self.sync.handle(rows, swift_mock)
@@ -570,11 +629,9 @@ class TestMetadataSync(unittest.TestCase):
         ]
         self.sync.logger.error.assert_has_calls(expected_error_calls)
 
-    @mock.patch(
-        'swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
-    def test_parse_json(self, mock_es, mock_helpers):
+    def test_parse_json(self, mock_es):
         test_cases = [
             ('{"bool": true, "number": 1234, "string": "foo"}', True),
             ('{regular meta}', False)
@@ -595,8 +652,9 @@ class TestMetadataSync(unittest.TestCase):
         sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
 
         for meta, is_json in test_cases:
-            mock_helpers.reset_mock()
-            mock_helpers.bulk.return_value = (None, [])
+            es_mock.bulk.reset_mock()
+            sync._freshness_cache.clear()
+            index_ops = self.fake_bulk(es_mock)
 
             test_meta = dict(obj_meta)
             test_meta['x-object-meta-test'] = meta
@@ -614,26 +672,24 @@ class TestMetadataSync(unittest.TestCase):
             else:
                 expected = meta
 
-            mock_helpers.bulk.assert_called_once_with(
-                es_mock, [
-                    {'_op_type': 'index',
-                     '_id': doc_id,
-                     '_index': self.test_index,
-                     '_type': metadata_sync.MetadataSync.DOC_TYPE,
-                     '_source': {
-                         'test': expected,
-                         'x-timestamp': 0,
-                         'last-modified': 1528323859000,
-                         'x-swift-account': self.test_account,
-                         'x-swift-container': self.test_container,
-                         'x-swift-object': obj}}],
-                raise_on_error=False,
-                raise_on_exception=False)
-
-    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+            self.assert_bulk_request(es_mock)
+            self.assertEqual(
+                [{'_op_type': 'index',
+                  '_id': doc_id,
+                  '_index': self.test_index,
+                  '_type': metadata_sync.MetadataSync.DOC_TYPE,
+                  '_source': {
+                      'test': expected,
+                      'x-timestamp': 0,
+                      'last-modified': 1528323859000,
+                      'x-swift-account': self.test_account,
+                      'x-swift-container': self.test_container,
+                      'x-swift-object': obj}}],
+                index_ops)
+
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
-    def test_set_pipeline(self, es_mock, helpers_mock):
+    def test_set_pipeline(self, es_mock):
         pipeline = 'test-pipeline'
         obj = 'object'
         doc_id = self.compute_id(self.test_account, self.test_container, obj)
@@ -650,13 +706,13 @@ class TestMetadataSync(unittest.TestCase):
             'x-timestamp': 0,
             'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT'
         }
-        helpers_mock.bulk.return_value = (None, [])
+        index_ops = self.fake_bulk(es_mock.return_value)
 
         sync = metadata_sync.MetadataSync(self.status_dir, config)
         sync.handle([{'name': obj, 'deleted': False, 'created_at': 0}],
                     internal_client)
-        helpers_mock.bulk.assert_called_once_with(
-            es_mock.return_value,
+        self.assert_bulk_request(es_mock.return_value)
+        self.assertEqual(
             [{'_op_type': 'index',
               '_id': doc_id,
               '_index': self.test_index,
@@ -669,5 +725,1170 @@ class TestMetadataSync(unittest.TestCase):
                   'x-swift-object': obj,
               },
               'pipeline': 'test-pipeline'}],
-            raise_on_error=False,
-            raise_on_exception=False)
+            index_ops)
+
+    def test_handle_concurrent_metadata_fetch(self):
+        def fake_object_meta(account, container, key, headers={}):
+            object_id = int(key.split('_')[1])
+            # Yield to other green threads, so that later objects may
+            # complete first.
+            eventlet.sleep(0.001 * (10 - object_id))
+            if object_id == 3:
+                raise RuntimeError('HEAD failed')
+            return {'x-timestamp': 0,
+                    'last-modified': email.utils.formatdate(0)}
+
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(10)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        self.sync._fetch_concurrency = 4
+        self.sync.logger = mock.Mock()
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = fake_object_meta
+        index_ops = self.fake_bulk(self.sync._es_conn)
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, swift_mock)
+
+        # The failed HEAD is retried twice
+        self.assertEqual(12, swift_mock.get_object_metadata.call_count)
+        self.assert_bulk_request(self.sync._es_conn)
+        indexed_ids = [op['_id'] for op in index_ops]
+        # The documents are indexed in the order returned by Elasticsearch
+        queried_ids = self.sync._es_conn.mget.mock_calls[0][2]['body']['ids']
+        self.assertEqual(
+            [doc_id for doc_id in queried_ids if doc_id != doc_ids[3]],
+            indexed_ids)
+        self.sync.logger.error.assert_called_once_with(
+            "Failed to retrieve metadata for object_3 (%s): %s" % (
+                doc_ids[3], repr(RuntimeError('HEAD failed'))))
+
+    def test_iter_index_ops_bounded(self):
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 0,
+            'last-modified': email.utils.formatdate(0)}
+        stale_rows = [
+            (self.compute_id(self.test_account, self.test_container,
+                             'object_%d' % i),
+             {'name': 'object_%d' % i, 'deleted': False, 'created_at': 0})
+            for i in xrange(20)]
+        self.sync._fetch_concurrency = 2
+        max_pending = 2 * metadata_sync.MetadataSync.PENDING_OPS_FACTOR
+
+        errors = []
+        ops_iter = self.sync._iter_index_ops(stale_rows, swift_mock, errors)
+        self.assertEqual(0, swift_mock.get_object_metadata.call_count)
+        first_op = next(ops_iter)
+        self.assertEqual(stale_rows[0][0], first_op['_id'])
+        self.assertLessEqual(swift_mock.get_object_metadata.call_count,
+                             max_pending + 1)
+
+        ops = [first_op] + list(ops_iter)
+        self.assertEqual([doc_id for doc_id, _ in stale_rows],
+                         [op['_id'] for op in ops])
+        self.assertEqual([], errors)
+
+    def test_handle_row_only(self):
+        created_at = encode_timestamps(
+            Timestamp(1000000.5), Timestamp(1000000.5), Timestamp(1000001.25))
+        rows = [{'name': 'object',
+                 'deleted': False,
+                 'created_at': created_at,
+                 'size': 42,
+                 'content_type': 'application/x-fake;swift_bytes=1024',
+                 'etag': 'deadbeef; slo_etag=cafebabe'},
+                {'name': u'object\xb0'.encode('utf-8'),
+                 'deleted': False,
+                 'created_at': created_at,
+                 'size': 0,
+                 'content_type': 'text/plain',
+                 'etag': 'd41d8cd98f00b204e9800998ecf8427e'}]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {
+            'docs': [{'_id': doc_id, 'found': False} for doc_id in doc_ids]}
+        self.sync._row_only = True
+        swift_mock = mock.Mock()
+        index_ops = self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, swift_mock)
+
+        swift_mock.get_object_metadata.assert_not_called()
+        expected_ops = [{
+            '_op_type': 'index',
+            '_index': self.test_index,
+            '_type': metadata_sync.MetadataSync.DOC_TYPE,
+            '_id': doc_ids[0],
+            '_source': {
+                'content-length': 42,
+                'content-type': 'application/x-fake',
+                'etag': 'deadbeef',
+                'last-modified': 1000002 * 1000,
+                'x-swift-account': self.test_account,
+                'x-swift-container': self.test_container,
+                'x-swift-object': 'object',
+                'x-timestamp': 1000001250,
+            }
+        }, {
+            '_op_type': 'index',
+            '_index': self.test_index,
+            '_type': metadata_sync.MetadataSync.DOC_TYPE,
+            '_id': doc_ids[1],
+            '_source': {
+                'content-length': 0,
+                'content-type': 'text/plain',
+                'etag': 'd41d8cd98f00b204e9800998ecf8427e',
+                'last-modified': 1000002 * 1000,
+                'x-swift-account': self.test_account,
+                'x-swift-container': self.test_container,
+                'x-swift-object': u'object\xb0',
+                'x-timestamp': 1000001250,
+            }
+        }]
+        self.assertEqual(expected_ops, index_ops)
+        self.assertEqual({'row': 2}, self.sync._index_counts)
+
+    def test_handle_skips_fresh_rows(self):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        # object_0 is current, object_1 is not indexed, object_2 is stale
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[0], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}},
+            {'_id': doc_ids[1], 'found': False},
+            {'_id': doc_ids[2], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000 - 1}}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        index_ops = self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, swift_mock)
+        self.assertEqual(set(doc_ids), set(
+            self.sync._es_conn.mget.call_args[1]['body']['ids']))
+        self.assertEqual(doc_ids[1:], [op['_id'] for op in index_ops])
+
+        # All of the rows are now known to be indexed
+        self.sync._es_conn.mget.reset_mock()
+        swift_mock.reset_mock()
+        del index_ops[:]
+        self.sync.handle(rows, swift_mock)
+        self.sync._es_conn.mget.assert_not_called()
+        swift_mock.get_object_metadata.assert_not_called()
+        self.assertEqual([], index_ops)
+
+        # A new row for the same object must be looked up
+        new_row = dict(rows[0], created_at=1000001)
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[0], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}}]}
+        self.sync.handle([new_row], swift_mock)
+        self.sync._es_conn.mget.assert_called_once_with(
+            body={'ids': [doc_ids[0]]},
+            index=self.test_index,
+            _source=['x-timestamp'])
+        self.assertEqual([doc_ids[0]], [op['_id'] for op in index_ops])
+
+        # Deleting the object evicts it from the cache
+        self.sync.handle([dict(rows[1], deleted=True)], swift_mock)
+        self.assertNotIn(doc_ids[1], self.sync._freshness_cache)
+        self.assertIn(doc_ids[2], self.sync._freshness_cache)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_rate_limits(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        rate_limits.configure({'swift_heads_per_second': 50,
+                               'es_docs_per_second': 1000})
+        sync_conf = dict(self.sync_conf)
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertEqual(50, sync._head_bucket.rate)
+        self.assertEqual(1000, sync._bulk.docs_bucket.rate)
+        self.assertEqual(0, sync._bulk.bytes_bucket.rate)
+
+        # The mappings cannot change the limits of the process
+        other = metadata_sync.MetadataSync(
+            self.status_dir, dict(sync_conf, container=u'other',
+                                  swift_heads_per_second=5))
+        self.assertIs(sync._head_bucket, other._head_bucket)
+        self.assertEqual(50, sync._head_bucket.rate)
+
+        # The limits are shared by the mappings and may be overridden
+        with open(os.path.join(self.status_dir,
+                               rate_limits.RATE_LIMITS_FILE), 'w') as f:
+            json.dump({'swift_heads_per_second': 10,
+                       'es_bytes_per_second': 2**20}, f)
+        other = metadata_sync.MetadataSync(
+            self.status_dir, dict(sync_conf, container=u'other'))
+        self.assertIs(sync._head_bucket, other._head_bucket)
+        self.assertIs(sync._bulk.docs_bucket, other._bulk.docs_bucket)
+        self.assertEqual(10, sync._head_bucket.rate)
+        self.assertEqual(2**20, sync._bulk.bytes_bucket.rate)
+
+        # Each Elasticsearch cluster has its own limits
+        other_cluster = metadata_sync.MetadataSync(
+            self.status_dir, dict(sync_conf, es_hosts='other.example.com'))
+        self.assertIs(sync._head_bucket, other_cluster._head_bucket)
+        self.assertIsNot(sync._bulk.docs_bucket,
+                         other_cluster._bulk.docs_bucket)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shared_batch_size(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        sync._bulk.docs = 10
+        # The handlers of the next pass and of the other mappings of the
+        # cluster start from the reduced size
+        other = metadata_sync.MetadataSync(
+            self.status_dir, dict(self.sync_conf, container=u'other'))
+        self.assertEqual(10, other._bulk.docs)
+        other_cluster = metadata_sync.MetadataSync(
+            self.status_dir,
+            dict(self.sync_conf, es_hosts='other.example.com'))
+        self.assertEqual(metadata_sync.MetadataSync.DEFAULT_BULK_MAX_DOCS,
+                         other_cluster._bulk.docs)
+
+    def test_head_rate_limit(self):
+        sink = mock.Mock()
+        self.sync._stats = stats.Stats(
+            [sink], self.test_account, self.test_container, self.test_index)
+        self.sync._head_bucket = mock.Mock()
+        self.sync._head_bucket.take.return_value = 0.25
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        row = {'name': 'object', 'deleted': False, 'created_at': 1000000}
+
+        self.sync._create_index_op('doc-id', row, swift_mock)
+        self.sync._head_bucket.take.assert_called_once_with(1)
+        self.assertEqual(
+            ['head_wait', 'head'],
+            [args[0] for args, _ in sink.timing.call_args_list])
+        self.assertEqual(0.25, sink.timing.call_args_list[0][0][1])
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_persist_freshness_cache(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        sync_conf = dict(self.sync_conf)
+        sync_conf['persist_freshness_cache'] = True
+        sync = metadata_sync.MetadataSync(status_dir, sync_conf)
+        sync._freshness_cache.update('doc-id', 1000)
+        sync.save_last_row(42, 'db-id')
+        self.assertTrue(os.path.exists(sync._freshness_cache_file))
+
+        registry.clear('freshness_cache')
+        sync = metadata_sync.MetadataSync(status_dir, sync_conf)
+        self.assertEqual(1000, sync._freshness_cache.get('doc-id'))
+        self.assertEqual(42, sync.get_last_row('db-id'))
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_shared_es_client(self, es_mock, index_mock):
+        es_mock.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        index_mock.return_value.get_mapping.return_value = {}
+
+        syncs = []
+        for container in ['c1', 'c2']:
+            for index in ['index1', 'index2']:
+                sync_conf = dict(self.sync_conf, container=container,
+                                 index=index)
+                syncs.append(
+                    metadata_sync.MetadataSync(self.status_dir, sync_conf))
+
+        es_mock.assert_called_once_with(
+            self.es_hosts,
+            maxsize=metadata_sync.MetadataSync.DEFAULT_ES_POOL_SIZE)
+        es_mock.return_value.info.assert_called_once_with()
+        self.assertEqual(
+            [mock.call(index='index1',
+                       doc_type=metadata_sync.MetadataSync.DOC_TYPE),
+             mock.call(index='index2',
+                       doc_type=metadata_sync.MetadataSync.DOC_TYPE)],
+            index_mock.return_value.get_mapping.mock_calls)
+        for sync in syncs:
+            self.assertIs(es_mock.return_value, sync._es_conn)
+
+        # A different pool size results in a separate client
+        sync_conf = dict(self.sync_conf, es_pool_size=50)
+        metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        es_mock.assert_called_with(self.es_hosts, maxsize=50)
+        self.assertEqual(2, es_mock.call_count)
+
+    def test_handle_retries_failed_rows(self):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i % 2 == 1,
+                 'created_at': 1000000} for i in xrange(4)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        # The first delete and the first index operation fail once
+        submitted_ops = self.fake_bulk(self.sync._es_conn, {
+            doc_ids[1]: [{'delete': {'_id': doc_ids[1], 'status': 500}}],
+            doc_ids[0]: [{'index': {'_id': doc_ids[0], 'status': 500}}]})
+
+        self.sync.handle(rows, swift_mock)
+
+        self.assertEqual(
+            [('delete', doc_ids[1]), ('delete', doc_ids[3])],
+            [(op['_op_type'], op['_id']) for op in submitted_ops[:2]])
+        self.assertEqual(
+            set([doc_ids[0], doc_ids[2]]),
+            set([op['_id'] for op in submitted_ops[2:4]]))
+        # Only the failed rows are retried
+        self.assertEqual(
+            [('delete', doc_ids[1]), ('index', doc_ids[0])],
+            [(op['_op_type'], op['_id']) for op in submitted_ops[4:]])
+        self.assertEqual([doc_ids[0]], self.sync._es_conn.mget.mock_calls[
+            -1][2]['body']['ids'])
+
+    def test_handle_parks_failed_rows(self):
+        rows = [{'name': u'object_\xb0'.encode('utf-8'),
+                 'deleted': False,
+                 'created_at': 1000000},
+                {'name': 'object_1',
+                 'deleted': False,
+                 'created_at': 1000000}]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        failure = {'index': {'_id': doc_ids[0], 'status': 400,
+                             'error': {'root_cause': 'mapping failure'}}}
+        self.fake_bulk(self.sync._es_conn, {doc_ids[0]: [failure] * 3})
+        self.sync._dead_letter = True
+        self.sync.logger = mock.Mock()
+
+        self.sync.handle(rows, swift_mock)
+
+        self.assertEqual(4, swift_mock.get_object_metadata.call_count)
+        with open(self.sync._dead_letter_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(1, len(records))
+        self.assertEqual(doc_ids[0], records[0]['doc_id'])
+        self.assertEqual(self.test_index, records[0]['index'])
+        self.assertEqual({'name': u'object_\xb0',
+                          'deleted': False,
+                          'created_at': 1000000}, records[0]['row'])
+        self.assertEqual('%s: mapping failure' % doc_ids[0],
+                         records[0]['error'])
+        self.sync.logger.error.assert_has_calls([
+            mock.call('%s: mapping failure' % doc_ids[0]),
+            mock.call('Recorded 1 failed rows in %s' %
+                      self.sync._dead_letter_file)])
+
+    def test_handle_does_not_park_cluster_errors(self):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in range(4)]
+        doc_id = self.compute_id(
+            self.test_account, self.test_container, rows[0]['name'])
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        self.sync._dead_letter = True
+        self.sync._bulk.max_retries = 0
+        self.sync.logger = mock.Mock()
+
+        def _mget(body, **kwargs):
+            return {'docs': [{'_id': body_id, 'found': False}
+                             for body_id in body['ids']]}
+
+        def _mget_error(body, **kwargs):
+            docs = _mget(body)['docs']
+            docs[0] = {'_id': docs[0]['_id'],
+                       'error': {'type': 'no_shard_available'}}
+            return {'docs': docs}
+
+        unavailable = {'index': {
+            '_id': doc_id, 'status': 503,
+            'error': {'root_cause': 'unavailable_shards_exception'}}}
+        rejected = {'index': {'_id': doc_id, 'status': 429}}
+        for failure, mget in [(unavailable, _mget), (rejected, _mget),
+                              (None, _mget_error)]:
+            self.sync._es_conn = mock.Mock()
+            self.sync._es_conn.mget.side_effect = mget
+            self.fake_bulk(self.sync._es_conn,
+                           {doc_id: [failure] * 3} if failure else {})
+            with self.assertRaises(RuntimeError):
+                self.sync.handle(rows, swift_mock)
+            self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+
+    def test_handle_does_not_park_transport_errors(self):
+        rows = [{'name': 'object', 'deleted': True}]
+        error = metadata_sync.elasticsearch.ConnectionError(
+            'N/A', 'connection refused', None)
+        self.fake_bulk(self.sync._es_conn, [
+            {'delete': {'exception': error, 'status': 'N/A'}}] * 3)
+        self.sync._dead_letter = True
+        self.sync.logger = mock.Mock()
+
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
+        self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+        self.sync.logger.error.assert_called_once_with(str(error))
+
+    def test_handle_fetches_during_bulk_requests(self):
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in range(30)]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        self.fake_bulk(self.sync._es_conn)
+        _bulk = self.sync._es_conn.bulk.side_effect
+        self.sync._bulk.max_docs = 10
+        heads = []
+        heads_during_bulk = []
+
+        def _slow_bulk(body, **kwargs):
+            # The request blocks its native thread, rather than the process
+            heads_made = len(heads)
+            time.sleep(0.05)
+            heads_during_bulk.append(len(heads) - heads_made)
+            return _bulk(body, **kwargs)
+
+        def _head(account, container, name, headers=None):
+            eventlet.sleep(0.001)
+            heads.append(name)
+            return {'x-timestamp': 1000000,
+                    'last-modified': email.utils.formatdate(1000000)}
+
+        self.sync._es_conn.bulk.side_effect = _slow_bulk
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = _head
+        self.sync.handle(rows, swift_mock)
+
+        self.assertEqual(30, len(heads))
+        self.assertEqual(3, len(heads_during_bulk))
+        # The HEADs of the next requests are made while the first is pending
+        self.assertTrue(heads_during_bulk[0] > 0)
+
+    def _handle_head_failures(self, statuses):
+        """Handles a row per status, whose HEAD fails with the status.
+
+        Rows with a None status are indexed.
+        """
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in range(len(statuses))]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        self.fake_bulk(self.sync._es_conn)
+        meta = {'x-timestamp': 1000000,
+                'last-modified': email.utils.formatdate(1000000)}
+
+        def _head(account, container, name, headers=None):
+            status = statuses[int(name.split('_')[1])]
+            if status is None:
+                return meta
+            raise UnexpectedResponse('Unexpected response: %d' % status,
+                                     mock.Mock(status_int=status))
+
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.side_effect = _head
+        self.sync._dead_letter = True
+        self.sync.logger = mock.Mock()
+        self.sync.handle(rows, swift_mock)
+        return swift_mock
+
+    def test_handle_skips_missing_objects(self):
+        self.sync._skip_missing_objects = True
+        swift_mock = self._handle_head_failures([None, 404, None])
+        self.assertEqual(3, swift_mock.get_object_metadata.call_count)
+        self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+        # Other errors still fail the chunk
+        with self.assertRaises(RuntimeError):
+            self._handle_head_failures([None, 503, None])
+
+    def test_handle_does_not_park_swift_outage(self):
+        with self.assertRaises(RuntimeError):
+            self._handle_head_failures([503] * 4)
+        self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+
+        # Server errors are not specific to the row either
+        with self.assertRaises(RuntimeError):
+            self._handle_head_failures([None, 503, None])
+        self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+
+    def test_handle_does_not_park_whole_chunk(self):
+        with self.assertRaises(RuntimeError):
+            self._handle_head_failures([404, 404])
+        self.assertFalse(os.path.exists(self.sync._dead_letter_file))
+
+    def test_handle_parks_missing_objects(self):
+        swift_mock = self._handle_head_failures([None, 404, None])
+        # The failed row is retried twice before being parked
+        self.assertEqual(5, swift_mock.get_object_metadata.call_count)
+        with open(self.sync._dead_letter_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(['object_1'],
+                         [record['row']['name'] for record in records])
+
+    def test_handle_records_stats(self):
+        sink = mock.Mock()
+        self.sync._stats = stats.Stats(
+            [sink], self.test_account, self.test_container, self.test_index)
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i == 3,
+                 'created_at': 1000000} for i in xrange(4)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        # object_0 is current, object_1 is not indexed, object_2 is stale
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[0], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}},
+            {'_id': doc_ids[1], 'found': False},
+            {'_id': doc_ids[2], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000 - 1}}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, swift_mock)
+
+        labels = self.sync._stats.labels
+        counters = collections.Counter()
+        for args, _ in sink.incr.call_args_list:
+            counters[args[0]] += args[1]
+        # The deletes are sent in the same request as the index operations
+        self.assert_bulk_request(self.sync._es_conn)
+        index_bytes = len(self.sync._es_conn.bulk.call_args[1]['body'])
+        self.assertEqual({'rows': 4,
+                          'deletes': 1,
+                          'mget_hits': 2,
+                          'mget_misses': 1,
+                          'stale_rows': 2,
+                          'heads': 2,
+                          'indexed': 2,
+                          'index_bytes': index_bytes}, counters)
+        self.assertTrue(all(args[2] == labels
+                            for args, _ in sink.incr.call_args_list))
+        self.assertEqual(
+            ['mget', 'head', 'head', 'index', 'handle'],
+            [args[0] for args, _ in sink.timing.call_args_list])
+        sink.maybe_flush.assert_called_once_with()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    def test_handle_scheduled(self, time_mock):
+        time_mock.return_value = 1010
+        sink = mock.Mock()
+        self.sync._stats = stats.Stats(
+            [sink], self.test_account, self.test_container, self.test_index)
+        self.sync._max_rows_per_cycle = 2
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': 1,
+                 'ROWID': 11 + i,
+                 'created_at': Timestamp(1000 + i).internal}
+                for i in xrange(3)]
+        self.sync._es_conn = mock.Mock()
+        submitted_ops = self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, mock.Mock())
+        self.sync.save_last_row(13, 'db-id')
+
+        # The last row is left for the next pass
+        self.assertEqual(2, len(submitted_ops))
+        self.assertEqual(12, self.sync.get_last_row('db-id'))
+        self.assertEqual(
+            [mock.call('lag_rows', 3, self.sync._stats.labels),
+             mock.call('lag_seconds', 10.0, self.sync._stats.labels)],
+            sink.gauge.mock_calls[:2])
+        sink.incr.assert_any_call('postponed_rows', 1,
+                                  self.sync._stats.labels)
+
+        # Once caught up, the rows are no longer limited
+        del submitted_ops[:]
+        self.sync.handle(rows[2:], mock.Mock())
+        self.sync.save_last_row(13, 'db-id')
+        self.assertEqual(1, len(submitted_ops))
+        self.assertEqual(13, self.sync.get_last_row('db-id'))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.replicas.find_broker')
+    def test_handle_adaptive_chunks(self, find_broker_mock):
+        self.sync._chunk_sizer = chunk_sizer.get_sizer(
+            (self.test_account, self.test_container, self.test_index),
+            1, 100, 5, 0)
+        self.sync._devices = '/srv/node'
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': 1,
+                 'ROWID': 11 + i,
+                 'created_at': Timestamp(1000 + i).internal}
+                for i in xrange(5)]
+        find_broker_mock.return_value.get_items_since.return_value = rows[3:]
+        self.sync._es_conn = mock.Mock()
+        submitted_ops = self.fake_bulk(self.sync._es_conn)
+
+        # The first chunk is handled as is and measured
+        self.assertEqual(0, self.sync.get_last_row('db-id'))
+        self.sync.handle(rows[:3], mock.Mock())
+        self.sync.save_last_row(13, 'db-id')
+        self.assertEqual(3, len(submitted_ops))
+        self.assertEqual(100, self.sync._chunk_sizer.size)
+
+        # Larger chunks are completed with the rows of the database
+        del submitted_ops[:]
+        self.sync.handle(rows[:3], mock.Mock())
+        self.sync.save_last_row(13, 'db-id')
+        self.assertEqual(5, len(submitted_ops))
+        find_broker_mock.return_value.get_items_since.assert_called_once_with(
+            13, 97)
+        self.assertEqual(15, self.sync.get_last_row('db-id'))
+
+        # Smaller chunks leave the rest of the rows for the next pass
+        self.sync._chunk_sizer.size = 2
+        del submitted_ops[:]
+        self.sync.handle(rows, mock.Mock())
+        self.sync.save_last_row(15, 'db-id')
+        self.assertEqual(2, len(submitted_ops))
+        self.assertEqual(12, self.sync.get_last_row('db-id'))
+        # The quick chunk grew the size again
+        self.assertEqual(51, self.sync._chunk_sizer.size)
+
+        # The size is restored from the checkpoint after a restart
+        self.sync._checkpoints.flush()
+        registry.clear()
+        self.sync._checkpoints = checkpoint_store.get_store(
+            self.sync._status_file)
+        self.sync._chunk_sizer = chunk_sizer.get_sizer(
+            (self.test_account, self.test_container, self.test_index),
+            1, 100, 5, 0)
+        self.assertIsNone(self.sync._chunk_sizer.size)
+        self.assertEqual(12, self.sync.get_last_row('db-id'))
+        self.assertEqual(51, self.sync._chunk_sizer.size)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.replicas.find_broker')
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    def test_get_lag(self, time_mock, find_broker_mock):
+        time_mock.return_value = 1000
+        rows = [{'name': 'object', 'ROWID': 5,
+                 'created_at': Timestamp(1001).internal}]
+        self.assertEqual((1, 0), self.sync._get_lag(rows))
+        find_broker_mock.assert_not_called()
+
+        self.sync._devices = '/srv/node'
+        find_broker_mock.return_value.get_max_row.return_value = 104
+        time_mock.return_value = 1031
+        self.assertEqual((100, 30), self.sync._get_lag(rows))
+        find_broker_mock.assert_called_once_with(
+            '/srv/node', '/etc/swift', self.test_account, self.test_container)
+
+        # Without the database, the rows are assumed to be the last ones
+        find_broker_mock.return_value = None
+        self.sync._broker = None
+        self.assertEqual((1, 30), self.sync._get_lag(rows))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    def test_handle_replica_partitioning(self, time_mock):
+        self.sync._replica_partition = replicas.ReplicaPartition(0, 3)
+        self.sync._verification_lag = 300
+        names = []
+        primary_names = []
+        i = 0
+        # Find objects that belong to this replica and to another replica
+        while len(names) < 2 or len(primary_names) < 1:
+            name = 'object_%d' % i
+            doc_id = self.compute_id(
+                self.test_account, self.test_container, name)
+            if self.sync._replica_partition.is_primary(doc_id):
+                if not primary_names:
+                    primary_names.append(name)
+            elif len(names) < 2:
+                names.append(name)
+            i += 1
+        rows = [
+            {'name': primary_names[0], 'deleted': True,
+             'created_at': 1000000, 'ROWID': 1},
+            # Even the old rows of the other replicas are deferred
+            {'name': names[0], 'deleted': True,
+             'created_at': 1000000 - 300, 'ROWID': 2},
+            {'name': names[1], 'deleted': True,
+             'created_at': 1000000, 'ROWID': 3},
+        ]
+        self.sync._es_conn = mock.Mock()
+        ops = self.fake_bulk(self.sync._es_conn)
+        time_mock.return_value = 1000000
+
+        self.sync.handle(rows, mock.Mock())
+        self.assertEqual(
+            [self.compute_id(self.test_account, self.test_container, obj)
+             for obj in primary_names[:1]],
+            [op['_id'] for op in ops])
+        self.assertEqual(2, len(self.sync._deferred_rows))
+
+        # The checkpoint is held back to the oldest deferred row
+        self.sync.save_last_row(3, 'db-id')
+        self.assertEqual(1, self.sync._checkpoints.get('db-id')['last_row'])
+        self.assertEqual(3, self.sync.get_last_row('db-id'))
+
+        # The deferred row is retried if it fails to be verified
+        del ops[:]
+        time_mock.return_value = 1000300
+        self.sync._es_conn.bulk.side_effect = RuntimeError('oops')
+        with self.assertRaises(RuntimeError):
+            self.sync.handle([dict(rows[0], ROWID=4)], mock.Mock())
+        self.assertEqual(2, len(self.sync._deferred_rows))
+
+        ops = self.fake_bulk(self.sync._es_conn)
+        self.sync.handle([dict(rows[0], ROWID=4)], mock.Mock())
+        self.assertEqual(
+            [self.compute_id(self.test_account, self.test_container, obj)
+             for obj in names + primary_names[:1]],
+            [op['_id'] for op in ops])
+        self.assertEqual(0, len(self.sync._deferred_rows))
+        self.sync.save_last_row(4, 'db-id')
+        self.assertEqual(4, self.sync._checkpoints.get('db-id')['last_row'])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    def test_handle_defers_old_replica_rows(self, time_mock):
+        time_mock.return_value = 1000000
+        self.sync._replica_partition = replicas.ReplicaPartition(0, 3)
+        self.sync._verification_lag = 300
+        self.sync._max_deferred_rows = 150
+        # A backfill of old rows, none of which are indexed yet
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000,
+                 'ROWID': i + 1} for i in xrange(300)]
+        primary = [self.sync._replica_partition.is_primary(
+            self.sync._get_document_id(row)) for row in rows]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.side_effect = lambda body, **kwargs: {
+            'docs': [{'_id': doc_id, 'found': False}
+                     for doc_id in body['ids']]}
+        self.fake_bulk(self.sync._es_conn)
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000,
+            'last-modified': email.utils.formatdate(1000)}
+
+        self.sync.handle(rows, swift_mock)
+        # The rows of the other replicas wait for the verification lag, up to
+        # max_deferred_rows, and the rest of the chunk is left for later
+        self.assertEqual(150, len(self.sync._deferred_rows))
+        last_row = self.sync._handled_row
+        self.assertEqual(150, primary[:last_row].count(False))
+        self.assertEqual(primary[:last_row].count(True),
+                         swift_mock.get_object_metadata.call_count)
+        self.sync.save_last_row(300, 'db-id')
+        self.assertEqual(last_row, self.sync.get_last_row('db-id'))
+        self.sync._es_conn.search.assert_not_called()
+
+    def test_handle_verifies_replica_rows(self):
+        self.sync._replica_partition = mock.Mock()
+        self.sync._replica_partition.is_primary.return_value = False
+        self.sync._verification_lag = 0
+        self.sync._verify_batch_size = 2
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': False,
+                 'created_at': 1000000} for i in xrange(3)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        # object_0 is current, object_1 is not indexed, object_2 is stale
+        indexed = {doc_ids[0]: 1000000 * 1000,
+                   doc_ids[2]: 1000000 * 1000 - 1}
+
+        def _search(index, doc_type, body):
+            return {'hits': {'hits': [
+                {'_id': doc_id, 'fields': {'x-timestamp': [indexed[doc_id]]}}
+                for doc_id in body['query']['terms']['_id']
+                if doc_id in indexed]}}
+
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.search.side_effect = _search
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        index_ops = self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, swift_mock)
+        self.sync._es_conn.mget.assert_not_called()
+        self.assertEqual(2, self.sync._es_conn.search.call_count)
+        searched_ids = []
+        for call in self.sync._es_conn.search.mock_calls:
+            body = call[2]['body']
+            self.assertEqual(self.test_index, call[2]['index'])
+            self.assertFalse(body['_source'])
+            # The server is 2.x, which does not support docvalue_fields
+            self.assertEqual(['x-timestamp'], body['fielddata_fields'])
+            self.assertEqual(len(body['query']['terms']['_id']),
+                             body['size'])
+            searched_ids.extend(body['query']['terms']['_id'])
+        self.assertEqual(sorted(doc_ids), sorted(searched_ids))
+        self.assertEqual(sorted(doc_ids[1:]),
+                         sorted(op['_id'] for op in index_ops))
+        self.assertTrue(self.sync._freshness_cache.is_fresh(
+            doc_ids[0], 1000000 * 1000))
+
+    def test_iter_indexed_objects(self):
+        self.sync._server_version = metadata_sync.StrictVersion('5.4.0')
+        pages = [
+            [{'_id': 'a', 'sort': [u'a'], 'fields': {'x-timestamp': [1]}},
+             {'_id': 'b', 'sort': [u'\u00e9'],
+              'fields': {'x-timestamp': [2]}}],
+            [{'_id': 'c', 'sort': [u'z'], 'fields': {'x-timestamp': [3]}}]]
+        bodies = []
+
+        def _search(index, doc_type, body):
+            bodies.append(dict(body))
+            return {'hits': {'hits': pages.pop(0)}}
+
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.search.side_effect = _search
+        self.assertEqual(
+            [('a', 1), ('\xc3\xa9', 2), ('z', 3)],
+            list(self.sync.iter_indexed_objects(2)))
+        self.assertEqual(2, len(bodies))
+        self.assertEqual([{'x-swift-object.keyword': 'asc'}],
+                         bodies[0]['sort'])
+        self.assertEqual(
+            [{'term': {'x-swift-account.keyword': self.test_account}},
+             {'term': {'x-swift-container.keyword': self.test_container}}],
+            bodies[0]['query']['bool']['filter'])
+        self.assertNotIn('search_after', bodies[0])
+        self.assertEqual([u'\u00e9'], bodies[1]['search_after'])
+
+    def test_iter_indexed_objects_2x(self):
+        with self.assertRaises(RuntimeError):
+            list(self.sync.iter_indexed_objects(10))
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shadow_index(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        mock_es.return_value.indices.get_alias.return_value = {
+            self.test_index: {'aliases': {'alias': {}}}}
+        sync_conf = dict(self.sync_conf, index='new-index', alias='alias',
+                         shadow_of=self.test_index)
+        shadow = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.sync.save_last_row(10, 'db-id')
+
+        # The shadow index has its own cursor
+        self.assertEqual(0, shadow.get_last_row('db-id'))
+        shadow.save_last_row(5, 'db-id')
+        self.assertEqual(5, shadow.get_last_row('db-id'))
+        self.assertEqual(10, self.sync.get_last_row('db-id'))
+        mock_es.return_value.indices.update_aliases.assert_not_called()
+
+        # The alias is moved once the shadow index catches up
+        shadow.save_last_row(10, 'db-id')
+        mock_es.return_value.indices.update_aliases.assert_called_once_with(
+            body={'actions': [
+                {'remove': {'index': self.test_index, 'alias': 'alias'}},
+                {'add': {'index': 'new-index', 'alias': 'alias'}}]})
+        shadow.save_last_row(11, 'db-id')
+        self.assertEqual(
+            1, mock_es.return_value.indices.update_aliases.call_count)
+
+        checkpoint_store.flush_stores()
+        self.assertEqual(
+            sorted([['db-id', 10, self.test_index],
+                    ['db-id/new-index', 11, 'new-index']]),
+            sorted(self.read_status()))
+
+        # Once the mapping is switched to the new index, it continues from
+        # the shadow index's cursor
+        sync_conf = dict(self.sync_conf, index='new-index')
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertEqual(11, sync.get_last_row('db-id'))
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shadow_index_alias_per_account(self, mock_verify_mapping,
+                                            mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        sync_conf = dict(self.sync_conf, index='new-index', alias='alias',
+                         shadow_of=self.test_index)
+        # The containers of the account would each move the alias
+        with self.assertRaises(ValueError):
+            metadata_sync.MetadataSync(self.status_dir, sync_conf,
+                                       per_account=True)
+        del sync_conf['alias']
+        metadata_sync.MetadataSync(self.status_dir, sync_conf,
+                                   per_account=True)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shadow_index_reindex(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        mock_es.return_value.reindex.return_value = {'task': 'node:1'}
+        mock_es.return_value.tasks.get.return_value = {'completed': True}
+        sync_conf = dict(self.sync_conf, index='new-index', reindex=True,
+                         shadow_of=self.test_index)
+        shadow = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.sync.save_last_row(10, 'db-id')
+
+        # The shadow index is synced from the row the live index was at
+        self.assertEqual(10, shadow.get_last_row('db-id'))
+        body = mock_es.return_value.reindex.call_args[1]['body']
+        self.assertEqual({'index': 'new-index'}, body['dest'])
+        self.assertEqual(self.test_index, body['source']['index'])
+        self.assertEqual(shadow._container_query(), body['source']['query'])
+        self.assertEqual(10, shadow.get_last_row('db-id'))
+        self.assertEqual(1, mock_es.return_value.reindex.call_count)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shadow_index_reindex_in_progress(self, mock_verify_mapping,
+                                              mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        mock_es.return_value.reindex.return_value = {'task': 'node:1'}
+        mock_es.return_value.tasks.get.return_value = {'completed': False}
+        sync_conf = dict(self.sync_conf, index='new-index', reindex=True,
+                         shadow_of=self.test_index)
+        shadow = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.sync.save_last_row(10, 'db-id')
+        rows = [{'name': 'object', 'deleted': True, 'created_at': 1000000,
+                 'ROWID': 11}]
+
+        # The pass does not wait for the task and skips the shadow index
+        self.assertEqual(10, shadow.get_last_row('db-id'))
+        shadow._es_conn = mock.Mock()
+        shadow.handle(rows, mock.Mock())
+        shadow.save_last_row(11, 'db-id')
+        shadow._es_conn.bulk.assert_not_called()
+        self.assertIsNone(shadow._checkpoints.get('db-id/new-index'))
+
+        # The next pass resumes from the row recorded when the task started
+        self.sync.save_last_row(20, 'db-id')
+        mock_es.return_value.tasks.get.return_value = {'completed': True}
+        self.assertEqual(10, shadow.get_last_row('db-id'))
+        self.assertEqual(1, mock_es.return_value.reindex.call_count)
+        self.assertEqual(2, mock_es.return_value.tasks.get.call_count)
+        self.fake_bulk(shadow._es_conn)
+        shadow.handle(rows, mock.Mock())
+        shadow._es_conn.bulk.assert_called_once_with(body=mock.ANY)
+        shadow.save_last_row(11, 'db-id')
+        self.assertEqual(11, shadow.get_last_row('db-id'))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    def test_handle_throttles_shadow_index(self, time_mock):
+        self.sync._shadow = mock.Mock()
+        self.sync._es_conn = mock.Mock()
+        self.fake_bulk(self.sync._es_conn)
+        time_mock.side_effect = itertools.count(1000)
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': True,
+                 'created_at': 1000000} for i in xrange(3)]
+        self.sync.handle(rows, mock.Mock())
+        self.sync._shadow.throttle.assert_called_once_with(3, mock.ANY)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_shadow_index_freshness_cache_file(self, mock_verify_mapping,
+                                               mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        sync_conf = dict(self.sync_conf, index='new-index',
+                         shadow_of=self.test_index)
+        shadow = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertNotEqual(self.sync._freshness_cache_file,
+                            shadow._freshness_cache_file)
+
+    def test_handle_coalesces_deletes(self):
+        rows = [{'name': 'object_0', 'deleted': True, 'created_at': 1000000},
+                {'name': 'object_1', 'deleted': False, 'created_at': 1000000},
+                # Superseded by the next row for the same object
+                {'name': 'object_2', 'deleted': False, 'created_at': 1000000},
+                {'name': 'object_2', 'deleted': True, 'created_at': 1000001}]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, 'object_%d' % i)
+            for i in range(3)]
+        self.sync._es_conn = mock.Mock()
+        self.sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[1], 'found': False}]}
+        swift_mock = mock.Mock()
+        swift_mock.get_object_metadata.return_value = {
+            'x-timestamp': 1000000,
+            'last-modified': email.utils.formatdate(1000000)}
+        ops = self.fake_bulk(self.sync._es_conn)
+
+        self.sync.handle(rows, swift_mock)
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(
+            [('delete', doc_ids[0]), ('delete', doc_ids[2]),
+             ('index', doc_ids[1])],
+            [(op['_op_type'], op['_id']) for op in ops])
+        self.assertEqual([doc_ids[1]], self.sync._es_conn.mget.call_args[1][
+            'body']['ids'])
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_delete_filter(self, mock_verify_mapping, mock_es):
+        mock_es.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        # object_0 is indexed
+        mock_es.return_value.search.return_value = {'hits': {'hits': [
+            {'_id': 'id', 'sort': [u'object_0'],
+             'fields': {'x-timestamp': [1000]}}]}}
+        sync_conf = dict(self.sync_conf, delete_filter=True,
+                         delete_filter_capacity=100)
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        sync.save_last_row(10, 'db-id')
+        # The filter is seeded from the index on first use
+        self.assertEqual(10, sync.get_last_row('db-id'))
+        self.assertTrue(os.path.exists(sync._delete_filter_file))
+        mock_es.return_value.search.reset_mock()
+
+        rows = [{'name': 'object_%d' % i, 'deleted': True,
+                 'created_at': 1000000} for i in range(3)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        sink = mock.Mock()
+        sync._stats = stats.Stats(
+            [sink], self.test_account, self.test_container, self.test_index)
+        sync._es_conn.mget.return_value = {'docs': [
+            {'_id': doc_ids[2], 'found': True,
+             '_source': {'x-timestamp': 1000000 * 1000}}]}
+        ops = self.fake_bulk(sync._es_conn)
+        sync.handle(rows[1:2] + [dict(rows[2], deleted=False)], mock.Mock())
+        del ops[:]
+        sync.handle(rows, mock.Mock())
+        # object_1 was never indexed, unlike object_0 and object_2
+        self.assertEqual([doc_ids[0], doc_ids[2]], [op['_id'] for op in ops])
+        sink.incr.assert_any_call(
+            'skipped_deletes', 1, sync._stats.labels)
+
+        # The rows past the saved filter are processed again after a restart
+        sync.save_last_row(20, 'db-id')
+        self.assertEqual(20, sync.get_last_row('db-id'))
+        registry.clear('delete_filter')
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertEqual(10, sync.get_last_row('db-id'))
+        mock_es.return_value.search.assert_not_called()
+        self.assertNotIn(doc_ids[1], sync._delete_filter)
+        self.assertIn(doc_ids[0], sync._delete_filter)
+
+    def test_handle_versioned_writes(self):
+        self.sync._versioned_writes = True
+        self.sync._row_only = True
+        self.sync._failure_retries = 0
+        rows = [{'name': 'object_%d' % i,
+                 'deleted': i == 2,
+                 'created_at': '1000000.12345',
+                 'size': 1,
+                 'content_type': 'text/plain',
+                 'etag': 'etag'} for i in xrange(3)]
+        doc_ids = [self.compute_id(
+            self.test_account, self.test_container, row['name'])
+            for row in rows]
+        self.sync._es_conn = mock.Mock()
+        # The documents of object_1 and object_2 are newer than the rows
+        ops = self.fake_bulk(self.sync._es_conn, {
+            doc_ids[1]: [{'index': {'_id': doc_ids[1], 'status': 409}}],
+            doc_ids[2]: [{'delete': {'_id': doc_ids[2], 'status': 409}}]})
+
+        self.sync.handle(rows, mock.Mock())
+        self.sync._es_conn.mget.assert_not_called()
+        self.assert_bulk_request(self.sync._es_conn)
+        self.assertEqual(
+            [('delete', doc_ids[2]), ('index', doc_ids[0]),
+             ('index', doc_ids[1])],
+            [(op['_op_type'], op['_id']) for op in ops])
+        self.assertTrue(all(op['_version'] == 1000000123 and
+                            op['_version_type'] == 'external'
+                            for op in ops))
+        # The conflicting rows are known to be indexed
+        self.assertTrue(self.sync._freshness_cache.is_fresh(
+            doc_ids[1], 1000000123))
+
+    def test_handle_versioned_reconcile_orphans(self):
+        self.sync._versioned_writes = True
+        self.sync._failure_retries = 0
+        doc_id = self.compute_id(
+            self.test_account, self.test_container, 'orphan')
+        self.sync._es_conn = mock.Mock()
+        ops = self.fake_bulk(self.sync._es_conn)
+        [(reason, row)] = reconcile.diff([], [('orphan', 1000000123)],
+                                         2000000000)
+        self.assertEqual('orphaned', reason)
+
+        self.sync.handle([row], mock.Mock())
+        self.assertEqual([('delete', doc_id)],
+                         [(op['_op_type'], op['_id']) for op in ops])
+        # The version must be greater than the one of the document, or
+        # Elasticsearch rejects the deletion as a conflict.
+        self.assertEqual(1000000124, ops[0]['_version'])
+        self.assertEqual('external', ops[0]['_version_type'])
+
+    def test_handle_version_conflicts_without_versioned_writes(self):
+        self.sync._failure_retries = 0
+        rows = [{'name': 'object_0', 'deleted': True}]
+        self.fake_bulk(self.sync._es_conn, [
+            {'delete': {'_id': 'object_0', 'status': 409}}])
+        with self.assertRaises(RuntimeError):
+            self.sync.handle(rows, mock.Mock())
@@ -0,0 +1,96 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import rate_limits, registry
+
+
+class TestTokenBucket(unittest.TestCase):
+    @mock.patch('swift_metadata_sync.rate_limits.eventlet.sleep')
+    @mock.patch('swift_metadata_sync.rate_limits.time.time')
+    def test_take(self, time_mock, sleep_mock):
+        time_mock.return_value = 100
+        bucket = rate_limits.TokenBucket(10)
+        # A second's worth of tokens is available right away
+        self.assertEqual(0, bucket.take(10))
+        self.assertEqual(0.5, bucket.take(5))
+        sleep_mock.assert_called_once_with(0.5)
+        # Later callers wait for the earlier debt as well
+        self.assertEqual(1, bucket.take(5))
+
+        # The tokens accumulate up to a second's worth
+        time_mock.return_value = 200
+        self.assertEqual(0, bucket.take(10))
+        self.assertEqual(0.1, bucket.take(1))
+
+    @mock.patch('swift_metadata_sync.rate_limits.eventlet.sleep')
+    def test_unlimited(self, sleep_mock):
+        bucket = rate_limits.TokenBucket(0)
+        self.assertEqual(0, bucket.take(1000))
+        sleep_mock.assert_not_called()
+
+
+class TestRateLimits(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_get_bucket(self):
+        rate_limits.configure({'es_docs_per_second': 10})
+        bucket = rate_limits.get_bucket(
+            'es_docs_per_second', 'key', self.tempdir)
+        self.assertEqual(10, bucket.rate)
+        self.assertIs(bucket, rate_limits.get_bucket(
+            'es_docs_per_second', 'key', self.tempdir))
+        self.assertIsNot(bucket, rate_limits.get_bucket(
+            'es_docs_per_second', 'other', self.tempdir))
+        self.assertIsNot(bucket, rate_limits.get_bucket(
+            'es_bytes_per_second', 'key', self.tempdir))
+
+        # The rate follows the overrides of the limits
+        path = os.path.join(self.tempdir, rate_limits.RATE_LIMITS_FILE)
+        with open(path, 'w') as f:
+            json.dump({'es_docs_per_second': 20}, f)
+        self.assertIs(bucket, rate_limits.get_bucket(
+            'es_docs_per_second', 'key', self.tempdir))
+        self.assertEqual(20, bucket.rate)
+
+    def test_get_overrides(self):
+        path = os.path.join(self.tempdir, rate_limits.RATE_LIMITS_FILE)
+        self.assertEqual({}, rate_limits.get_overrides(path))
+
+        with open(path, 'w') as f:
+            json.dump({'swift_heads_per_second': 50}, f)
+        os.utime(path, (1000, 1000))
+        self.assertEqual({'swift_heads_per_second': 50},
+                         rate_limits.get_overrides(path))
+
+        # The file is only read again once it is modified
+        with open(path, 'w') as f:
+            f.write('[]')
+        os.utime(path, (1000, 1000))
+        self.assertEqual({'swift_heads_per_second': 50},
+                         rate_limits.get_overrides(path))
+        os.utime(path, (2000, 2000))
+        self.assertEqual({}, rate_limits.get_overrides(path))
+
+    def test_get_limits(self):
+        self.assertEqual({'swift_heads_per_second': 0,
+                          'es_docs_per_second': 0,
+                          'es_bytes_per_second': 0},
+                         rate_limits.get_limits(self.tempdir))
+
+        rate_limits.configure({'swift_heads_per_second': '50',
+                               'es_docs_per_second': 1000})
+        path = os.path.join(self.tempdir, rate_limits.RATE_LIMITS_FILE)
+        with open(path, 'w') as f:
+            json.dump({'es_docs_per_second': 10, 'unknown': 1}, f)
+        self.assertEqual({'swift_heads_per_second': 50,
+                          'es_docs_per_second': 10,
+                          'es_bytes_per_second': 0},
+                         rate_limits.get_limits(self.tempdir))
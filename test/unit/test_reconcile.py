@@ -0,0 +1,120 @@
+import collections
+import mock
+import unittest
+
+from swift.common.utils import Timestamp
+from swift.container.backend import ContainerBroker
+from swift_metadata_sync import reconcile, registry
+from swift_metadata_sync.metadata_sync import MetadataSync
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    def _create_broker(self, names):
+        broker = ContainerBroker(':memory:', account='a', container='c')
+        broker.initialize(Timestamp(1).internal, 0)
+        for i, name in enumerate(names):
+            broker.put_object(name, Timestamp(1000 + i).internal, 0,
+                              'text/plain', 'etag')
+        return broker
+
+    def test_iter_container_rows(self):
+        names = ['obj%02d' % i for i in range(7)] + ['\xc3\xa9']
+        broker = self._create_broker(reversed(names))
+        broker.delete_object('obj03', Timestamp(2000).internal)
+        rows = list(reconcile.iter_container_rows(broker, 3))
+        self.assertEqual([name for name in names if name != 'obj03'],
+                         [row['name'] for row in rows])
+        self.assertEqual(Timestamp(1007).internal, rows[0]['created_at'])
+
+    def test_diff(self):
+        def _row(name, ts):
+            return {'name': name, 'deleted': 0,
+                    'created_at': Timestamp(ts).internal}
+
+        rows = [_row('b', 10), _row('c', 10), _row('d', 10), _row('f', 10)]
+        indexed = [('a', 5000), ('c', 10000), ('d', 9999), ('e', 5000),
+                   ('e2', 20000), ('g', 5000)]
+        results = list(reconcile.diff(rows, indexed, 15000))
+        self.assertEqual(
+            [('orphaned', 'a'), ('missing', 'b'), ('stale', 'd'),
+             ('orphaned', 'e'), ('missing', 'f'), ('orphaned', 'g')],
+            [(reason, row['name']) for reason, row in results])
+        self.assertTrue(all(row['deleted'] for reason, row in results
+                            if reason == 'orphaned'))
+        self.assertEqual(
+            [5001, 5001, 5001],
+            [MetadataSync._get_row_timestamp(row) for reason, row in results
+             if reason == 'orphaned'])
+
+        self.assertEqual([], list(reconcile.diff([], [], 0)))
+        self.assertEqual(
+            ['missing'], [reason for reason, _ in reconcile.diff(
+                [_row('a', 1)], [], 0)])
+
+    def test_reconcile_mapping(self):
+        names = ['obj%d' % i for i in range(5)]
+        broker = self._create_broker(names)
+        sync = mock.Mock()
+        # obj0 and obj2 are current, obj1 is stale and the rest are missing
+        sync.iter_indexed_objects.return_value = iter([
+            ('obj0', 1000000), ('obj1', 1000), ('obj2', 1002000),
+            ('old', 1000)])
+        internal_client = mock.Mock()
+
+        counts = reconcile.reconcile_mapping(
+            sync, broker, internal_client, 2)
+        self.assertEqual({'missing': 2, 'stale': 1, 'orphaned': 1}, counts)
+        sync.iter_indexed_objects.assert_called_once_with(2)
+        handled = [[row['name'] for row in call[1][0]]
+                   for call in sync.handle.mock_calls]
+        self.assertEqual([['obj1', 'obj3'], ['obj4', 'old']], handled)
+        for call in sync.handle.mock_calls:
+            self.assertIs(internal_client, call[1][1])
+
+    @mock.patch('swift_metadata_sync.reconcile.reconcile_mapping')
+    @mock.patch('swift_metadata_sync.reconcile.MetadataSync')
+    @mock.patch('swift_metadata_sync.reconcile.replicas.find_broker')
+    @mock.patch('swift_metadata_sync.reconcile.InternalClient')
+    def test_reconcile_settings(self, mock_ic, mock_find_broker,
+                                mock_sync, mock_reconcile_mapping):
+        mock_reconcile_mapping.return_value = collections.Counter()
+        mapping = {'account': 'a', 'container': 'c', 'index': 'i',
+                   'es_hosts': 'localhost', 'persist_freshness_cache': True,
+                   'freshness_cache_size': 100, 'max_rows_per_cycle': 10}
+        reconcile.reconcile({'status_dir': '/status', 'devices': '/srv',
+                             'containers': [mapping]})
+
+        mock_sync.assert_called_once_with('/status', mock.ANY)
+        settings = mock_sync.mock_calls[0][1][1]
+        self.assertFalse(settings['persist_freshness_cache'])
+        self.assertEqual(0, settings['freshness_cache_size'])
+        self.assertEqual(0, settings['max_rows_per_cycle'])
+        self.assertFalse(settings['replica_partitioning'])
+        self.assertTrue(settings['skip_missing_objects'])
+        # The mapping itself is left unchanged
+        self.assertTrue(mapping['persist_freshness_cache'])
+
+    @mock.patch('swift_metadata_sync.reconcile.reconcile_mapping')
+    @mock.patch('swift_metadata_sync.reconcile.MetadataSync')
+    @mock.patch('swift_metadata_sync.reconcile.replicas.find_broker')
+    @mock.patch('swift_metadata_sync.reconcile.InternalClient')
+    def test_reconcile_failures(self, mock_ic, mock_find_broker,
+                                mock_sync, mock_reconcile_mapping):
+        mock_reconcile_mapping.side_effect = [
+            RuntimeError('Failed to process some entries'),
+            collections.Counter()]
+        mappings = [{'account': 'a', 'container': 'c%d' % i, 'index': 'i',
+                     'es_hosts': 'localhost'} for i in range(2)]
+        with mock.patch('swift_metadata_sync.reconcile.logging') as logging:
+            self.assertEqual(1, reconcile.reconcile(
+                {'status_dir': '/status', 'devices': '/srv',
+                 'containers': mappings}))
+        # The failure does not stop the other mappings
+        self.assertEqual(2, mock_reconcile_mapping.call_count)
+        logger = logging.getLogger.return_value
+        logger.exception.assert_called_once_with(
+            'Failed to reconcile a/c0')
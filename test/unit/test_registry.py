@@ -0,0 +1,35 @@
+import mock
+import unittest
+
+from swift_metadata_sync import registry
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    def test_get(self):
+        factory = mock.Mock(side_effect=lambda: object())
+        obj = registry.get('kind', 'key', factory)
+        self.assertIs(obj, registry.get('kind', 'key', factory))
+        self.assertEqual(1, factory.call_count)
+        self.assertIsNot(obj, registry.get('kind', 'other', factory))
+        self.assertIsNot(obj, registry.get('other', 'key', factory))
+        self.assertEqual(3, factory.call_count)
+
+    def test_values(self):
+        registry.get('kind', 'a', lambda: 1)
+        registry.get('kind', 'b', lambda: 2)
+        registry.get('other', 'a', lambda: 3)
+        self.assertEqual([1, 2], sorted(registry.values('kind')))
+        self.assertEqual([], registry.values('missing'))
+
+    def test_clear(self):
+        registry.get('kind', 'a', lambda: 1)
+        registry.get('other', 'a', lambda: 2)
+        registry.clear('kind')
+        self.assertEqual([], registry.values('kind'))
+        self.assertEqual([2], registry.values('other'))
+        registry.clear()
+        self.assertEqual([], registry.values('other'))
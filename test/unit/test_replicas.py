@@ -0,0 +1,105 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift.common.utils import hash_path, storage_directory
+
+from swift_metadata_sync import replicas, registry
+
+
+class TestReplicaPartition(unittest.TestCase):
+    def test_is_primary(self):
+        partitions = [replicas.ReplicaPartition(i, 3) for i in range(3)]
+        for doc_id in ['00000000', '00000001', '00000002', 'ffffffffab']:
+            self.assertEqual(
+                1, sum(p.is_primary(doc_id) for p in partitions))
+        self.assertTrue(partitions[0].is_primary('00000003'))
+        self.assertTrue(partitions[2].is_primary('00000002'))
+
+
+class TestDeferredRows(unittest.TestCase):
+    def test_due_and_remove(self):
+        deferred = replicas.DeferredRows()
+        rows = [{'name': 'o%d' % i, 'ROWID': i + 1} for i in range(3)]
+        for i, row in enumerate(rows):
+            deferred.add('id%d' % i, row, 10 + i)
+        self.assertEqual(3, len(deferred))
+        self.assertEqual([], deferred.due(9))
+        self.assertEqual(rows[:2], deferred.due(11))
+        # The rows are returned until they are removed
+        self.assertEqual(rows[:2], deferred.due(11))
+        self.assertEqual(1, deferred.oldest_row_id())
+        deferred.remove(2)
+        self.assertEqual(rows[2:], deferred.due(20))
+        self.assertEqual(3, deferred.oldest_row_id())
+        deferred.remove(1)
+        self.assertEqual(0, len(deferred))
+        self.assertIsNone(deferred.oldest_row_id())
+
+    def test_add_duplicate(self):
+        deferred = replicas.DeferredRows()
+        row = {'name': 'o', 'ROWID': 1}
+        deferred.add('id', row, 10)
+        deferred.add('id', row, 10)
+        self.assertEqual(1, len(deferred))
+        # A newer row for the same object is added
+        deferred.add('id', dict(row, ROWID=2), 20)
+        self.assertEqual(2, len(deferred))
+
+
+class TestGetPartition(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+        self.addCleanup(registry.clear)
+
+    @mock.patch('swift_metadata_sync.replicas.whataremyips')
+    @mock.patch('swift_metadata_sync.replicas.Ring')
+    def test_get_partition(self, ring_mock, ips_mock):
+        ring_mock.return_value.get_nodes.return_value = (1, [
+            {'ip': '10.0.0.1', 'port': 6201},
+            {'ip': '10.0.0.2', 'port': 6201},
+            {'ip': '10.0.0.2', 'port': 6202}])
+        ips_mock.return_value = ['10.0.0.2']
+
+        partition = replicas.get_partition('/etc/swift', u'a', u'c', 6202)
+        self.assertEqual((2, 3), (partition.index, partition.count))
+        ring_mock.assert_called_once_with('/etc/swift', ring_name='container')
+        ring_mock.return_value.get_nodes.assert_called_once_with('a', 'c')
+
+        # Without a port, the first node with a local IP is used
+        partition = replicas.get_partition('/etc/swift', u'a', u'c')
+        self.assertEqual((1, 3), (partition.index, partition.count))
+        self.assertEqual(1, ring_mock.call_count)
+
+        # Handoff nodes are not assigned a partition
+        ips_mock.return_value = ['10.0.0.9']
+        self.assertIsNone(replicas.get_partition('/etc/swift', u'a', u'c'))
+
+    @mock.patch('swift_metadata_sync.replicas.Ring')
+    def test_find_broker(self, ring_mock):
+        ring_mock.return_value.get_part.return_value = 7
+        devices = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, devices)
+        name_hash = hash_path('a', u'c\u00e9'.encode('utf-8'))
+        os.mkdir(os.path.join(devices, 'sda'))
+        self.assertIsNone(
+            replicas.find_broker(devices, '/etc/swift', u'a', u'c\u00e9'))
+
+        db_dir = os.path.join(devices, 'sdb',
+                              storage_directory('containers', 7, name_hash))
+        os.makedirs(db_dir)
+        open(os.path.join(db_dir, name_hash + '.db'), 'w').close()
+        broker = replicas.find_broker(devices, '/etc/swift', u'a',
+                                      u'c\u00e9')
+        self.assertEqual(os.path.join(db_dir, name_hash + '.db'),
+                         broker.db_file)
+        ring_mock.return_value.get_part.assert_called_with(
+            'a', u'c\u00e9'.encode('utf-8'))
+
+    def test_get_deferred_rows(self):
+        deferred = replicas.get_deferred_rows(('a', 'c', 'i'))
+        self.assertIs(deferred, replicas.get_deferred_rows(('a', 'c', 'i')))
+        self.assertIsNot(
+            deferred, replicas.get_deferred_rows(('a', 'c', 'j')))
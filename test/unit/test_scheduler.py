@@ -0,0 +1,27 @@
+import unittest
+
+from swift_metadata_sync import scheduler, registry
+
+
+class TestFairScheduler(unittest.TestCase):
+    def test_steady_state(self):
+        fair_scheduler = scheduler.FairScheduler()
+        self.assertIsNone(fair_scheduler.limit('a', 100, 1, 0))
+        self.assertIsNone(fair_scheduler.limit('a', 100, 1, 100))
+
+    def test_backfills_share_by_priority(self):
+        fair_scheduler = scheduler.FairScheduler()
+        self.assertEqual(100, fair_scheduler.limit('a', 1000, 1, 100))
+        self.assertEqual(100, fair_scheduler.limit('b', 1000, 4, 100))
+        self.assertEqual(25, fair_scheduler.limit('a', 1000, 1, 100))
+        self.assertEqual(1, fair_scheduler.limit('c', 1000, 0.001, 100))
+
+        # Mappings that caught up no longer take a share
+        self.assertIsNone(fair_scheduler.limit('b', 50, 4, 100))
+        self.assertEqual(100, fair_scheduler.limit('a', 1000, 1, 100))
+
+    def test_get_scheduler(self):
+        fair_scheduler = scheduler.get_scheduler()
+        self.assertIs(fair_scheduler, scheduler.get_scheduler())
+        registry.clear()
+        self.assertIsNot(fair_scheduler, scheduler.get_scheduler())
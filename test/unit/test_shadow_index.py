@@ -0,0 +1,128 @@
+import elasticsearch
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import shadow_index
+
+
+class TestShadowIndex(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.state_file = os.path.join(self.status_dir, 'account', 'state')
+        self.es_conn = mock.Mock()
+        self.shadow = shadow_index.ShadowIndex(
+            self.es_conn, 'new', 'old', 'alias', self.state_file, 100)
+
+    def _state(self):
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    def test_reindex(self):
+        self.es_conn.reindex.return_value = {'task': 'node:1'}
+        self.es_conn.tasks.get.side_effect = [
+            {'completed': False},
+            {'completed': True, 'response': {'failures': []}}]
+        query = {'match_all': {}}
+
+        # The task is checked once per call
+        self.assertIsNone(self.shadow.reindex(query, 42))
+        self.es_conn.reindex.assert_called_once_with(
+            body={'source': {'index': 'old', 'query': query},
+                  'dest': {'index': 'new'}},
+            wait_for_completion=False,
+            requests_per_second=100)
+        self.es_conn.tasks.get.assert_called_once_with(task_id='node:1')
+        self.assertEqual(42, self.shadow.reindex(query, 50))
+        self.assertEqual(1, self.es_conn.reindex.call_count)
+        self.assertEqual(2, self.es_conn.tasks.get.call_count)
+        self.assertEqual({'task': 'node:1', 'row': 42}, self._state())
+
+        # A restarted daemon waits for the same task
+        self.es_conn.reset_mock()
+        self.es_conn.tasks.get.side_effect = None
+        self.es_conn.tasks.get.return_value = {'completed': True}
+        shadow = shadow_index.ShadowIndex(
+            self.es_conn, 'new', 'old', 'alias', self.state_file)
+        self.assertEqual(42, shadow.reindex(query, 50))
+        self.es_conn.reindex.assert_not_called()
+
+    def test_reindex_failures(self):
+        self.es_conn.reindex.return_value = {'task': 'node:1'}
+        self.es_conn.tasks.get.return_value = {
+            'completed': True, 'response': {'failures': ['oops']}}
+        with self.assertRaises(RuntimeError):
+            self.shadow.reindex({}, 42)
+        # The reindexing is started again on the next attempt
+        self.assertEqual({}, self._state())
+
+        self.es_conn.tasks.get.side_effect = elasticsearch.NotFoundError(
+            404, 'resource_not_found_exception')
+        with self.assertRaises(RuntimeError):
+            self.shadow.reindex({}, 42)
+        self.assertEqual({}, self._state())
+
+    def test_promote(self):
+        self.es_conn.indices.get_alias.return_value = {
+            'old': {'aliases': {'alias': {}}}}
+        self.assertFalse(self.shadow.promoted)
+        self.shadow.promote()
+        self.es_conn.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'remove': {'index': 'old', 'alias': 'alias'}},
+                        {'add': {'index': 'new', 'alias': 'alias'}}]})
+        self.assertTrue(self.shadow.promoted)
+        self.assertTrue(shadow_index.ShadowIndex(
+            self.es_conn, 'new', 'old', 'alias', self.state_file).promoted)
+
+    def test_promote_new_alias(self):
+        self.es_conn.indices.get_alias.return_value = {
+            'error': 'alias [alias] missing', 'status': 404}
+        self.shadow.promote()
+        self.es_conn.indices.get_alias.assert_called_once_with(
+            name='alias', ignore=404)
+        self.es_conn.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'add': {'index': 'new', 'alias': 'alias'}}]})
+
+    def test_promote_without_alias(self):
+        shadow = shadow_index.ShadowIndex(
+            self.es_conn, 'new', 'old', None, self.state_file)
+        shadow.promote()
+        self.es_conn.indices.update_aliases.assert_not_called()
+        self.assertTrue(shadow.promoted)
+
+    def test_check_aliases(self):
+        live = {'account': 'a', 'container': 'c', 'index': 'old'}
+        shadow = dict(live, index='new', shadow_of='old', alias='alias')
+        other = {'account': 'a', 'container': 'c2', 'index': 'other'}
+        shadow_index.check_aliases([live, shadow, other])
+        # Without an alias, the shadow indices may be shared
+        shadow_index.check_aliases([
+            live, dict(shadow, alias=None), dict(other, index='old'),
+            dict(other, index='new', shadow_of='old')])
+
+        # The alias would be moved once either container catches up
+        for mappings in (
+                [live, shadow, dict(other, index='old')],
+                [live, shadow, dict(other, index='new', shadow_of='other',
+                                    alias='alias')],
+                [dict(live, index='other'), dict(shadow, shadow_of='other'),
+                 other]):
+            with self.assertRaises(ValueError):
+                shadow_index.check_aliases(mappings)
+
+    @mock.patch('swift_metadata_sync.shadow_index.eventlet.sleep')
+    def test_throttle(self, sleep_mock):
+        self.shadow.throttle(50, 0.1)
+        sleep_mock.assert_called_once_with(0.4)
+        sleep_mock.reset_mock()
+        self.shadow.throttle(50, 1)
+        sleep_mock.assert_not_called()
+
+        self.es_conn.indices.get_alias.return_value = {}
+        self.shadow.promote()
+        self.shadow.throttle(50, 0.1)
+        sleep_mock.assert_not_called()
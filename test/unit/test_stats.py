@@ -0,0 +1,151 @@
+import mock
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from swift_metadata_sync import registry, stats
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.addCleanup(registry.clear)
+        self.labels = (('account', u'AUTH_test'),
+                       ('container', u'c.1'),
+                       ('index', 'index'))
+
+    def test_no_sinks(self):
+        mapping_stats = stats.Stats([], u'AUTH_test', u'c', 'index')
+        self.assertFalse(mapping_stats.enabled)
+        mapping_stats.incr('rows', 10)
+        with mapping_stats.timer('handle'):
+            pass
+        mapping_stats.flush()
+
+    @mock.patch('swift_metadata_sync.stats.time.time')
+    def test_timer(self, time_mock):
+        time_mock.side_effect = [100, 101.5]
+        sink = mock.Mock()
+        mapping_stats = stats.Stats([sink], u'AUTH_test', u'c.1', 'index')
+        with mapping_stats.timer('handle'):
+            pass
+        sink.timing.assert_called_once_with('handle', 1.5, self.labels)
+
+    @mock.patch('swift_metadata_sync.stats.socket')
+    def test_statsd_sink(self, socket_mock):
+        socket_mock.error = socket.error
+        socket_mock.gethostbyname.return_value = '10.0.0.1'
+        sock = socket_mock.socket.return_value
+        sink = stats.StatsdSink('statsd.example.com', 8125, 'sync')
+        sink.incr('rows', 10, self.labels)
+        sink.timing('head', 0.25, self.labels)
+        sink.gauge('lag_rows', 42, self.labels)
+        self.assertEqual(
+            [mock.call('sync.AUTH_test.c_1.index.rows:10|c',
+                       ('10.0.0.1', 8125)),
+             mock.call('sync.AUTH_test.c_1.index.head:250.000|ms',
+                       ('10.0.0.1', 8125)),
+             mock.call('sync.AUTH_test.c_1.index.lag_rows:42.000000|g',
+                       ('10.0.0.1', 8125))],
+            sock.sendto.mock_calls)
+
+        # Errors are ignored
+        sock.sendto.side_effect = socket.error('unreachable')
+        sink.incr('rows', 1, self.labels)
+
+    @mock.patch('swift_metadata_sync.stats.time.time')
+    def test_prometheus_file_sink(self, time_mock):
+        time_mock.return_value = 1000
+        path = os.path.join(self.status_dir, 'stats.prom')
+        sink = stats.PrometheusFileSink(path, 'sync', flush_interval=10)
+        sink.incr('rows', 10, self.labels)
+        sink.incr('rows', 5, self.labels)
+        sink.timing('head', 0.5, self.labels)
+        sink.timing('head', 0.25, self.labels)
+        sink.gauge('lag_rows', 20, self.labels)
+        sink.gauge('lag_rows', 7, self.labels)
+        other_labels = (('account', u'AUTH_\u062a'),
+                        ('container', u'c"2'),
+                        ('index', 'index'))
+        sink.incr('rows', 1, other_labels)
+
+        sink.maybe_flush()
+        self.assertFalse(os.path.exists(path))
+        time_mock.return_value = 1010
+        sink.maybe_flush()
+        with open(path) as f:
+            self.assertEqual(
+                '# TYPE sync_rows_total counter\n'
+                'sync_rows_total{account="AUTH_test",container="c.1",'
+                'index="index"} 15\n'
+                'sync_rows_total{account="AUTH_\xd8\xaa",container="c\\"2",'
+                'index="index"} 1\n'
+                '# TYPE sync_lag_rows gauge\n'
+                'sync_lag_rows{account="AUTH_test",container="c.1",'
+                'index="index"} 7.000000\n'
+                '# TYPE sync_head_seconds summary\n'
+                'sync_head_seconds_sum{account="AUTH_test",container="c.1",'
+                'index="index"} 0.750000\n'
+                'sync_head_seconds_count{account="AUTH_test",'
+                'container="c.1",index="index"} 2\n', f.read())
+
+    def test_get_sinks(self):
+        self.assertEqual([], stats.get_sinks({}, self.status_dir))
+
+        settings = {'statsd_host': '127.0.0.1',
+                    'statsd_port': 9125,
+                    'prometheus_stats': True,
+                    'stats_flush_interval': 30}
+        statsd_sink, file_sink = stats.get_sinks(settings, self.status_dir)
+        self.assertEqual(('127.0.0.1', 9125), statsd_sink._address)
+        self.assertEqual(stats.DEFAULT_PREFIX, statsd_sink.prefix)
+        self.assertEqual(
+            os.path.join(self.status_dir, stats.PROMETHEUS_FILE),
+            file_sink.path)
+        self.assertEqual(30, file_sink.flush_interval)
+        # The sinks are shared by the mappings
+        self.assertEqual([statsd_sink, file_sink],
+                         stats.get_sinks(settings, self.status_dir))
+        settings['stats_flush_interval'] = 1
+        stats.get_sinks(settings, self.status_dir)
+        self.assertEqual(30, file_sink.flush_interval)
+
+        file_sink.incr('rows', 1, self.labels)
+        stats.flush_sinks()
+        self.assertTrue(os.path.exists(file_sink.path))
+
+    def test_merge_worker_files(self):
+        for worker, rows in [(0, 10), (1, 5)]:
+            sink = stats.PrometheusFileSink(
+                os.path.join(self.status_dir,
+                             'swift_metadata_sync.%d.prom' % worker),
+                stats.DEFAULT_PREFIX)
+            sink.incr('rows', rows, self.labels)
+            sink.incr('rows', 1, (('account', u'AUTH_%d' % worker),))
+            sink.timing('head', 0.25, self.labels)
+            sink.flush()
+
+        stats.merge_worker_files(self.status_dir)
+        with open(os.path.join(self.status_dir, stats.PROMETHEUS_FILE)) as f:
+            self.assertEqual(
+                '# TYPE swift_metadata_sync_head_seconds summary\n'
+                'swift_metadata_sync_head_seconds_count{account="AUTH_test",'
+                'container="c.1",index="index"} 2\n'
+                'swift_metadata_sync_head_seconds_sum{account="AUTH_test",'
+                'container="c.1",index="index"} 0.500000\n'
+                '# TYPE swift_metadata_sync_rows_total counter\n'
+                'swift_metadata_sync_rows_total{account="AUTH_0"} 1\n'
+                'swift_metadata_sync_rows_total{account="AUTH_1"} 1\n'
+                'swift_metadata_sync_rows_total{account="AUTH_test",'
+                'container="c.1",index="index"} 15\n', f.read())
+
+    def test_worker_sinks(self):
+        stats.set_worker(3)
+        self.addCleanup(stats.set_worker, None)
+        [sink] = stats.get_sinks({'prometheus_stats': True}, self.status_dir)
+        self.assertEqual(
+            os.path.join(self.status_dir, 'swift_metadata_sync.3.prom'),
+            sink.path)
@@ -0,0 +1,137 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import freshness_cache, stats, workers
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.addCleanup(stats.set_worker, None)
+        self.conf = {
+            'status_dir': self.status_dir,
+            'containers': [{'account': u'AUTH_test',
+                            'container': u'container-%d' % i,
+                            'index': 'index',
+                            'es_hosts': 'localhost'} for i in range(20)]}
+
+    def test_shard_index(self):
+        mapping = {'account': u'AUTH_\u062a', 'container': u'container'}
+        shard = workers.shard_index(mapping, 4)
+        self.assertTrue(0 <= shard < 4)
+        # The shard must be stable across processes and runs
+        self.assertEqual(shard, workers.shard_index(dict(mapping), 4))
+        self.assertEqual(
+            0, workers.shard_index({'account': u'AUTH_test',
+                                    'container': u'container-0'}, 4))
+
+    def test_shard_conf(self):
+        confs = [workers.shard_conf(self.conf, shard, 3)
+                 for shard in range(3)]
+        mappings = [mapping for conf in confs
+                    for mapping in conf['containers']]
+        self.assertEqual(
+            sorted(self.conf['containers']), sorted(mappings))
+        for conf in confs:
+            self.assertEqual(self.status_dir, conf['status_dir'])
+            self.assertTrue(conf['containers'])
+
+    def test_skips_empty_shards(self):
+        conf = dict(self.conf, containers=self.conf['containers'][:1])
+        supervisor = workers.Supervisor(conf, 4, mock.Mock())
+        self.assertEqual([0], supervisor.shard_confs.keys())
+
+    def _run_worker(self, conf):
+        # Records the mappings handled by the worker process
+        stats.get_sinks({'prometheus_stats': True}, self.status_dir)[0].incr(
+            'rows', len(conf['containers']), (('index', 'index'),))
+        with open(os.path.join(self.status_dir, 'worker.%d' % os.getpid()),
+                  'w') as f:
+            f.write('\n'.join(
+                mapping['container'] for mapping in conf['containers']))
+        if any(mapping['container'] == u'fail'
+               for mapping in conf['containers']):
+            raise RuntimeError('worker failure')
+
+    def _handled_mappings(self):
+        handled = []
+        for name in os.listdir(self.status_dir):
+            if name.startswith('worker.'):
+                with open(os.path.join(self.status_dir, name)) as f:
+                    handled.append(f.read().split('\n'))
+        return handled
+
+    def test_run_once(self):
+        supervisor = workers.Supervisor(
+            self.conf, 3, self._run_worker, once=True)
+        supervisor.POLL_INTERVAL = 0.01
+        self.assertEqual(0, supervisor.run())
+
+        handled = self._handled_mappings()
+        self.assertEqual(3, len(handled))
+        self.assertEqual(
+            sorted(mapping['container']
+                   for mapping in self.conf['containers']),
+            sorted(sum(handled, [])))
+        # The stats of the workers are merged
+        with open(os.path.join(self.status_dir, stats.PROMETHEUS_FILE)) as f:
+            self.assertEqual(
+                '# TYPE swift_metadata_sync_rows_total counter\n'
+                'swift_metadata_sync_rows_total{index="index"} 20\n', f.read())
+
+    def test_run_once_failure(self):
+        self.conf['containers'].append(
+            dict(self.conf['containers'][0], container=u'fail'))
+        supervisor = workers.Supervisor(
+            self.conf, 3, self._run_worker, once=True)
+        supervisor.POLL_INTERVAL = 0.01
+        with mock.patch.object(supervisor, 'logger') as logger:
+            self.assertEqual(1, supervisor.run())
+        self.assertEqual(3, len(self._handled_mappings()))
+        logger.error.assert_called_once_with(
+            'Worker %d exited with status 1' % workers.shard_index(
+                self.conf['containers'][-1], 3))
+
+    def test_flushes_caches(self):
+        path = os.path.join(self.status_dir, 'freshness')
+
+        def _run_worker(conf):
+            cache = freshness_cache.get_cache(os.getpid(), 10)
+            cache.maybe_save(path, 'index', 3600)
+            cache.update('doc-id', 1000)
+
+        conf = dict(self.conf, containers=self.conf['containers'][:1])
+        supervisor = workers.Supervisor(conf, 1, _run_worker, once=True)
+        supervisor.POLL_INTERVAL = 0.01
+        self.assertEqual(0, supervisor.run())
+        # The workers exit without running the atexit handlers
+        cache = freshness_cache.FreshnessCache(10)
+        cache.load(path, 'index')
+        self.assertTrue(cache.is_fresh('doc-id', 1000))
+
+    @mock.patch('swift_metadata_sync.workers.time.time')
+    def test_restart_backoff(self, time_mock):
+        supervisor = workers.Supervisor(self.conf, 2, mock.Mock())
+        supervisor.logger = mock.Mock()
+        time_mock.return_value = 1000
+        supervisor._started = {0: 1000, 1: 1000}
+
+        for delay in [1, 2, 4, 8, 16, 32, 60, 60]:
+            supervisor._exited(0, 256)
+            self.assertEqual(1000 + delay, supervisor._restarts[0])
+        self.assertTrue(supervisor._failed)
+
+        # A worker that ran for a while is restarted right away
+        time_mock.return_value = 2000
+        supervisor._exited(0, 256)
+        self.assertEqual(2001, supervisor._restarts[0])
+
+        # Workers are not restarted when stopping
+        supervisor._restarts.clear()
+        supervisor._stopping = True
+        supervisor._exited(1, 0)
+        self.assertEqual({}, supervisor._restarts)